@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import contextlib
+from subprocess import check_output as shell_call
+
+import pycab
+
+#
+# Synthetic IFC Generation
+#
+
+# Default share of each element type in a synthetic model
+DEFAULT_MIX = {
+    'Wall': 0.40,
+    'Slab': 0.10,
+    'Roof': 0.05,
+    'Door': 0.15,
+    'Window': 0.25,
+    'Stair': 0.05
+}
+
+# Layer build-ups as (material name, embodied carbon in kgCO2/kg, mass density in kg/m^3, thickness in mm)
+WALL_BUILD_UPS = [
+    [('Clay, Brick', 0.213, 1700., 102.5), ('Insulation, Mineral wool', 1.28, 140., 100.),
+     ('Concrete Block', 0.093, 1760., 100.), ('Plaster Skim Finish', 0.87, 1430., 12.5)],
+    [('Concrete Block', 0.093, 1760., 140.), ('Plasterboard', 0.39, 800., 12.5)],
+    [('Plasterboard', 0.39, 800., 12.5), ('Timber, Panel', 0.345, 550., 50.), ('Plasterboard', 0.39, 800., 12.5)],
+    [('Stone, Limestone', 0.09, 2750., 150.), ('Insulation, Expanded Polystyrene', 3.29, 24., 120.),
+     ('AAC Concrete Block', 0.28, 750., 100.)],
+]
+SLAB_BUILD_UPS = [
+    [('RC 28/35 (CEM I)', 0.136, 2300., 200.), ('Insulation, Expanded Polystyrene', 3.29, 24., 100.),
+     ('LDPE Film, Foundation', 2.6, 1200., 1.)],
+    [('RC 25/30 (CEM I)', 0.129, 2300., 150.), ('Timber, Floor (Oak)', 0.811, 720., 20.)],
+]
+ROOF_BUILD_UPS = [
+    [('Slate Shingle, Roof', 0.035, 2750., 10.), ('Membrane, Roof', 1.93, 1380., 2.), ('Timber, Roof', 0.263, 510., 150.)],
+    [('Membrane, Roof', 1.93, 1380., 4.), ('Insulation, Rockwool', 1.12, 23., 200.), ('Precast Concrete', 0.132, 2300., 150.)],
+]
+
+# Number of related objects per relationship when one definition is shared by many elements
+RELATED_OBJECTS_CHUNK = 1000
+
+
+class Enumeration(str):
+    pass
+
+
+class Typed:
+    def __init__(self, type, value):
+        self.type = type
+        self.value = value
+
+
+class Reference(int):
+    pass
+
+
+def format_step_string(string):
+    # Quote a string, escaping non ASCII characters as \X2\
+    encoded = []
+    for character in string.replace('\\', '\\\\').replace("'", "''"):
+        if ord(character) < 128:
+            encoded.append(character)
+        else:
+            encoded.append('\\X2\\%04X\\X0\\' % ord(character))
+    return "'" + ''.join(encoded) + "'"
+
+
+def format_step_value(value):
+    if value is None:
+        return '$'
+    if isinstance(value, Reference):
+        return '#%d' % value
+    if isinstance(value, Enumeration):
+        return '.%s.' % value
+    if isinstance(value, bool):
+        return '.T.' if value else '.F.'
+    if isinstance(value, Typed):
+        return '%s(%s)' % (value.type, format_step_value(value.value))
+    if isinstance(value, str):
+        return format_step_string(value)
+    if isinstance(value, float):
+        # STEP reals always have a decimal point
+        text = repr(value).upper().replace('E+', 'E')
+        if '.' not in text:
+            text = text.replace('E', '.E') if 'E' in text else text + '.'
+        return text
+    if isinstance(value, (list, tuple)):
+        return '(' + ','.join(format_step_value(item) for item in value) + ')'
+    return str(value)
+
+
+class StepWriter:
+    '''
+    Write IFC2X3 STEP entities straight to a file, so models of
+    millions of elements can be generated in constant memory.
+
+    '''
+
+    def __init__(self, f):
+        self.f = f
+        self.next_id = 1
+        self.guid_count = 0
+        self.f.write("ISO-10303-21;\nHEADER;\nFILE_DESCRIPTION(('ViewDefinition [CoordinationView]'),'2;1');\n"
+                     "FILE_NAME('synthetic.ifc','2000-01-01T00:00:00',(''),(''),'pycab benchmark','pycab benchmark','');\n"
+                     "FILE_SCHEMA(('IFC2X3'));\nENDSEC;\nDATA;\n")
+
+    def add(self, type, *arguments):
+        step_id = self.next_id
+        self.next_id += 1
+        self.f.write('#%d=%s(%s);\n' % (step_id, type, ','.join(format_step_value(argument) for argument in arguments)))
+        return Reference(step_id)
+
+    def guid(self):
+        # Deterministic 22 character GlobalIds
+        alphabet = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz_$'
+        number = self.guid_count
+        self.guid_count += 1
+        characters = []
+        for _ in range(22):
+            characters.append(alphabet[number % 64])
+            number //= 64
+        return ''.join(reversed(characters))
+
+    def close(self):
+        self.f.write('ENDSEC;\nEND-ISO-10303-21;\n')
+
+
+def get_element_counts(element_count, mix=None):
+    # Split a total number of elements according to the share of each element type
+    mix = mix or DEFAULT_MIX
+    counts = {name: int(element_count * share) for name, share in mix.items()}
+    counts['Wall'] += element_count - sum(counts.values())
+    return counts
+
+
+def get_model_path(workdir, element_count, counts):
+    # Path of a synthetic model, named after its counts unless they follow the default mix
+    if counts == get_element_counts(element_count):
+        return os.path.join(workdir, 'synthetic_%d.ifc' % element_count)
+    return os.path.join(workdir, 'synthetic_%d_%s.ifc' % (
+        element_count, '_'.join('%s%d' % (name, count) for name, count in counts.items())))
+
+
+def generate_ifc(path, counts, seed=0):
+    '''
+    Generate a synthetic IFC2X3 model with the property structures pycab
+    reads: ``BaseQuantities``, ``Pset_*Common`` with ``IsExternal``,
+    nested ``Material Properties``, ``EC_Pset_EmbodiedCarbon``, roof
+    ``Component Quantities`` and material layer set usages.
+
+    Layer build-ups and property sets are shared between elements, as
+    they would be by element types in an exported model.
+
+    :param path:
+        str;
+        The path of the generated file.
+
+    :param counts:
+        dict;
+        The number of elements per type (``Wall``, ``Slab``, ``Roof``,
+        ``Door``, ``Window`` and ``Stair``).
+
+    :param seed:
+        int;
+        The seed of the random quantities.
+
+    '''
+    rnd = random.Random(seed)
+    with open(path, 'w') as f:
+        w = StepWriter(f)
+        person = w.add('IFCPERSON', None, None, None, None, None, None, None, None)
+        organization = w.add('IFCORGANIZATION', None, 'pycab', None, None, None)
+        application = w.add('IFCAPPLICATION', organization, '1', 'pycab benchmark', 'pycab')
+        owner = w.add('IFCOWNERHISTORY', w.add('IFCPERSONANDORGANIZATION', person, organization, None), application,
+                      None, Enumeration('ADDED'), None, None, None, 0)
+
+        def relate(type, related, relating):
+            # Relate elements to a shared definition in chunks of RELATED_OBJECTS_CHUNK
+            for start in range(0, len(related), RELATED_OBJECTS_CHUNK):
+                w.add(type, w.guid(), owner, None, None, related[start:start + RELATED_OBJECTS_CHUNK], relating)
+
+        def property_set(name, properties):
+            return w.add('IFCPROPERTYSET', w.guid(), owner, name, None, properties)
+
+        def single_value(name, value):
+            return w.add('IFCPROPERTYSINGLEVALUE', name, None, value, None)
+
+        def element_quantity(name, quantities):
+            return w.add('IFCELEMENTQUANTITY', w.guid(), owner, name, None, None, quantities)
+
+        def material_properties(build_up, component_names):
+            components = []
+            for component_name, (name, embodied_carbon, mass_density, _) in zip(component_names, build_up):
+                material = w.add('IFCCOMPLEXPROPERTY', name, None, 'Material', [
+                    single_value('Embodied Carbon', Typed('IFCLABEL', '%s (kgCO₂/kg)' % embodied_carbon)),
+                    single_value('MassDensity', Typed('IFCREAL', mass_density))])
+                components.append(w.add('IFCCOMPLEXPROPERTY', component_name, None, 'Component', [material]))
+            return property_set('Material Properties', components)
+
+        def common_psets(name):
+            return {is_external: property_set(name, [single_value('IsExternal', Typed('IFCBOOLEAN', is_external))])
+                    for is_external in (False, True)}
+
+        project = w.add('IFCPROJECT', w.guid(), owner, 'Synthetic Project', None, None, None, None, None, None)
+        site = w.add('IFCSITE', w.guid(), owner, 'Site', None, None, None, None, None, Enumeration('ELEMENT'),
+                     None, None, None, None, None)
+        building = w.add('IFCBUILDING', w.guid(), owner, 'Building', None, None, None, None, None,
+                         Enumeration('ELEMENT'), None, None, None)
+        storey = w.add('IFCBUILDINGSTOREY', w.guid(), owner, 'Level 0', None, None, None, None, None,
+                       Enumeration('ELEMENT'), 0.)
+        w.add('IFCRELAGGREGATES', w.guid(), owner, None, None, project, [site])
+        w.add('IFCRELAGGREGATES', w.guid(), owner, None, None, site, [building])
+        w.add('IFCRELAGGREGATES', w.guid(), owner, None, None, building, [storey])
+        relate('IFCRELDEFINESBYPROPERTIES', [building], property_set('Pset_BuildingCommon', [
+            single_value('BuildingID', Typed('IFCIDENTIFIER', 'Synthetic')),
+            single_value('YearOfConstruction', Typed('IFCLABEL', '2024')),
+            single_value('Location', Typed('IFCLABEL', 'Synthetic')),
+            single_value('BuildingType', Typed('IFCLABEL', 'Office'))]))
+
+        contained = []
+
+        # Walls and floor slabs share layer set usages and material properties per build-up
+        for category, build_ups, direction, area_name in (('Wall', WALL_BUILD_UPS, 'AXIS2', 'NetSideArea'),
+                                                           ('Slab', SLAB_BUILD_UPS, 'AXIS3', 'NetArea')):
+            usages, psets, members = [], [], []
+            for number, build_up in enumerate(build_ups):
+                layers = [w.add('IFCMATERIALLAYER', w.add('IFCMATERIAL', name), thickness, None)
+                          for name, _, _, thickness in build_up]
+                layer_set = w.add('IFCMATERIALLAYERSET', layers, '%s Type %d' % (category, number))
+                usages.append(w.add('IFCMATERIALLAYERSETUSAGE', layer_set, Enumeration(direction),
+                                    Enumeration('POSITIVE'), 0.))
+                psets.append(material_properties(build_up, ['Component %d' % (i + 1) for i in range(len(build_up))]))
+                members.append([])
+            common = common_psets('Pset_%sCommon' % category)
+            external = {False: [], True: []}
+            for i in range(counts[category]):
+                element = w.add('IFC%s' % category.upper(), w.guid(), owner, '%s %d' % (category, i), None, None,
+                                None, None, None, *([Enumeration('FLOOR')] if category == 'Slab' else []))
+                build_up = rnd.randrange(len(build_ups))
+                members[build_up].append(element)
+                external[rnd.random() < 0.3].append(element)
+                relate('IFCRELDEFINESBYPROPERTIES', [element], element_quantity('BaseQuantities', [
+                    w.add('IFCQUANTITYAREA', area_name, None, None, round(rnd.uniform(2., 60.), 3)),
+                    w.add('IFCQUANTITYVOLUME', 'NetVolume', None, None, round(rnd.uniform(0.5, 12.), 3))]))
+                contained.append(element)
+            for build_up, elements in enumerate(members):
+                relate('IFCRELASSOCIATESMATERIAL', elements, usages[build_up])
+                relate('IFCRELDEFINESBYPROPERTIES', elements, psets[build_up])
+            for is_external, elements in external.items():
+                relate('IFCRELDEFINESBYPROPERTIES', elements, common[is_external])
+            if category == 'Slab':
+                floor_type = w.add('IFCSLABTYPE', w.guid(), owner, 'Floor', None, None, None, None, None, None,
+                                   Enumeration('FLOOR'))
+                relate('IFCRELDEFINESBYTYPE', [e for elements in members for e in elements], floor_type)
+
+        # Roofs are slabs of type ROOF with their layers in 'Component Quantities'
+        roof_type = w.add('IFCSLABTYPE', w.guid(), owner, 'Roof', None, None, None, None, None, None,
+                          Enumeration('ROOF'))
+        roof_psets = [material_properties(build_up, ['Component %d' % (i + 1) for i in range(len(build_up))])
+                      for build_up in ROOF_BUILD_UPS]
+        roof_members = [[] for _ in ROOF_BUILD_UPS]
+        roofs = []
+        for i in range(counts['Roof']):
+            element = w.add('IFCSLAB', w.guid(), owner, 'Roof %d' % i, None, None, None, None, None, Enumeration('ROOF'))
+            build_up = rnd.randrange(len(ROOF_BUILD_UPS))
+            roof_members[build_up].append(element)
+            roofs.append(element)
+            components = [w.add('IFCPHYSICALCOMPLEXQUANTITY', 'Component %d' % (j + 1), None, [
+                w.add('IFCQUANTITYLENGTH', 'Skin Thickness', None, None, thickness)], 'layer', None, None)
+                for j, (_, _, _, thickness) in enumerate(ROOF_BUILD_UPS[build_up])]
+            relate('IFCRELDEFINESBYPROPERTIES', [element], element_quantity('BaseQuantities', [
+                w.add('IFCQUANTITYAREA', 'NetArea', None, None, round(rnd.uniform(20., 200.), 3))]))
+            relate('IFCRELDEFINESBYPROPERTIES', [element], element_quantity('Component Quantities', components))
+            contained.append(element)
+        for build_up, elements in enumerate(roof_members):
+            relate('IFCRELDEFINESBYPROPERTIES', elements, roof_psets[build_up])
+        relate('IFCRELDEFINESBYPROPERTIES', roofs, common_psets('Pset_SlabCommon')[True])
+        relate('IFCRELDEFINESBYTYPE', roofs, roof_type)
+
+        # Doors, windows and stairs carry a single embodied carbon and density in EC_Pset_EmbodiedCarbon
+        for category, volume_name, external_share in (('Door', 'Volume', 0.3), ('Window', 'Volume', 0.),
+                                                      ('Stair', 'NetVolume', 0.)):
+            common = common_psets('Pset_%sCommon' % category)
+            carbon_psets = [property_set('EC_Pset_EmbodiedCarbon', [
+                single_value('EmbodiedCarbon', Typed('IFCREAL', round(rnd.uniform(0.3, 3.), 3))),
+                single_value('MassDensity', Typed('IFCREAL', round(rnd.uniform(500., 2500.), 1)))]) for _ in range(3)]
+            carbon_members = [[] for _ in carbon_psets]
+            external = {False: [], True: []}
+            for i in range(counts[category]):
+                element = w.add('IFC%s' % category.upper(), w.guid(), owner, '%s %d' % (category, i), None, None,
+                                None, None, None, *([None, None] if category != 'Stair' else [Enumeration('NOTDEFINED')]))
+                carbon_members[rnd.randrange(len(carbon_psets))].append(element)
+                external[rnd.random() < external_share].append(element)
+                relate('IFCRELDEFINESBYPROPERTIES', [element], element_quantity('BaseQuantities', [
+                    w.add('IFCQUANTITYVOLUME', volume_name, None, None, round(rnd.uniform(0.05, 2.), 3))]))
+                contained.append(element)
+            for number, elements in enumerate(carbon_members):
+                relate('IFCRELDEFINESBYPROPERTIES', elements, carbon_psets[number])
+            for is_external, elements in external.items():
+                relate('IFCRELDEFINESBYPROPERTIES', elements, common[is_external])
+
+        for start in range(0, len(contained), RELATED_OBJECTS_CHUNK):
+            w.add('IFCRELCONTAINEDINSPATIALSTRUCTURE', w.guid(), owner, None, None,
+                  contained[start:start + RELATED_OBJECTS_CHUNK], storey)
+        w.close()
+
+#
+# Benchmark
+#
+
+def run_stages(ifc_path, db_path, stream=False):
+    '''
+    Run the pycab pipeline on one file with the profiler enabled.
+
+    :returns:
+        dict;
+        The :meth:`pycab.Profiler.summary` of the run with the
+        ``Total`` wall-clock time.
+
+    '''
+    pycab.profiler.enable()
+    start = time.perf_counter()
+    material_db = pycab.load_material_db(db_path)
+    pycab.evaluate_ifc_file(ifc_path, material_db, stream=stream)
+    total = time.perf_counter() - start
+    summary = pycab.profiler.summary()
+    summary['Total'] = total
+    return summary
+
+
+def run_benchmark(element_count, workdir, db_path, mix=None, stream=False, keep_reports=False):
+    # Generate a model and benchmark it in a fresh interpreter, so peak memory is not shared between sizes
+    counts = get_element_counts(element_count, mix)
+    ifc_path = get_model_path(workdir, element_count, counts)
+    start = time.perf_counter()
+    if not os.path.exists(ifc_path):
+        generate_ifc(ifc_path, counts)
+    generate_time = time.perf_counter() - start
+
+    command = [sys.executable, os.path.abspath(__file__), '--run-single', os.path.abspath(ifc_path),
+               '--dbfile', os.path.abspath(db_path)] + (['--stream'] if stream else [])
+    # Reports are written to the current directory if they are kept, and otherwise to a temporary one
+    with (contextlib.nullcontext(os.getcwd()) if keep_reports else tempfile.TemporaryDirectory()) as cwd:
+        result = json.loads(shell_call(command, cwd=cwd).decode().splitlines()[-1])
+    result.update({
+        'Elements': element_count,
+        'Counts': counts,
+        'FileSize': os.path.getsize(ifc_path),
+        'Generate': generate_time,
+        'Stream': stream,
+        'GitID': pycab.get_git_id()
+    })
+    return result
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark pycab on synthetic IFC files.')
+    parser.add_argument('-s','--sizes', action='store', nargs='+', type=int, required=False, help='the numbers of elements of the synthetic models', default=[1000, 10000, 100000], metavar="ELEMENTS")
+    parser.add_argument('-m','--mix', action='store', type=str, required=False, help='the share of each element type, e.g. Wall=0.5,Slab=0.1,Roof=0.1,Door=0.1,Window=0.1,Stair=0.1', metavar="MIX")
+    parser.add_argument('-d','--dbfile', action='store', type=str, required=False, help='the material database file', default='EC_MaterialsDB.csv', metavar="DATABASE_FILE")
+    parser.add_argument('-w','--workdir', action='store', type=str, required=False, help='the directory of the synthetic IFC files, kept between runs (default: a temporary directory)', metavar="WORKDIR")
+    parser.add_argument('-o','--output', action='store', type=str, required=False, help='append the results as JSON lines to this file', metavar="OUTPUT_FILE")
+    parser.add_argument('--stream', action='store_true', help='read the models with the streaming reader')
+    parser.add_argument('--generate-only', action='store_true', help='only generate the synthetic IFC files')
+    parser.add_argument('--keep-reports', action='store_true', help='keep the generated reports, in the current directory')
+    parser.add_argument('--run-single', action='store', type=str, required=False, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_single:
+        with contextlib.redirect_stdout(sys.stderr):
+            summary = run_stages(args.run_single, args.dbfile, args.stream)
+        print(json.dumps(summary))
+        sys.exit(0)
+
+    mix = None
+    if args.mix:
+        mix = {name: float(share) for name, share in (item.split('=') for item in args.mix.split(','))}
+        mix = {name: mix.get(name, 0.) for name in DEFAULT_MIX}
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='pycab_benchmark_')
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        for element_count in args.sizes:
+            if args.generate_only:
+                counts = get_element_counts(element_count, mix)
+                ifc_path = get_model_path(workdir, element_count, counts)
+                generate_ifc(ifc_path, counts)
+                print(ifc_path)
+                continue
+            result = run_benchmark(element_count, workdir, args.dbfile, mix, args.stream, args.keep_reports)
+            print('%8d elements: %8.2f s, %8.1f MB peak' % (element_count, result['Total'], result['PeakMemory']),
+                  file=sys.stderr)
+            print(json.dumps(result))
+            if args.output:
+                with open(args.output, 'a') as f:
+                    f.write(json.dumps(result) + '\n')
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
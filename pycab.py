@@ -1,77 +1,137 @@
 #!/usr/bin/env python3
 import os
+import sys
 import shutil
 import datetime
+import time
+import heapq
+import hashlib
+import json
+import re
 import argparse
+import array
+import contextlib
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from subprocess import check_output as shell_call, CalledProcessError, STDOUT
 
-import pandas as pd
 import numpy as np
-import markdown
-import matplotlib.pyplot as plt
-import ifcopenshell
-#import ifcopenshell.geom
+# pandas, markdown, matplotlib and ifcopenshell are imported where they are used,
+# so runs that skip the report (or the model, on a cache hit) do not pay for them
 #import ifcopenshell.util.pset
 
 #
 # Plotting
 #
 
-def plot_barchart(filename, names, values, yaxis, values2 = None):
+# Charts are drawn on standalone Figures, which pyplot does not keep alive, so memory stays flat over many reports.
+# 'inline' returns the SVG markup instead of writing a file.
+CHART_FORMATS = ('svg', 'png', 'inline')
+
+
+def new_figure(figsize):
+    # Pin the non-interactive Agg backend in case anything imports pyplot later
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=figsize, constrained_layout=True)
+    return fig, fig.add_subplot()
+
+
+def save_figure(fig, filename, chart_format='svg'):
+    # Save a figure as filename.svg / filename.png, or return its inline SVG markup, and release it
+    try:
+        if chart_format == 'inline':
+            import io
+            svg = io.StringIO()
+            fig.savefig(svg, format='svg')
+            # Drop the XML declaration and doctype so the markup can be embedded in HTML
+            return svg.getvalue()[svg.getvalue().index('<svg'):]
+        fig.savefig(filename + '.' + chart_format)
+    finally:
+        fig.clear()
+
+
+def plot_barchart(filename, names, values, yaxis, values2 = None, chart_format='svg'):
     # Plot
     #sns.set()
     #sns.set_palette('pastel')
 
-    fig, ax = plt.subplots(figsize=(7.5, 6),  constrained_layout=True)
+    fig, ax = new_figure(figsize=(7.5, 6))
 
-    plt.ylabel(yaxis)
-    plt.xticks(rotation=90)
+    ax.set_ylabel(yaxis)
+    ax.tick_params(axis='x', labelrotation=90)
     # plt.xlabel
-    plt.bar(names, values, color='#4C7998', label='Current', edgecolor='#4C7998')
+    ax.bar(names, values, color='#4C7998', label='Current', edgecolor='#4C7998')
     if values2:
-        plt.bar(names, values2, color='#C5E0B4', label='Potential', edgecolor='#4C7998')
+        ax.bar(names, values2, color='#C5E0B4', label='Potential', edgecolor='#4C7998')
 
     ax.text(0.95, 0.95, 'pycab', ha='center', va='center', transform=ax.transAxes, font='Andale Mono', fontsize=12, color='grey')
-    plt.legend(loc='upper right', bbox_to_anchor=(1., 0.9))
+    ax.legend(loc='upper right', bbox_to_anchor=(1., 0.9))
 
     #fig.tight_layout()
     # Hide the right and top spines
     ax.spines['right'].set_visible(False)
     ax.spines['top'].set_visible(False)
 
-    plt.savefig(filename + '.svg')
+    return save_figure(fig, filename, chart_format)
 
 
-def plot_benchmark(filename, benchmark_value, suggested_benchmark_value):
-    #Plot
-    names = ['Current (Max)','','','Current (Avg)','','','Current (Min)','2030 (Max)','','2030 (Avg)','','2030 (Min)']
-    vals = [367.50, 338.10, 289.80, 275.10, 231.00, 215.25, 210.00, 178.50, 157.50, 110.25, 63.00, 42.00]
+# RIBA 2030 Climate Challenge benchmarks (kgCO₂/m²), plotted unless there is a portfolio to compare with
+RIBA_BENCHMARK_NAMES = ['Current (Max)','','','Current (Avg)','','','Current (Min)','2030 (Max)','','2030 (Avg)','','2030 (Min)']
+RIBA_BENCHMARK_VALUES = [367.50, 338.10, 289.80, 275.10, 231.00, 215.25, 210.00, 178.50, 157.50, 110.25, 63.00, 42.00]
 
-    # Choose some nice levels
-    levels = [-3, -2, -2, -3, -2, -2, -3, 3, 2, 3, 2, 3]
-    colors = ['#F8CBAD','#F8CBAD','#F8CBAD','#F8CBAD','#F8CBAD','#F8CBAD','#F8CBAD',
-              '#93DBDB','#93DBDB','#93DBDB','#93DBDB','#93DBDB']
+
+def plot_benchmark(filename, benchmark_value, suggested_benchmark_value, chart_format='svg', portfolio=None):
+    '''
+    Plot the building embodied carbon per m² and its potential against
+    the RIBA 2030 benchmarks, or against the percentiles of a portfolio.
+
+    :param portfolio:
+        dict;
+        The comparison of :meth:`PortfolioStore.compare`, None to plot
+        the RIBA benchmarks.
+
+    '''
+    #Plot
+    if portfolio is None:
+        names = RIBA_BENCHMARK_NAMES
+        vals = RIBA_BENCHMARK_VALUES
+        # Choose some nice levels
+        levels = [-3, -2, -2, -3, -2, -2, -3, 3, 2, 3, 2, 3]
+        colors = ['#F8CBAD','#F8CBAD','#F8CBAD','#F8CBAD','#F8CBAD','#F8CBAD','#F8CBAD',
+                  '#93DBDB','#93DBDB','#93DBDB','#93DBDB','#93DBDB']
+    else:
+        percentiles = sorted(portfolio['Percentiles'].items(), reverse=True)
+        names = ['Portfolio P%d' % percentile for percentile, _ in percentiles]
+        vals = [value for _, value in percentiles]
+        levels = [-3 if i % 2 == 0 else 3 for i in range(len(percentiles))]
+        colors = ['#F8CBAD' if percentile >= 50 else '#93DBDB' for percentile, _ in percentiles]
 
     # Create figure and plot a stem plot with the date
-    fig, ax = plt.subplots(figsize=(7.5, 4), constrained_layout=True)
+    fig, ax = new_figure(figsize=(7.5, 4))
 
     ax.invert_xaxis()
     ax.vlines(vals, 0, levels, colors=colors)  # The vertical stems.
     ax.plot(vals, np.zeros_like(vals), "-o", color="k", markerfacecolor="w")  # Baseline and markers on it.
 
-    ax.plot(benchmark_value, np.zeros_like(benchmark_value), "o", color="black", markerfacecolor="w", markersize=10, fillstyle='full')
-    ax.plot(benchmark_value, np.zeros_like(benchmark_value), "o", color="#4C7998", markerfacecolor="#4C7998", markersize=5, fillstyle='full')
-    ax.vlines(benchmark_value, 0, [2], colors='#4C7998')
-
-    ax.plot(suggested_benchmark_value, np.zeros_like(suggested_benchmark_value), "o", color="black", markerfacecolor="w", markersize=10, fillstyle='full')
-    ax.plot(suggested_benchmark_value, np.zeros_like(suggested_benchmark_value), "o", color="#9BCA7E", markerfacecolor="#9BCA7E", markersize=5, fillstyle='full')
-    ax.vlines(suggested_benchmark_value, 0, [-2], colors='#9BCA7E')
+    # The building is only placed if it has an internal area, EC/m² is nan otherwise
+    building_values, building_levels, building_names = [], [], []
+    for value, level, color, name in ((benchmark_value, 2, '#4C7998', 'Current Building EC'),
+                                      (suggested_benchmark_value, -2, '#9BCA7E', 'Potential Building EC')):
+        if not np.isfinite(value):
+            continue
+        ax.plot(value, 0, "o", color="black", markerfacecolor="w", markersize=10, fillstyle='full')
+        ax.plot(value, 0, "o", color=color, markerfacecolor=color, markersize=5, fillstyle='full')
+        ax.vlines(value, 0, [level], colors=color)
+        building_values.append(value)
+        building_levels.append(level)
+        building_names.append(name + ' (' + str(round(value)) + ')')
+    if not building_values:
+        ax.text(0.75, 0.25, 'Building EC/m² not available\n(no internal floor area)', ha='center', va='center',
+                transform=ax.transAxes, color='grey')
 
     # annotate lines
-    for d, l, r in zip(vals+[benchmark_value, suggested_benchmark_value], levels + [2, -2], names + [
-        'Current Building EC (' + str(round(benchmark_value)) + ')',
-        'Potential Building EC (' + str(round(suggested_benchmark_value)) + ')'
-    ]):
+    for d, l, r in zip(vals + building_values, levels + building_levels, names + building_names):
         ax.annotate(r, xy=(d, l),
                     xytext=(-3, np.sign(l) * 3), textcoords="offset points",
                     horizontalalignment="right",
@@ -80,9 +140,11 @@ def plot_benchmark(filename, benchmark_value, suggested_benchmark_value):
     # format xaxis with 4 month intervals
     #ax.xaxis.set_major_locator(mdates.MonthLocator(interval=4))
     #ax.xaxis.set_major_formatter(mdates.DateFormatter("%b %Y"))
-    plt.setp(ax.get_xticklabels(), rotation=30, ha="right")
+    ax.tick_params(axis='x', labelrotation=30)
+    for label in ax.get_xticklabels():
+        label.set_horizontalalignment('right')
     ax.text(0.95, 0.05, 'pycab', ha='center', va='center', transform=ax.transAxes, font='Andale Mono', fontsize=12, color='grey')
-    plt.xlabel('Embodied Carbon (kgCO₂/m²)')
+    ax.set_xlabel('Embodied Carbon (kgCO₂/m²)')
 
     # remove y axis and spines
     ax.yaxis.set_visible(False)
@@ -90,7 +152,91 @@ def plot_benchmark(filename, benchmark_value, suggested_benchmark_value):
 
     ax.margins(y=0.1)
     #plt.show()
-    plt.savefig(filename + '.svg')
+    return save_figure(fig, filename, chart_format)
+
+
+def plot_uncertainty(filename, counts, edges, percentiles, benchmark_value, chart_format='svg'):
+    # Histogram of binned samples, see np.histogram
+    fig, ax = new_figure(figsize=(7.5, 4))
+    ax.stairs(counts / max(counts.sum(), 1), edges, fill=True, color='#C5E0B4', edgecolor='#4C7998')
+    for percentile, value in percentiles.items():
+        ax.axvline(value, color='grey', linestyle='--', linewidth=1)
+        ax.annotate('P%d' % percentile, xy=(value, 1), xycoords=('data', 'axes fraction'),
+                    xytext=(3, -12), textcoords='offset points', color='grey')
+    if np.isfinite(benchmark_value):
+        ax.axvline(benchmark_value, color='#4C7998', linewidth=2, label='Current Building EC (' + str(round(benchmark_value)) + ')')
+        ax.legend(loc='upper left')
+    else:
+        ax.text(0.5, 0.5, 'Building EC/m² not available (no internal floor area)', ha='center', va='center',
+                transform=ax.transAxes, color='grey')
+
+    ax.text(0.95, 0.95, 'pycab', ha='center', va='center', transform=ax.transAxes, font='Andale Mono', fontsize=12, color='grey')
+    ax.set_xlabel('Embodied Carbon (kgCO₂/m²)')
+    ax.set_ylabel('Share of Samples')
+    ax.spines[["top", "right"]].set_visible(False)
+    return save_figure(fig, filename, chart_format)
+
+
+def plot_whole_life(filename, cumulative, potential_cumulative, chart_format='svg'):
+    # Cumulative carbon by year of the analysis period, replacements show as steps
+    fig, ax = new_figure(figsize=(7.5, 4))
+    years = np.arange(len(cumulative))
+    ax.step(years, cumulative, where='post', color='#4C7998', linewidth=2, label='Current')
+    ax.step(years, potential_cumulative, where='post', color='#9BCA7E', linewidth=2, label='Potential')
+
+    ax.text(0.95, 0.05, 'pycab', ha='center', va='center', transform=ax.transAxes, font='Andale Mono', fontsize=12, color='grey')
+    ax.set_xlabel('Year')
+    ax.set_ylabel('Cumulative Embodied Carbon (kgCO₂)')
+    ax.set_xlim(0, len(cumulative) - 1)
+    ax.set_ylim(bottom=0)
+    ax.legend(loc='upper left')
+    ax.spines[["top", "right"]].set_visible(False)
+    return save_figure(fig, filename, chart_format)
+
+
+# Process pool rendering charts, kept for the life of the process so batches pay its start up once
+render_pool = {}
+
+
+def render_charts(charts, jobs=1):
+    '''
+    Render charts, concurrently in a pool of `jobs` processes.
+
+    :param charts:
+        list;
+        ``(plot function, arguments)`` of every chart.
+
+    :returns:
+        list;
+        The return value of every plot function, the SVG markup of
+        inline charts.
+
+    '''
+    if jobs <= 1 or len(charts) <= 1:
+        return [plot(*arguments) for plot, arguments in charts]
+    futures = [get_render_pool(jobs).submit(plot, *arguments) for plot, arguments in charts]
+    return [future.result() for future in futures]
+
+
+def get_render_pool(jobs):
+    # The render pool of `jobs` processes, replacing one of another size
+    if render_pool.get('jobs') != jobs:
+        if 'pool' in render_pool:
+            render_pool['pool'].shutdown()
+        render_pool['pool'] = ProcessPoolExecutor(max_workers=jobs)
+        render_pool['jobs'] = jobs
+    return render_pool['pool']
+
+
+def load_renderer(jobs=1):
+    # Import matplotlib and set up the report builder ahead of the first report, in the render pool workers as well
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    import matplotlib.figure
+    get_report_builder()
+    if jobs > 1:
+        pool = get_render_pool(jobs)
+        for future in [pool.submit(load_renderer) for _ in range(jobs)]:
+            future.result()
 
 #
 # Misc
@@ -112,6 +258,167 @@ def get_git_id():
 def zip_sort(*args):
     return zip(*sorted(zip(*args), reverse=True, key= lambda t: t[-1]))
 
+#
+# Profiling
+#
+
+# Stage context of a disabled profiler
+NULL_STAGE = contextlib.nullcontext()
+
+
+def get_peak_memory():
+    # Peak resident set size of this process in MB, None where the resource module is not available
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024. ** 2 if sys.platform == 'darwin' else peak / 1024.
+
+
+class Profiler:
+    '''
+    Wall-clock and CPU timers per stage, counters, peak memory and
+    the slowest elements of a run.
+
+    The module level :data:`profiler` is disabled by default, in which
+    case :meth:`stage` returns a shared null context and the counters
+    return immediately. Stages may nest, the time of a stage includes
+    its nested stages. Stages may also run in threads, each thread is
+    a row of the trace. In parallel extraction, elements are timed
+    inside the workers and are not recorded.
+
+    Example::
+
+        profiler.enable()
+        evaluate_ifc_file('model.ifc', material_db)
+        print(profiler.format_summary())
+        profiler.write_trace('trace.json')
+
+    :param slowest_count:
+        int;
+        The number of slowest elements kept.
+
+    '''
+
+    def __init__(self, slowest_count=10):
+        self.enabled = False
+        self.slowest_count = slowest_count
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        # stage name -> [wall time, CPU time, calls]
+        self.stages = {}
+        self.counters = {}
+        # min-heap of (seconds, section, GlobalId, Name) of the slowest elements
+        self.slowest = []
+        # Chrome trace events
+        self.events = []
+        self.origin = time.perf_counter()
+
+    def enable(self, slowest_count=None):
+        if slowest_count is not None:
+            self.slowest_count = slowest_count
+        self.reset()
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def stage(self, name):
+        # Context timing a stage of the run
+        if not self.enabled:
+            return NULL_STAGE
+        return self.timed_stage(name)
+
+    @contextlib.contextmanager
+    def timed_stage(self, name):
+        start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - start, time.process_time() - cpu_start
+            with self.lock:
+                totals = self.stages.setdefault(name, [0., 0., 0])
+                totals[0] += wall
+                totals[1] += cpu
+                totals[2] += 1
+                self.events.append({'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_native_id(),
+                                    'ts': (start - self.origin) * 1e6, 'dur': wall * 1e6})
+
+    def count(self, name, value=1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_element(self, seconds, section, element):
+        # Keep the slowest_count slowest elements
+        entry = (seconds, section, element.GlobalId, str(element.Name))
+        if len(self.slowest) < self.slowest_count:
+            heapq.heappush(self.slowest, entry)
+        elif entry > self.slowest[0]:
+            heapq.heapreplace(self.slowest, entry)
+
+    def hit_rates(self):
+        # Hit rate of every cache counted as '<Name>Hits' and '<Name>Misses'
+        hit_rates = {}
+        for name in self.counters:
+            if name.endswith('Hits') or name.endswith('Misses'):
+                cache = name[:-4] if name.endswith('Hits') else name[:-6]
+                hits, misses = self.counters.get(cache + 'Hits', 0), self.counters.get(cache + 'Misses', 0)
+                hit_rates[cache] = hits / (hits + misses)
+        return hit_rates
+
+    def summary(self):
+        '''
+        :returns:
+            dict;
+            The ``Stages`` with their ``Wall`` and ``CPU`` seconds and
+            ``Calls``, the ``Counters``, the ``HitRates`` of the caches,
+            the ``PeakMemory`` in MB and the ``SlowestElements``,
+            slowest first.
+
+        '''
+        return {
+            'Stages': {name: {'Wall': wall, 'CPU': cpu, 'Calls': calls}
+                       for name, (wall, cpu, calls) in self.stages.items()},
+            'Counters': dict(self.counters),
+            'HitRates': self.hit_rates(),
+            'PeakMemory': get_peak_memory(),
+            'SlowestElements': [{'Seconds': seconds, 'Section': section, 'GlobalId': global_id, 'Name': name}
+                                for seconds, section, global_id, name in sorted(self.slowest, reverse=True)]
+        }
+
+    def format_summary(self):
+        # Plain text tables of the summary
+        summary = self.summary()
+        lines = ['%-28s %10s %10s %8s' % ('Stage', 'Wall (s)', 'CPU (s)', 'Calls')]
+        for name, stage in summary['Stages'].items():
+            lines.append('%-28s %10.3f %10.3f %8d' % (name, stage['Wall'], stage['CPU'], stage['Calls']))
+        lines.append('')
+        for name, value in summary['Counters'].items():
+            lines.append('%-28s %10d' % (name, value))
+        for name, hit_rate in summary['HitRates'].items():
+            lines.append('%-28s %9.1f%%' % (name + ' Hit Rate', 100. * hit_rate))
+        if summary['PeakMemory'] is not None:
+            lines.append('%-28s %10.1f' % ('Peak Memory (MB)', summary['PeakMemory']))
+        if summary['SlowestElements']:
+            lines.append('')
+            lines.append('Slowest Elements')
+            for element in summary['SlowestElements']:
+                lines.append('%10.4f s  %-18s %s %s' % (element['Seconds'], element['Section'], element['GlobalId'],
+                                                     element['Name']))
+        return '\n'.join(lines)
+
+    def write_trace(self, filename):
+        # Write the stages in the Chrome trace event format (chrome://tracing, Perfetto)
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+
+
+profiler = Profiler()
+
 #
 # Report Generation
 #
@@ -158,14 +465,7 @@ def parse_template_file(src, dest, replacements={}):
         dest_file.write(string)
 
 
-def generate_report(ifc_filename, replacement_dict):
-
-    # Generate markdown
-    parse_template_file('report_template.md',os.path.join('reports',ifc_filename,'report.md'),replacement_dict)
-    shutil.copy('markdown.css',os.path.join('reports',ifc_filename,'markdown.css'))
-
-    # Generate HTML
-    html_template = """<!DOCTYPE html>
+HTML_TEMPLATE = """<!DOCTYPE html>
     <html>
     <head>
         <meta http-equiv="Content-Type" content="text/html; charset=utf-8">
@@ -193,539 +493,4611 @@ def generate_report(ifc_filename, replacement_dict):
     </body>
     </html>
     """
-    with open(os.path.join('reports',ifc_filename,'report.md')) as f:
-        html = markdown.markdown(
-            f.read(),
-            extensions = ['extra', 'smarty'],
-            output_format='html5'
-        )
-    html = html_template.replace('{{content}}', html)
-    with open(os.path.join('reports',ifc_filename,'report.html'), 'w') as f:
-        f.write(html)
 
-#
-# Parsing
-#
 
-def parse_ec_code(ec_code):
-    ec, ec_class, ec_id = ec_code.split('-')
-    assert ec == 'EC'
-    return (ec_class, ec_id)
+def link_asset(src, dest):
+    # Hard link a shared asset into a report, copying where links are not supported (e.g. across devices)
+    try:
+        if os.path.exists(dest):
+            if os.path.samefile(src, dest):
+                return
+            os.remove(dest)
+        os.link(src, dest)
+    except OSError:
+        shutil.copy(src, dest)
 
 
-def dump(element):
-    print('---------- begin dump ----------')
-    for definition in element.IsDefinedBy:
-        print('D  ', definition)
-        if definition.is_a('IfcRelDefinesByProperties'):
-            print('    ', definition.RelatingPropertyDefinition.Name)
-            if definition.RelatingPropertyDefinition.is_a('IfcPropertySet'):
-                for sub_definition in definition.RelatingPropertyDefinition.HasProperties:
-                    print('     ', sub_definition.Name)
-        print(definition)
+class ReportBuilder:
+    '''
+    Build markdown and HTML reports in memory.
 
-    for assoc in element.HasAssociations:
-        print('A  ', assoc)
-    print('---------- end dump ----------')
+    The template is read, the markdown converter is set up and the
+    HTML wrapper is split once, so a builder can be reused for every
+    report of a batch. Each report is written with a single write per
+    file and ``markdown.css`` is hard linked instead of copied.
 
+    :param template_path:
+        str;
+        The path to the markdown template, ``report_template.md``
+        next to this script by default.
 
-def get_quantities(element_quantity):
-    quantities = {}
-    for quantity in element_quantity.Quantities:
-        if quantity.is_a('IfcQuantityLength'):
-            quantities[quantity.Name] = quantity.LengthValue
-        elif quantity.is_a('IfcQuantityArea'):
-            quantities[quantity.Name] = quantity.AreaValue
-        elif quantity.is_a('IfcQuantityVolume'):
-            quantities[quantity.Name] = quantity.VolumeValue
-    return quantities
+    :param css_path:
+        str;
+        The path to the stylesheet shared by the reports,
+        ``markdown.css`` next to this script by default.
 
+    '''
 
-def get_extent(element):
-    # Return dictionary of quantities for BaseQuantities
-    for definition in element.IsDefinedBy:
-        if definition.is_a('IfcRelDefinesByProperties'):
-            related_data = definition.RelatingPropertyDefinition
-            if related_data.is_a('IfcElementQuantity'):
-                if related_data.Name == 'BaseQuantities':
-                    return get_quantities(related_data)
+    def __init__(self, template_path=None, css_path=None):
+        import markdown
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        template_path = template_path or os.path.join(script_dir, 'report_template.md')
+        css_path = css_path or os.path.join(script_dir, 'markdown.css')
+        with open(template_path, 'r') as f:
+            self.template = f.read()
+        self.css_path = css_path
+        self.converter = markdown.Markdown(extensions=['extra', 'smarty'], output_format='html5')
+        self.html_prefix, self.html_suffix = HTML_TEMPLATE.split('{{content}}')
 
+    def render(self, replacement_dict):
+        # Return the markdown and HTML of a report
+        report = self.template % replacement_dict
+        return report, self.convert(report)
 
-def get_element_properties(element):
-    # Build dictionary of 'Embodied Carbon' and 'MassDensity'
-    property_data = {'IsExternal': False}
-    embodied_carbon = False
-    mass_density = False
-    for definition in element.IsDefinedBy:
-        if definition.is_a('IfcRelDefinesByProperties'):
-            related_data = definition.RelatingPropertyDefinition
-            if related_data.is_a('IfcPropertySet'):
-                if related_data.Name in ('Pset_DoorCommon', 'Pset_WindowCommon', 'Pset_StairCommon'):
-                    for prop in related_data.HasProperties:
-                        if prop.Name == 'IsExternal':
-                            property_data['IsExternal'] = True if prop.NominalValue.wrappedValue is True else False
-                if related_data.Name == 'EC_Pset_EmbodiedCarbon':
-                    for prop in related_data.HasProperties:
-                        # print(property)
-                        if prop.Name == 'EmbodiedCarbon':
-                            embodied_carbon = prop.NominalValue.wrappedValue
-                        elif prop.Name == 'MassDensity':
-                            mass_density = prop.NominalValue.wrappedValue
-    if embodied_carbon and mass_density:
-        property_data['Element'] = {
-            'EmbodiedCarbon': embodied_carbon,
-            'MassDensity': mass_density
-        }
-    return property_data
+    def convert(self, report):
+        # HTML page of the markdown of a report
+        with profiler.stage('Markdown'):
+            html = self.converter.reset().convert(report)
+        return self.html_prefix + html + self.html_suffix
 
+    def build(self, report_dir, replacement_dict):
+        # Write report.md, report.html and markdown.css to report_dir
+        report, html = self.render(replacement_dict)
+        self.write_markdown(report_dir, report)
+        self.write_html(report_dir, html)
 
-def get_material_properties(element):
-    # Build dictionary of 'Embodied Carbon' and 'MassDensity'
-    property_data = {'IsExternal': False}
-    for definition in element.IsDefinedBy:
-        if definition.is_a('IfcRelDefinesByProperties'):
-            related_data = definition.RelatingPropertyDefinition
-            if related_data.is_a('IfcPropertySet'):
-                if related_data.Name in ('Pset_WallCommon', 'Pset_SlabCommon'):
-                    for prop in related_data.HasProperties:
-                        if prop.Name == 'IsExternal':
-                            property_data['IsExternal'] = True if prop.NominalValue.wrappedValue is True else False
-                if related_data.Name == 'Material Properties':
-                    for property in related_data.HasProperties:
-                        # print(property.Name)
-                        for sub_property in property.HasProperties:
-                            # print('here',sub_property.Name)
-                            sub_property_name = sub_property.Name
-                            # print(sub_property_name)
-                            for sub_sub_property in sub_property.HasProperties:
-                                if sub_sub_property.Name == 'Embodied Carbon':
-                                    embodied_carbon = sub_sub_property.NominalValue.wrappedValue
-                                    if embodied_carbon.endswith(' (kgCO₂/kg)'):
-                                        embodied_carbon = float(embodied_carbon[:-11])
-                                elif sub_sub_property.Name == 'MassDensity':
-                                    mass_density = sub_sub_property.NominalValue.wrappedValue
-                            if embodied_carbon and mass_density:
-                                property_data[sub_property_name] = {
-                                    'EmbodiedCarbon': embodied_carbon,
-                                    'MassDensity': mass_density
-                                }
-    return property_data
+    def write_markdown(self, report_dir, report):
+        with open(os.path.join(report_dir, 'report.md'), 'w') as f:
+            f.write(report)
 
+    def write_html(self, report_dir, html):
+        with open(os.path.join(report_dir, 'report.html'), 'w') as f:
+            f.write(html)
+        link_asset(self.css_path, os.path.join(report_dir, 'markdown.css'))
 
-def get_material_names(element):
-    # Build dictionary of names e.g. 'Component 1' = 'Slate Shingle, Roof'
-    names_data = {}
-    for definition in element.IsDefinedBy:
-        if definition.is_a('IfcRelDefinesByProperties'):
-            related_data = definition.RelatingPropertyDefinition
-            if related_data.is_a('IfcPropertySet'):
-                if related_data.Name == 'Material Properties':
-                    for prop in related_data.HasProperties:
-                        component_name = prop.Name
-                        for sub_property in prop.HasProperties:
-                            names_data[component_name] = sub_property.Name
-    return names_data
 
+# Report builders of this process, keyed by template and stylesheet
+report_builders = {}
 
-def get_element_type(element):
-    for definition in element.IsDefinedBy:
-        if definition.is_a('IfcRelDefinesByType'):
-            if definition.RelatingType.is_a('IfcSlabType'):
-                return definition.RelatingType.PredefinedType
-
-
-def yield_material_layers(element, material_names={}):
-    element_type = get_element_type(element)
-
-    if element_type == 'ROOF':
-        for definition in element.IsDefinedBy:
-            if definition.is_a('IfcRelDefinesByProperties'):
-                related_data = definition.RelatingPropertyDefinition
-                if related_data.is_a('IfcElementQuantity'):
-                    if related_data.Name == 'Component Quantities':
-                        for quantity in related_data.Quantities:
-                            # print(quantity.Name)
-                            for sub_quantity in quantity.HasQuantities:
-                                if sub_quantity.is_a('IfcQuantityLength'):
-                                    if sub_quantity.Name == 'Skin Thickness':
-                                        material_layer_thickness = sub_quantity.LengthValue
-                            yield {'Name': quantity.Name, 'LayerThickness': material_layer_thickness}
-    else:
-        for assoc in element.HasAssociations:
-            if assoc.is_a('IfcRelAssociatesMaterial'):
-                if assoc.RelatingMaterial.is_a('IfcMaterialLayerSetUsage'):
-                    # print('  ', assoc.RelatingMaterial.ForLayerSet.LayerSetName)
-                    for material_layer in assoc.RelatingMaterial.ForLayerSet.MaterialLayers:
-                        yield {'Name': material_layer.Material.Name, 'LayerThickness': material_layer.LayerThickness}
 
+def get_report_builder(template_path=None, css_path=None):
+    key = (template_path, css_path)
+    if key not in report_builders:
+        report_builders[key] = ReportBuilder(template_path, css_path)
+    return report_builders[key]
 
-def get_building_properties(building):
-    building_properties = {}
-    for definition in building.IsDefinedBy:
-        if definition.is_a('IfcRelDefinesByProperties'):
-            related_data = definition.RelatingPropertyDefinition
-            if related_data.is_a('IfcPropertySet'):
-                if related_data.Name == 'Pset_BuildingCommon':
-                    for prop in related_data.HasProperties:
-                        building_properties[prop.Name] = str(prop.NominalValue.wrappedValue)
-    return building_properties
 
+def generate_report(ifc_filename, replacement_dict):
+    get_report_builder().build(os.path.join('reports', ifc_filename), replacement_dict)
 
-if __name__ == '__main__':
+#
+# Material Matching
+#
 
-    parser = argparse.ArgumentParser(description='A python tool for calculating the embodied carbon of IFC files.')
-    parser.add_argument('-i','--ifcfile', action='store', type=str, required=True, help='the IFC file to process', metavar="IFC_FILE")
-    parser.add_argument('-d','--dbfile', action='store', type=str, required=False, help='the material database file', default='EC_MaterialsDB.csv', metavar="DATABASE_FILE")
-    args = parser.parse_args()
+# Number of candidates suggested for a material, and the minimum confidence of a candidate
+MATCH_CANDIDATES = 3
+MATCH_MIN_CONFIDENCE = 0.3
+# Number of rows from which a trigram is too common to find candidates with
+MATCH_COMMON_ROWS = 1000
+# Number of candidates scored per query, those sharing the most rarer trigrams with it
+MATCH_SCORED_ROWS = 500
+# Weight of the share of the trigrams of a name found in a description, against the similarity of names
+DESCRIPTION_WEIGHT = 0.8
+NON_WORD = re.compile(r'[\W_]+')
+ALIAS_COLUMNS = ('Material', 'DatabaseName', 'Confidence', 'Confirmed')
+CONFIRMED_VALUES = ('yes', 'y', 'true', '1', 'x')
 
-    ifc_filename, _ = os.path.splitext(os.path.basename(args.ifcfile))
 
-    # Generate report directory
-    os.makedirs(os.path.join('reports',ifc_filename), exist_ok=True)
+def get_text_grams(texts):
+    '''
+    Find the distinct character trigrams of the lower case words of
+    texts, with words padded by spaces to match their start and end.
+    Trigrams are coded by their three UTF-8 bytes, so codes are stable
+    across processes and stored in compiled databases.
 
-    # Parse file
-    ifc_file = ifcopenshell.open(args.ifcfile)
+    :returns:
+        tuple;
+        The row positions and codes of the trigrams, sorted by row.
+
+    '''
+    # Words separated by two spaces, so no trigram has a space in the middle
+    text = '\n'.join(' %s ' % NON_WORD.sub('  ', text.lower()) if isinstance(text, str) else '' for text in texts)
+    buffer = np.frombuffer(text.encode(), dtype=np.uint8).astype(np.int64)
+    rows = np.cumsum(buffer == ord('\n'))[:-2]
+    codes = buffer[:-2] << 16 | buffer[1:-1] << 8 | buffer[2:]
+    valid = (buffer[1:-1] != ord(' ')) & (buffer[:-2] != ord('\n')) & (buffer[1:-1] != ord('\n')) & (buffer[2:] != ord('\n'))
+    pairs = np.sort(rows[valid] << 24 | codes[valid])
+    pairs = pairs[np.diff(pairs, prepend=-1) != 0]
+    return pairs >> 24, pairs & 0xFFFFFF
 
-    area_type_dictionary = {
-        'Wall': 'NetSideArea',
-        'Slab': 'NetArea'
-    }
 
-    element_counts = {
-        'Wall': {'Number': 0, 'Carbon': 0},
-        'Slab': {'Number': 0, 'Carbon': 0},
-        'Roof': {'Number': 0, 'Carbon': 0},
-        'Door': {'Number': 0, 'Carbon': 0},
-        'Window': {'Number': 0, 'Carbon': 0},
-        'Stair': {'Number': 0, 'Carbon': 0}
+def build_inverted_index(name, texts):
+    '''
+    Index the trigrams of texts both ways: the sorted trigram codes
+    (``keys``), the start of their rows (``starts``) and the rows
+    (``postings``), and the start of the trigrams of each row
+    (``rows``) and their positions in ``keys`` (``grams``).
+
+    '''
+    rows, codes = get_text_grams(texts)
+    order = np.argsort(codes, kind='stable')
+    sorted_codes = codes[order]
+    starts = np.flatnonzero(np.diff(sorted_codes, prepend=-1))
+    grams = np.empty(len(codes), dtype=np.int32)
+    grams[order] = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, len(codes))))
+    return {
+        name + '.keys': sorted_codes[starts].astype(np.int32),
+        name + '.starts': np.append(starts, len(codes)).astype(np.int64),
+        name + '.postings': rows[order].astype(np.int32),
+        name + '.rows': np.append(0, np.cumsum(np.bincount(rows, minlength=len(texts)))).astype(np.int64),
+        name + '.grams': grams
     }
 
-    element_dict = {}
-    element_dict['Wall'] = {}
-    element_dict['Slab'] = {}
-    element_dict['Roof'] = {}
-    element_dict['Door'] = {}
-    element_dict['Window'] = {}
-    element_dict['Stair'] = {}
 
-    print('Processing Project...')
-    buildings = ifc_file.by_type('IfcBuilding')
-    if len(buildings) > 1:
-        raise Exception('Can not parse IFC files containing multiple IfcBuilding (not yet supported)')
+def build_match_index(names, descriptions):
+    # Inverted indices of the name and description trigrams of a material database
+    names = list(names)
+    if isinstance(descriptions, str):
+        descriptions = [descriptions] * len(names)
+    index = build_inverted_index('NameGrams', names)
+    index.update(build_inverted_index('DescriptionGrams', list(descriptions)))
+    return index
 
-    building_properties = get_building_properties(buildings[0])
 
-    #print('Processing Roofs...')
-    roofs = ifc_file.by_type('IfcRoof')
-    if len(roofs) > 0:
-        raise Exception('Can not parse IFC files containing IfcRoof (user must export roofs as IfcSlab)')
+class MaterialMatcher:
+    '''
+    Ranks the materials of a database by their similarity to a name
+    that is not in it.
 
-    print('Processing Walls...')
-    walls = ifc_file.by_type('IfcWall')
-    for wall in walls:
-        element_counts['Wall']['Number'] += 1
-
-        quantities = get_extent(wall)
-        material_properties = get_material_properties(wall)
-
-        # Iterate over material layers
-        total_wall_carbon = 0
-        material_layer_dict = {}
-        for material_layer in yield_material_layers(wall):
-            # Assuming thickness in mm, areas in m^2, embodied_carbon in kgCO2/kg, mass_density in kg/m^3
-            embodied_carbon = material_properties[material_layer['Name']]['EmbodiedCarbon']
-            mass_density = material_properties[material_layer['Name']]['MassDensity']
-            total_layer_carbon = material_layer['LayerThickness'] / 1000. * \
-                                 quantities['NetSideArea'] * \
-                                 embodied_carbon * \
-                                 mass_density
-            total_wall_carbon += total_layer_carbon
-            if material_layer['Name'] in material_layer_dict:
-                material_layer_dict[material_layer['Name']] += total_layer_carbon
-            else:
-                material_layer_dict[material_layer['Name']] = total_layer_carbon
-        element_dict['Wall'][wall.Name + ' (' + wall.GlobalId + ')'] = {
-            'IsExternal': material_properties['IsExternal'],
-            'Area': quantities['NetSideArea'],
-            'Layers': material_layer_dict
-        }
-        element_counts['Wall']['Carbon'] += total_wall_carbon
+    Names are compared by the Dice coefficient of the character
+    trigrams of their words, which tolerates spelling, word order,
+    punctuation and case differences. A material also matches by the
+    share of the trigrams of the name found in its description,
+    weighted by ``DESCRIPTION_WEIGHT``.
 
-    print('Processing Slabs/Roofs...')
-    slabs = ifc_file.by_type('IfcSlab')
-    for slab in slabs:
-        if get_element_type(slab) == 'ROOF':
-            element_counts['Roof']['Number'] += 1
-        else:
-            element_counts['Slab']['Number'] += 1
-
-        quantities = get_extent(slab)
-        material_properties = get_material_properties(slab)
-        material_names = get_material_names(slab)
-        #print(material_names)
-
-        # Iterate over material layers
-        total_slab_carbon = 0
-        material_layer_dict = {}
-        for material_layer in yield_material_layers(slab, material_names):
-            if material_layer['Name'] in material_properties:
-                embodied_carbon = material_properties[material_layer['Name']]['EmbodiedCarbon']
-                mass_density = material_properties[material_layer['Name']]['MassDensity']
-            else:
-                embodied_carbon = material_properties[material_names[material_layer['Name']]]['EmbodiedCarbon']
-                mass_density = material_properties[material_names[material_layer['Name']]]['MassDensity']
-
-            # Assuming thickness in mm, areas in m^2, embodied_carbon in kgCO2/kg, mass_density in kg/m^3
-            total_layer_carbon = material_layer['LayerThickness'] / 1000. * \
-                                 quantities['NetArea'] * \
-                                 embodied_carbon * \
-                                 mass_density
-            total_slab_carbon += total_layer_carbon
-            if material_layer['Name'] in material_properties:
-                material_layer_dict[material_layer['Name']] = total_layer_carbon
-            else:
-                material_layer_dict[material_names[material_layer['Name']]] = total_layer_carbon
-
-        if get_element_type(slab) == 'ROOF':
-            element_counts['Roof']['Carbon'] += total_slab_carbon
-            element_dict['Roof'][slab.Name + ' (' + slab.GlobalId + ')'] = {
-                'IsExternal' : material_properties['IsExternal'],
-                'Area': quantities['NetArea'],
-                'Layers': material_layer_dict
-            }
-        else:
-            element_counts['Slab']['Carbon'] += total_slab_carbon
-            element_dict['Slab'][slab.Name + ' (' + slab.GlobalId + ')'] = {
-                'IsExternal' : material_properties['IsExternal'],
-                'Area': quantities['NetArea'],
-                'Layers': material_layer_dict
-            }
+    Candidates are found in the inverted indices by the rarer trigrams
+    of the name, and only the ``MATCH_SCORED_ROWS`` candidates sharing
+    most of them are scored, so the work of a query is bounded whatever
+    the size of the database. Trigrams in more than
+    ``MATCH_COMMON_ROWS`` rows (e.g. those of "concrete" in a large
+    database) are only used to find candidates when the name has no
+    rarer one.
 
-    print('Processing Doors...')
-    doors = ifc_file.by_type('IfcDoor')
-    for door in doors:
-        element_counts['Door']['Number'] += 1
-        quantities = get_extent(door)
-        door_properties = get_element_properties(door)
-
-        # Assuming volumne in m^3, embodied_carbon in kgCO2/kg, mass_density in kg/m^3
-        embodied_carbon = door_properties['Element']['EmbodiedCarbon'] * door_properties['Element']['MassDensity'] * \
-                          quantities['Volume']
-        element_counts['Door']['Carbon'] += embodied_carbon
-        composite_layer = 'External Door Composite' if door_properties['IsExternal'] else 'Internal Door Composite'
-        element_dict['Door'][door.Name + ' (' + door.GlobalId + ')'] = {
-            'IsExternal' : door_properties['IsExternal'],
-            'Layers': {composite_layer: embodied_carbon}
-        }
+    :param arrays:
+        dict;
+        The arrays of :func:`build_match_index`.
 
-    print('Processing Windows/Skylights...')
-    windows = ifc_file.by_type('IfcWindow')
-    for window in windows:
-        element_counts['Window']['Number'] += 1
-        quantities = get_extent(window)
-        window_properties = get_element_properties(window)
-
-        # Assuming volumne in m^3, embodied_carbon in kgCO2/kg, mass_density in kg/m^3
-        embodied_carbon = window_properties['Element']['EmbodiedCarbon'] * window_properties['Element']['MassDensity'] * \
-                          quantities['Volume']
-        element_counts['Window']['Carbon'] += embodied_carbon
-        element_dict['Window'][window.Name + ' (' + window.GlobalId + ')'] = {
-            'IsExternal': window_properties['IsExternal'],
-            'Layers': {'Window Composite': embodied_carbon}
-        }
+    '''
 
-    print('Processing Stairs...')
-    stairs = ifc_file.by_type('IfcStair')
-    for stair in stairs:
-        element_counts['Stair']['Number'] += 1
-        quantities = get_extent(stair)
-        stair_properties = get_element_properties(stair)
-
-        # Assuming volumne in m^3, embodied_carbon in kgCO2/kg, mass_density in kg/m^3
-        embodied_carbon = stair_properties['Element']['EmbodiedCarbon'] * stair_properties['Element']['MassDensity'] * \
-                          quantities['NetVolume']
-        # print('  ', 'embodied_carbon', embodied_carbon, 'kgCO2')
-        element_counts['Stair']['Carbon'] += embodied_carbon
-        element_dict['Stair'][stair.Name + ' (' + stair.GlobalId + ')'] = {
-            'IsExternal': stair_properties['IsExternal'],
-            'Layers': {'Stair Composite': embodied_carbon}
-        }
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.row_count = len(arrays['NameGrams.rows']) - 1
 
-    #
-    # Find Replacements
-    #
-    print('Processing Replacements...')
+    @classmethod
+    def build(cls, names, descriptions):
+        with profiler.stage('Index Materials'):
+            return cls(build_match_index(names, descriptions))
 
-    # get list of materials
-    material_list = set()
-    for element_key, element_val in element_dict.items():
-        for sub_key, sub_val in element_val.items():
-            for material_key in sub_val['Layers'].keys():
-                material_list.add(material_key)
-    material_list = list(material_list)
+    def find_keys(self, index, codes):
+        # Positions of the trigrams of a query in an index, and the number of rows having them
+        keys = self.arrays[index + '.keys']
+        starts = self.arrays[index + '.starts']
+        if len(keys) == 0:
+            return keys[:0], starts[:0]
+        found = np.minimum(np.searchsorted(keys, codes), len(keys) - 1)
+        found = found[keys[found] == codes]
+        return found, starts[found + 1] - starts[found]
 
-    # process replacement database
-    cmp_tol = 1e-5 # Tolerance when comparing floats
-    ec_dataframe = pd.read_csv(args.dbfile,sep=';')
-    ec_dataframe['Name'] = ec_dataframe['Name'].apply(lambda x: str(x).strip())
-    ec_dataframe['EC_Class'] = ec_dataframe['ID'].apply(lambda x: str(x).split('-')[1])
-    ec_dataframe['EC_ID'] = ec_dataframe['ID'].apply(lambda x: str(x).split('-')[2])
-    ec_dataframe['EC_Per_Volume'] = ec_dataframe['EmbodiedCarbon(kgCO2e/kg)'].apply(lambda x: float(str(x).replace(',','.'))) * \
-                                    ec_dataframe['Density'].apply(lambda x: float(str(x).replace(',','.')))
-    # build replacement dict
-    ec_replacements_dict = {}
-    min_ec_dict = {}
-    for material in material_list:
-        material_dataframe =  ec_dataframe.loc[ec_dataframe['Name'] == material.strip()]
-        if len(material_dataframe) > 1:
-            raise LookupError('Found more than one entry in database for: ' + material.strip() )
-        elif len(material_dataframe) == 0:
-            print('WARNING: did not find material %s in database' % material.strip())
-        elif len(material_dataframe) == 1:
-            # Attempt to find replacement material
-            class_dataframe = ec_dataframe.loc[ec_dataframe['EC_Class'] == material_dataframe.squeeze().at['EC_Class']]
-            if class_dataframe.EC_Per_Volume.min() < material_dataframe.squeeze().at['EC_Per_Volume'] - cmp_tol:
-                min_ec_dict[material.strip()] = class_dataframe.EC_Per_Volume.min()
-                possible_replacements = class_dataframe[class_dataframe.EC_Per_Volume == class_dataframe.EC_Per_Volume.min()]
-                if len(possible_replacements) > 0:
-                    ec_replacements_dict[material_dataframe.squeeze().at['Name']] = pd.concat([
-                            material_dataframe[['ID','Name','EC_Per_Volume']],
-                            possible_replacements[['ID','Name','EC_Per_Volume']]
-                        ])
-            else:
-                min_ec_dict[material.strip()] = material_dataframe.squeeze().at['EC_Per_Volume']
-
-    building_area_internal = 0
-    material_counts = {}
-    element_counts = {}
-    for element_key, element_val in element_dict.items():
-        if element_key == 'Slab':
-            for sub_key, sub_val in element_val.items():
-                if not sub_val['IsExternal']:
-                    building_area_internal += sub_val['Area']
-        for sub_key, sub_val in element_val.items():
-            for material_key, material_value in sub_val['Layers'].items():
-                # build current material counts
-                if material_key in material_counts:
-                    material_counts[material_key.strip()] += material_value
-                else:
-                    material_counts[material_key.strip()] = material_value
-                # build current element counts
-                if sub_val['IsExternal']:
-                    element_key_name = 'External' + element_key.strip()
-                else:
-                    element_key_name = element_key.strip()
-                if element_key_name in element_counts:
-                    element_counts[element_key_name] += material_value
-                else:
-                    element_counts[element_key_name] = material_value
-
-    # build min material counts
-    min_material_counts = {}
-    for material in material_list:
-        material_key = material.strip()
-        if not ec_dataframe.loc[ec_dataframe['Name'] == material_key].squeeze().empty:
-            new_ec = material_counts[material_key] * min_ec_dict[material_key] / float(
-                ec_dataframe.loc[ec_dataframe['Name'] == material_key].squeeze().at['EC_Per_Volume'])
-            min_material_counts[material_key] = new_ec
-        else:
-            min_material_counts[material_key] = material_counts[material_key] # current == suggested
-
-    # build min element counts
-    min_element_counts = {}
-    for element_key, element_val in element_dict.items():
-        for sub_key, sub_val in element_val.items():
-            for material_key, material_value in sub_val['Layers'].items():
-                if not ec_dataframe.loc[ec_dataframe['Name'] == material_key.strip()].squeeze().empty:
-                    new_ec = material_value * min_ec_dict[material_key.strip()] / float(
-                        ec_dataframe.loc[ec_dataframe['Name'] == material_key.strip()].squeeze().at['EC_Per_Volume'])
-                else:
-                    new_ec = material_value
-                if sub_val['IsExternal']:
-                    element_key_name = 'External' + element_key.strip()
-                else:
-                    element_key_name = element_key.strip()
-                if element_key_name in min_element_counts:
-                    min_element_counts[element_key_name] += new_ec
-                else:
-                    min_element_counts[element_key_name] = new_ec
+    def find_candidates(self, found):
+        # Rows sharing the most of the rarer trigrams of a query with their name or description
+        row_counts = np.concatenate([row_counts for keys, row_counts in found.values()])
+        if len(row_counts) == 0:
+            return np.zeros(0, dtype=np.int64)
+        limit = max(MATCH_COMMON_ROWS, row_counts.min())
+        # At most `limit` postings are read per trigram, so sorting them is cheaper than counting over all rows
+        postings = [self.arrays[index + '.postings'][start:end] for index, (keys, row_counts) in found.items()
+                    for start, end in zip(self.arrays[index + '.starts'][keys[row_counts <= limit]].tolist(),
+                                          self.arrays[index + '.starts'][keys[row_counts <= limit] + 1].tolist())]
+        rows, shared = np.unique(np.concatenate(postings), return_counts=True)
+        if len(rows) > MATCH_SCORED_ROWS:
+            # Keep the rows sharing the most trigrams, ties in database order
+            at_least = np.cumsum(np.bincount(shared)[::-1])[::-1]
+            threshold = np.flatnonzero(at_least >= MATCH_SCORED_ROWS)[-1]
+            above = shared > threshold
+            tied = np.flatnonzero(shared == threshold)[:MATCH_SCORED_ROWS - np.count_nonzero(above)]
+            rows = np.sort(np.concatenate([rows[above], rows[tied]]))
+        return rows
 
+    def count_shared(self, index, keys, rows):
+        # Number of trigrams of each row shared with a query, and the number of trigrams of the rows
+        row_starts = self.arrays[index + '.rows'][rows]
+        lengths = self.arrays[index + '.rows'][rows + 1] - row_starts
+        ends = np.cumsum(lengths)
+        positions = np.repeat(row_starts - ends + lengths, lengths)
+        positions += np.arange(len(positions))
+        # Membership of the query trigrams by key position, a single gather per trigram of the rows, and the few
+        # shared trigrams counted to their rows by position
+        query_keys = np.zeros(len(self.arrays[index + '.keys']), dtype=bool)
+        query_keys[keys] = True
+        shared = np.flatnonzero(query_keys.take(self.arrays[index + '.grams'].take(positions)))
+        return np.bincount(np.searchsorted(ends, shared, side='right'), minlength=len(rows)), lengths
 
-    sorted_material_names = list(material_counts.keys())
-    sorted_material_values = [material_counts[sorted_material_names] for sorted_material_names in sorted_material_names]
-    sorted_material_names, sorted_material_values = zip_sort(sorted_material_names, sorted_material_values)
-    plot_min_values = []
-    true_min_values = []
-    true_saving_values = []
-    for name, value in zip(sorted_material_names, sorted_material_values):
-        if not ec_dataframe.loc[ec_dataframe['Name'] == name.strip()].squeeze().empty:
-            new_ec = value * min_ec_dict[name] / float(ec_dataframe.loc[ec_dataframe['Name'] == name].squeeze().at['EC_Per_Volume'])
-            plot_min_values.append(new_ec)
-            true_min_values.append(new_ec)
-            true_saving_values.append(value - new_ec)
-        else:
-            plot_min_values.append(material_counts[name]) # if no suggestion, do not plot a suggested bar
-            true_min_values.append(material_counts[name])
-            true_saving_values.append(0.)
+    def match(self, name, count=MATCH_CANDIDATES, min_confidence=MATCH_MIN_CONFIDENCE):
+        '''
+        :returns:
+            list;
+            Up to `count` tuples of the row position and confidence
+            (0 to 1) of the closest materials, best first, ties in
+            database order.
 
-    # Plot 2
-    plot_barchart(os.path.join('reports',ifc_filename,'material_counts'), sorted_material_names, sorted_material_values, 'Total kgCO₂', plot_min_values)
+        '''
+        profiler.count('MaterialMatches')
+        codes = get_text_grams([name])[1].astype(np.int32)
+        found = {index: self.find_keys(index, codes) for index in ('NameGrams', 'DescriptionGrams')}
+        rows = self.find_candidates(found)
+        if len(rows) == 0:
+            return []
+        name_shared, name_lengths = self.count_shared('NameGrams', found['NameGrams'][0], rows)
+        confidence = 2. * name_shared / (len(codes) + name_lengths)
+        # Descriptions share at most the trigrams of the name found in their index, they are only scored when
+        # that could raise a row to the best matches
+        description_keys = found['DescriptionGrams'][0]
+        cutoff = np.partition(confidence, -count)[-count] if len(confidence) >= count else -np.inf
+        if DESCRIPTION_WEIGHT * len(description_keys) / len(codes) >= max(cutoff, min_confidence):
+            description_shared, _ = self.count_shared('DescriptionGrams', description_keys, rows)
+            confidence = np.maximum(confidence, DESCRIPTION_WEIGHT * description_shared / len(codes))
+        best = np.lexsort((rows, -confidence))[:count]
+        best = best[confidence[best] >= min_confidence]
+        return [(int(row), float(value)) for row, value in zip(rows[best], confidence[best])]
 
-    # Replacement Tables
-    names, values, true_min_values, true_saving_values = zip_sort(sorted_material_names, sorted_material_values, true_min_values, true_saving_values)
-    true_min_values_dict = {names[i]: true_min_values[i] for i in range(len(names))}
-    true_saving_values_dict = {names[i]: true_saving_values[i] for i in range(len(names))}
-    ec_replacements_str = []
-    i = 1
-    for name in names:
-        if name in ec_replacements_dict:
-            ec_replacements_str.append(
-                '\n#### %d. %s: <span style="color:#4C7998">%.0f kgCO₂</span> / <span style="color:#9BCA7E">%.0f kgCO₂</span> (Saving %.0f kgCO₂)  \n' % (
-                i, name, material_counts[name], true_min_values_dict[name], true_saving_values_dict[name]))
-            ec_replacements_str.append(ec_replacements_dict[name].to_markdown(
-                index=False,
-                headers=['ID','Name','EC/m³'],
-                floatfmt='.2f')
-            )
-            i = i + 1
-    ec_replacements_str = '\n'.join(ec_replacements_str)
 
-    # Plot 3
-    element_rename_dict = {
-        'ExternalSlab': 'Substructure',
-        'ExternalWall': 'External Walls',
-        'Slab': 'Upper Floors',
-        'Wall': 'Internal Walls',
-        'ExternalRoof': 'Roof',
-        'ExternalDoor': 'External Doors',
-        'Window': 'Windows',
-        'Stair': 'Stairs',
-        'Door': 'Internal Doors'
-    }
-    names = list(element_counts.keys())
-    values = list(element_counts[name] for name in names)
-    min_values = list(min_element_counts[name] for name in names)
-    new_names = [element_rename_dict[n] for n in names]
-    new_names, values, min_values = zip_sort(new_names, values, min_values)
-    plot_barchart(os.path.join('reports',ifc_filename,'element_counts'), new_names, values, 'Total kgCO₂', min_values)
+def read_alias_table(alias_path):
+    # Rows of an alias file, empty if the file does not exist yet
+    import pandas as pd
+    if not os.path.exists(alias_path):
+        return pd.DataFrame(columns=list(ALIAS_COLUMNS))
+    alias_table = pd.read_csv(alias_path, sep=';', dtype=str, keep_default_na=False)
+    return alias_table.reindex(columns=list(ALIAS_COLUMNS), fill_value='')
 
-    # Generate Report
-    building_ec = sum(element_counts.values())
-    replacement_dict = {}
-    replacement_dict['Date'] = datetime.date.today().strftime("%d/%m/%Y")
-    replacement_dict['GitID'] = get_git_id()[:7]
-    replacement_dict['ECReplacements'] = ec_replacements_str
-    replacement_dict['BuildingPotentialEC'] = sum(true_min_values_dict.values())
-    replacement_dict['BuildingPotentialECPerAreaInternal'] = sum(true_min_values_dict.values()) / building_area_internal
-    replacement_dict['BuildingAreaInternal'] = building_area_internal
-    replacement_dict['BuildingEC'] = building_ec
-    replacement_dict['BuildingECPerAreaInternal'] = building_ec/building_area_internal
-    replacement_dict['IFCFilename'] = ifc_filename
-    replacement_dict.update(building_properties)
 
-    # Plot 1
-    plot_benchmark(os.path.join('reports',ifc_filename,'benchmark'), building_ec/building_area_internal, replacement_dict['BuildingPotentialECPerAreaInternal'])
+def read_alias_file(alias_path):
+    '''
+    Read the confirmed aliases of a semicolon separated file of
+    ``ALIAS_COLUMNS``, in which `Material` is a name used in models and
+    `DatabaseName` the name of the database material it stands for.
+    A row is confirmed when its `Confirmed` column is e.g. ``yes``.
+
+    :returns:
+        dict;
+        The database names by material name.
+
+    '''
+    alias_table = read_alias_table(alias_path)
+    confirmed = alias_table['Confirmed'].str.strip().str.lower().isin(CONFIRMED_VALUES)
+    return {material.strip(): database_name.strip() for material, database_name
+            in zip(alias_table['Material'][confirmed], alias_table['DatabaseName'][confirmed])}
 
-    generate_report(ifc_filename, replacement_dict)
 
-    # TODO, compare with Leti guide and recompute with new materials (for Bahriye)
+def match_material(material, material_db):
+    '''
+    Look up a material not in the database by its closest match, if the
+    confidence of the match reaches the ``match_threshold`` of the
+    database, and otherwise suggest the closest matches.
+
+    :returns:
+        dict;
+        The record of the matched material, None if there is no match.
+
+    '''
+    candidates = material_db.match(material)
+    if candidates and material_db.match_threshold is not None and candidates[0][1] >= material_db.match_threshold:
+        print('NOTE: matched material %s to %s (confidence %.2f)' % (material, candidates[0][0], candidates[0][1]))
+        return material_db.lookup(candidates[0][0])
+    if candidates:
+        print('WARNING: did not find material %s in database, closest matches: %s' %
+              (material, ', '.join('%s (%.2f)' % candidate for candidate in candidates)))
+    else:
+        print('WARNING: did not find material %s in database' % material)
+    return None
+
+#
+# Material Database
+#
+
+def parse_decimal(column):
+    # Parse a column of decimal-comma strings (e.g. '0,007') into floats
+    return column.astype(str).str.replace(',', '.', regex=False).astype(float)
+
+
+def parse_decimal_value(text, column, location):
+    # Parse a decimal-comma string of a row of an input file, naming the row and column if it is not a number
+    try:
+        return float(text.replace(',', '.'))
+    except ValueError:
+        raise ValueError('%s: %s %r is not a number' % (location, column, text)) from None
+
+
+class MaterialDatabase:
+    '''
+    Embodied carbon material database with hash indexed lookups.
+
+    The database is parsed once. Materials are indexed by their
+    stripped ``Name`` and each ``EC_Class`` keeps its minimum
+    ``EC_Per_Volume`` and the records attaining it.
+
+    :param dataframe:
+        pandas.DataFrame;
+        The raw database with the columns ``ID``, ``Name``,
+        ``EmbodiedCarbon(kgCO2e/kg)`` and ``Density``.
+
+    '''
+
+    def __init__(self, dataframe):
+        dataframe = dataframe.copy()
+        dataframe['Name'] = dataframe['Name'].astype(str).str.strip()
+        ec_code = dataframe['ID'].astype(str).str.split('-')
+        dataframe['EC_Class'] = ec_code.str[1]
+        dataframe['EC_ID'] = ec_code.str[2]
+        dataframe['EC_Per_Volume'] = parse_decimal(dataframe['EmbodiedCarbon(kgCO2e/kg)']) * \
+                                     parse_decimal(dataframe['Density'])
+        self.dataframe = dataframe
+        self.records = dataframe.to_dict('records')
+        # Confirmed aliases of material names, see read_alias_file
+        self.aliases = {}
+        # Confidence from which unmatched names are replaced by their best match, None to only suggest matches
+        self.match_threshold = None
+        self.matcher = None
+
+        # Name index, duplicate names are only an error once they are looked up
+        self.name_index = {}
+        self.duplicate_names = set()
+        for position, record in enumerate(self.records):
+            if record['Name'] in self.name_index:
+                self.duplicate_names.add(record['Name'])
+            else:
+                self.name_index[record['Name']] = position
+
+        # Class index of minimum EC_Per_Volume and the records attaining it
+        self.class_minimum_index = dataframe.groupby('EC_Class')['EC_Per_Volume'].min().to_dict()
+        self.class_minimum_positions = {}
+        for position, record in enumerate(self.records):
+            if record['EC_Per_Volume'] == self.class_minimum_index[record['EC_Class']]:
+                self.class_minimum_positions.setdefault(record['EC_Class'], []).append(position)
+
+    @classmethod
+    def read_csv(cls, filename):
+        import pandas as pd
+        with profiler.stage('Load Database'):
+            return cls(pd.read_csv(filename, sep=';'))
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, name):
+        return self.aliases.get(name.strip(), name.strip()) in self.name_index
+
+    def lookup(self, name):
+        # Return the record of a material, None if it is not in the database
+        profiler.count('DatabaseLookups')
+        name = self.aliases.get(name.strip(), name.strip())
+        if name in self.duplicate_names:
+            raise LookupError('Found more than one entry in database for: ' + name)
+        position = self.name_index.get(name)
+        return None if position is None else self.records[position]
+
+    def lookup_many(self, names):
+        # Return a dictionary of records for a batch of material names
+        return {name: self.lookup(name) for name in names}
+
+    def get_name(self, position):
+        return self.records[position]['Name']
+
+    def get_matcher(self):
+        # Build the match index of names and descriptions on first use
+        if self.matcher is None:
+            self.matcher = MaterialMatcher.build(self.dataframe['Name'], self.dataframe.get('Description', ''))
+        return self.matcher
+
+    def match(self, name, count=MATCH_CANDIDATES):
+        # Return the names and confidences of the closest materials to a name not in the database
+        return [(self.get_name(position), confidence) for position, confidence in self.get_matcher().match(name, count)]
+
+    def class_minimum(self, ec_class):
+        return self.class_minimum_index[ec_class]
+
+    def class_minimum_records(self, ec_class):
+        return [self.records[position] for position in self.class_minimum_positions[ec_class]]
+
+    def table(self, records, columns=('ID', 'Name', 'EC_Per_Volume')):
+        # Build a dataframe of selected columns for a list of records
+        import pandas as pd
+        return pd.DataFrame([[record[column] for column in columns] for record in records], columns=list(columns))
+
+COMPILED_DB_MAGIC = b'PYCABDB1'
+# Alignment of the arrays of a compiled database
+COMPILED_DB_ALIGNMENT = 64
+COMPILED_DB_STRINGS = ('ID', 'Name', 'Description', 'EC_Class', 'EC_ID')
+COMPILED_DB_NUMBERS = ('EmbodiedCarbon(kgCO2e/kg)', 'Density', 'EC_Per_Volume')
+# Arrays every compiled database has, the match index is optional as it is rebuilt on first use
+COMPILED_DB_REQUIRED = (tuple(column + suffix for column in COMPILED_DB_STRINGS + ('Classes',) for suffix in ('.offsets', '.bytes'))
+                        + COMPILED_DB_NUMBERS + ('NameSlots', 'ClassPositions', 'ClassStarts'))
+EC_CODE = re.compile(r'^[^-]+-([^-]+)-([^-]+)$')
+
+
+def hash_name(name):
+    # Hash of a material name that is stable across processes, unlike hash()
+    import zlib
+    return zlib.crc32(name.encode())
+
+
+def validate_material_table(dataframe):
+    '''
+    Check a raw material database: required columns, ``ID`` codes of
+    the form ``EC-<class>-<id>``, decimal values of the embodied carbon
+    and density, and unique (stripped) names.
+
+    :returns:
+        list;
+        A message for every problem found, empty if the table is valid.
+
+    '''
+    problems = []
+    columns = ('ID', 'Name', 'EmbodiedCarbon(kgCO2e/kg)', 'Density')
+    missing_columns = [column for column in columns if column not in dataframe.columns]
+    if missing_columns:
+        return ['missing columns: ' + ', '.join(missing_columns)]
+    # Rows are numbered as in the file, after the header
+    for row, (ec_id, name, embodied_carbon, density) in enumerate(dataframe[list(columns)].itertuples(index=False), 2):
+        if not EC_CODE.match(str(ec_id).strip()):
+            problems.append('row %d: malformed ID %r, expected EC-<class>-<id>' % (row, ec_id))
+        if not str(name).strip():
+            problems.append('row %d: empty Name' % row)
+        for column, value in (('EmbodiedCarbon(kgCO2e/kg)', embodied_carbon), ('Density', density)):
+            try:
+                float(str(value).replace(',', '.'))
+            except ValueError:
+                problems.append('row %d: %s %r is not a number' % (row, column, value))
+    names = dataframe['Name'].astype(str).str.strip()
+    for name in names[names.duplicated()].unique():
+        rows = [str(row) for row in (np.flatnonzero(names.to_numpy() == name) + 2)]
+        problems.append('duplicate Name %r in rows %s' % (name, ', '.join(rows)))
+    return problems
+
+
+def encode_strings(strings):
+    # Offsets and UTF-8 bytes of a string table
+    encoded = [string.encode() for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(string) for string in encoded])
+    return offsets, np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+
+def compile_material_db(csv_path, output_path):
+    '''
+    Validate a CSV material database and write it as a compiled,
+    memory-mappable file read by :class:`CompiledMaterialDatabase`.
+
+    The file holds a JSON header of array offsets followed by the
+    aligned arrays: the numeric columns, the string tables (offsets
+    and UTF-8 bytes), an open addressing hash index of the names and
+    the positions of each ``EC_Class`` sorted by ``EC_Per_Volume`` and
+    the match index of :class:`MaterialMatcher`.
+
+    :raises ValueError:
+        If the database is not valid, listing all problems.
+
+    '''
+    import pandas as pd
+    dataframe = pd.read_csv(csv_path, sep=';', dtype=str, keep_default_na=False)
+    problems = validate_material_table(dataframe)
+    if problems:
+        raise ValueError('%s is not a valid material database:\n  ' % csv_path + '\n  '.join(problems))
+
+    material_db = MaterialDatabase(dataframe)
+    table = material_db.dataframe
+    arrays = {}
+    for column in COMPILED_DB_STRINGS:
+        strings = table[column].astype(str).str.strip() if column in ('ID', 'Name') else table[column].astype(str)
+        arrays[column + '.offsets'], arrays[column + '.bytes'] = encode_strings(strings)
+    arrays['EmbodiedCarbon(kgCO2e/kg)'] = parse_decimal(table['EmbodiedCarbon(kgCO2e/kg)']).to_numpy()
+    arrays['Density'] = parse_decimal(table['Density']).to_numpy()
+    arrays['EC_Per_Volume'] = table['EC_Per_Volume'].to_numpy(dtype=float)
+
+    # Hash index of at most half full slots, linear probing
+    slot_count = 1 << max(1, (2 * len(table)).bit_length())
+    name_slots = np.full(slot_count, -1, dtype=np.int64)
+    for position, name in enumerate(table['Name']):
+        slot = hash_name(name) & (slot_count - 1)
+        while name_slots[slot] != -1:
+            slot = (slot + 1) & (slot_count - 1)
+        name_slots[slot] = position
+    arrays['NameSlots'] = name_slots
+
+    # Positions grouped by class and sorted by EC_Per_Volume, ties in file order
+    class_codes, classes = pd.factorize(table['EC_Class'], sort=True)
+    class_positions = np.lexsort((arrays['EC_Per_Volume'], class_codes)).astype(np.int64)
+    arrays['ClassPositions'] = class_positions
+    arrays['ClassStarts'] = np.searchsorted(class_codes[class_positions], np.arange(len(classes) + 1)).astype(np.int64)
+    arrays['Classes.offsets'], arrays['Classes.bytes'] = encode_strings(classes)
+    arrays.update(build_match_index(table['Name'], table['Description']))
+
+    header = {'Rows': len(table), 'Arrays': {}}
+    offset = 0
+    for name, array in arrays.items():
+        header['Arrays'][name] = {'dtype': array.dtype.str, 'count': len(array), 'offset': offset}
+        offset += -(-array.nbytes // COMPILED_DB_ALIGNMENT) * COMPILED_DB_ALIGNMENT
+    header_bytes = json.dumps(header).encode()
+    data_start = -(-(len(COMPILED_DB_MAGIC) + 8 + len(header_bytes)) // COMPILED_DB_ALIGNMENT) * COMPILED_DB_ALIGNMENT
+
+    temporary_path = '%s.%d.tmp' % (output_path, os.getpid())
+    with open(temporary_path, 'wb') as f:
+        f.write(COMPILED_DB_MAGIC + np.uint64(len(header_bytes)).tobytes() + header_bytes)
+        for name, array in arrays.items():
+            f.seek(data_start + header['Arrays'][name]['offset'])
+            f.write(array.tobytes())
+    os.replace(temporary_path, output_path)
+
+
+class CompiledMaterialDatabase:
+    '''
+    Material database memory-mapped from a file written by
+    :func:`compile_material_db`, with the interface of
+    :class:`MaterialDatabase`.
+
+    Nothing is parsed on load: lookups go through the stored hash index
+    and records are built only for the materials looked up. Pickling
+    only transfers the path, so worker processes map the same file and
+    share its pages.
+
+    :param path:
+        str;
+        The path to the compiled database.
+
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(COMPILED_DB_MAGIC)) != COMPILED_DB_MAGIC:
+                raise ValueError('%s is not a compiled material database' % path)
+            header_size = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            header = json.loads(f.read(header_size))
+        data_start = -(-(len(COMPILED_DB_MAGIC) + 8 + header_size) // COMPILED_DB_ALIGNMENT) * COMPILED_DB_ALIGNMENT
+        mapping = np.memmap(path, dtype=np.uint8, mode='r')
+        # Files of an older layout or cut short are rejected here rather than failing on some later lookup
+        missing = [name for name in COMPILED_DB_REQUIRED if name not in header['Arrays']]
+        if missing:
+            raise ValueError('%s was compiled by an older version, missing %s, compile it again'
+                             % (path, ', '.join(missing)))
+        if any(data_start + array['offset'] + array['count'] * np.dtype(array['dtype']).itemsize > len(mapping)
+               for array in header['Arrays'].values()):
+            raise ValueError('%s is truncated, compile it again' % path)
+        self.arrays = {name: np.frombuffer(mapping, dtype=array['dtype'], count=array['count'],
+                                           offset=data_start + array['offset'])
+                       for name, array in header['Arrays'].items()}
+        self.row_count = header['Rows']
+        self.slot_mask = len(self.arrays['NameSlots']) - 1
+        self.class_index = {self.get_string('Classes', position): position
+                            for position in range(len(self.arrays['ClassStarts']) - 1)}
+        self.aliases = {}
+        self.match_threshold = None
+        self.matcher = None
+
+    def __reduce__(self):
+        return (CompiledMaterialDatabase, (self.path,), {'aliases': self.aliases, 'match_threshold': self.match_threshold})
+
+    def __len__(self):
+        return self.row_count
+
+    def __contains__(self, name):
+        return self.find(self.aliases.get(name.strip(), name.strip())) is not None
+
+    def get_string(self, column, position):
+        offsets = self.arrays[column + '.offsets']
+        return self.arrays[column + '.bytes'][offsets[position]:offsets[position + 1]].tobytes().decode()
+
+    def get_record(self, position):
+        record = {column: self.get_string(column, position) for column in COMPILED_DB_STRINGS}
+        record.update({column: float(self.arrays[column][position]) for column in COMPILED_DB_NUMBERS})
+        return record
+
+    def find(self, name):
+        # Position of a stripped name in the hash index, None if it is not in the database
+        name_slots = self.arrays['NameSlots']
+        slot = hash_name(name) & self.slot_mask
+        while name_slots[slot] != -1:
+            if self.get_string('Name', name_slots[slot]) == name:
+                return int(name_slots[slot])
+            slot = (slot + 1) & self.slot_mask
+        return None
+
+    def lookup(self, name):
+        # Return the record of a material, None if it is not in the database
+        profiler.count('DatabaseLookups')
+        position = self.find(self.aliases.get(name.strip(), name.strip()))
+        return None if position is None else self.get_record(position)
+
+    def lookup_many(self, names):
+        return {name: self.lookup(name) for name in names}
+
+    def get_name(self, position):
+        return self.get_string('Name', position)
+
+    def get_matcher(self):
+        # Use the stored match index, databases compiled without one are indexed on first use
+        if self.matcher is None:
+            if all(index + '.grams' in self.arrays for index in ('NameGrams', 'DescriptionGrams')):
+                self.matcher = MaterialMatcher(self.arrays)
+            else:
+                self.matcher = MaterialMatcher.build([self.get_string('Name', position) for position in range(len(self))],
+                                                     [self.get_string('Description', position) for position in range(len(self))])
+        return self.matcher
+
+    def match(self, name, count=MATCH_CANDIDATES):
+        return MaterialDatabase.match(self, name, count)
+
+    def class_positions(self, ec_class):
+        class_number = self.class_index[ec_class]
+        starts = self.arrays['ClassStarts']
+        return self.arrays['ClassPositions'][starts[class_number]:starts[class_number + 1]]
+
+    def class_minimum(self, ec_class):
+        return float(self.arrays['EC_Per_Volume'][self.class_positions(ec_class)[0]])
+
+    def class_minimum_records(self, ec_class):
+        positions = self.class_positions(ec_class)
+        ec_per_volume = self.arrays['EC_Per_Volume'][positions]
+        return [self.get_record(position) for position in positions[ec_per_volume == ec_per_volume[0]]]
+
+    def table(self, records, columns=('ID', 'Name', 'EC_Per_Volume')):
+        return MaterialDatabase.table(self, records, columns)
+
+
+def load_material_db(path, alias_path=None, match_threshold=None):
+    '''
+    Open a compiled material database, or parse a CSV one.
+
+    :param alias_path:
+        str;
+        A file of material aliases, of which the confirmed ones are
+        used by lookups, see :func:`read_alias_file`.
+
+    :param match_threshold:
+        float;
+        The confidence from which materials not in the database are
+        replaced by their best match, None to only suggest matches.
+
+    '''
+    with open(path, 'rb') as f:
+        compiled = f.read(len(COMPILED_DB_MAGIC)) == COMPILED_DB_MAGIC
+    material_db = CompiledMaterialDatabase(path) if compiled else MaterialDatabase.read_csv(path)
+    if alias_path is not None:
+        material_db.aliases = read_alias_file(alias_path)
+    material_db.match_threshold = match_threshold
+    return material_db
+
+#
+# Parsing
+#
+
+def parse_ec_code(ec_code):
+    ec, ec_class, ec_id = ec_code.split('-')
+    assert ec == 'EC'
+    return (ec_class, ec_id)
+
+
+def dump(element):
+    print('---------- begin dump ----------')
+    for definition in element.IsDefinedBy:
+        print('D  ', definition)
+        if definition.is_a('IfcRelDefinesByProperties'):
+            print('    ', definition.RelatingPropertyDefinition.Name)
+            if definition.RelatingPropertyDefinition.is_a('IfcPropertySet'):
+                for sub_definition in definition.RelatingPropertyDefinition.HasProperties:
+                    print('     ', sub_definition.Name)
+        print(definition)
+
+    for assoc in element.HasAssociations:
+        print('A  ', assoc)
+    print('---------- end dump ----------')
+
+
+def get_quantities(element_quantity):
+    quantities = {}
+    for quantity in element_quantity.Quantities:
+        if quantity.is_a('IfcQuantityLength'):
+            quantities[quantity.Name] = quantity.LengthValue
+        elif quantity.is_a('IfcQuantityArea'):
+            quantities[quantity.Name] = quantity.AreaValue
+        elif quantity.is_a('IfcQuantityVolume'):
+            quantities[quantity.Name] = quantity.VolumeValue
+    return quantities
+
+
+def new_definition_entry():
+    return {'PropertySets': {}, 'ElementQuantities': {}, 'SlabType': None}
+
+
+def add_definition(definitions, definition):
+    # Sort a relationship into the property sets / element quantities / type of an index entry
+    if definition.is_a('IfcRelDefinesByProperties'):
+        related_data = definition.RelatingPropertyDefinition
+        if related_data.is_a('IfcPropertySet'):
+            definitions['PropertySets'].setdefault(related_data.Name, []).append(related_data)
+        elif related_data.is_a('IfcElementQuantity'):
+            definitions['ElementQuantities'].setdefault(related_data.Name, []).append(related_data)
+    elif definition.is_a('IfcRelDefinesByType'):
+        if definitions['SlabType'] is None and definition.RelatingType.is_a('IfcSlabType'):
+            definitions['SlabType'] = definition.RelatingType.PredefinedType
+
+
+def index_element_definitions(element):
+    # Build the definition index entry of a single element from its own IsDefinedBy
+    definitions = new_definition_entry()
+    for definition in element.IsDefinedBy:
+        add_definition(definitions, definition)
+    return definitions
+
+
+class DefinitionIndex(dict):
+    # Index entries keyed by element id, with the build-ups resolved from them
+    def __init__(self):
+        super().__init__()
+        self.build_ups = BuildUpCache()
+
+
+def build_definition_index(ifc_file):
+    '''
+    Build an index of the property sets, element quantities and
+    slab types of all elements in a single pass over the
+    ``IfcRelDefinesByProperties`` and ``IfcRelDefinesByType``
+    relationships of `ifc_file`.
+
+    :param ifc_file:
+        ifcopenshell.file;
+        The parsed IFC file.
+
+    :returns:
+        DefinitionIndex;
+        Index entries keyed by element id. Property sets and element
+        quantities are grouped by name in the order they appear in
+        ``IsDefinedBy``.
+
+    '''
+    # Gather relationships in file order, as IsDefinedBy returns them
+    relationships = list(ifc_file.by_type('IfcRelDefinesByProperties')) + \
+                    list(ifc_file.by_type('IfcRelDefinesByType'))
+    relationships.sort(key=lambda definition: definition.id())
+
+    index = DefinitionIndex()
+    for definition in relationships:
+        for element in definition.RelatedObjects:
+            if element.id() not in index:
+                index[element.id()] = new_definition_entry()
+            add_definition(index[element.id()], definition)
+    return index
+
+
+def get_definitions(element, index=None):
+    # Look up the index entry of an element, walking IsDefinedBy if no index is available
+    if index is None:
+        return index_element_definitions(element)
+    return index.get(element.id(), new_definition_entry())
+
+
+def get_extent(element, index=None):
+    # Return dictionary of quantities for BaseQuantities, or of the quantities computed from geometry in the index
+    definitions = get_definitions(element, index)
+    if 'BaseQuantities' not in definitions and 'BaseQuantities' in definitions['ElementQuantities']:
+        definitions['BaseQuantities'] = get_quantities(definitions['ElementQuantities']['BaseQuantities'][0])
+    return definitions.get('BaseQuantities')
+
+
+def get_element_properties(element, index=None):
+    # Build dictionary of 'Embodied Carbon' and 'MassDensity'
+    property_data = {'IsExternal': False}
+    embodied_carbon = False
+    mass_density = False
+    property_sets = get_definitions(element, index)['PropertySets']
+    for related_data in select_property_sets(property_sets, ('Pset_DoorCommon', 'Pset_WindowCommon', 'Pset_StairCommon')):
+        for prop in related_data.HasProperties:
+            if prop.Name == 'IsExternal':
+                property_data['IsExternal'] = True if prop.NominalValue.wrappedValue is True else False
+    for related_data in property_sets.get('EC_Pset_EmbodiedCarbon', []):
+        for prop in related_data.HasProperties:
+            # print(property)
+            if prop.Name == 'EmbodiedCarbon':
+                embodied_carbon = prop.NominalValue.wrappedValue
+            elif prop.Name == 'MassDensity':
+                mass_density = prop.NominalValue.wrappedValue
+    if embodied_carbon and mass_density:
+        property_data['Element'] = {
+            'EmbodiedCarbon': embodied_carbon,
+            'MassDensity': mass_density
+        }
+    return property_data
+
+
+def get_is_external(element, index=None):
+    # Read IsExternal of a wall or slab, the last value defined wins
+    is_external = False
+    property_sets = get_definitions(element, index)['PropertySets']
+    for related_data in select_property_sets(property_sets, ('Pset_WallCommon', 'Pset_SlabCommon')):
+        for prop in related_data.HasProperties:
+            if prop.Name == 'IsExternal':
+                is_external = True if prop.NominalValue.wrappedValue is True else False
+    return is_external
+
+
+def get_material_properties(element, index=None):
+    # Build dictionary of 'Embodied Carbon' and 'MassDensity'
+    property_data = {'IsExternal': get_is_external(element, index)}
+    property_sets = get_definitions(element, index)['PropertySets']
+    for related_data in property_sets.get('Material Properties', []):
+        for property in related_data.HasProperties:
+            # print(property.Name)
+            for sub_property in property.HasProperties:
+                # print('here',sub_property.Name)
+                sub_property_name = sub_property.Name
+                # print(sub_property_name)
+                for sub_sub_property in sub_property.HasProperties:
+                    if sub_sub_property.Name == 'Embodied Carbon':
+                        embodied_carbon = sub_sub_property.NominalValue.wrappedValue
+                        if embodied_carbon.endswith(' (kgCO₂/kg)'):
+                            embodied_carbon = float(embodied_carbon[:-11])
+                    elif sub_sub_property.Name == 'MassDensity':
+                        mass_density = sub_sub_property.NominalValue.wrappedValue
+                if embodied_carbon and mass_density:
+                    property_data[sub_property_name] = {
+                        'EmbodiedCarbon': embodied_carbon,
+                        'MassDensity': mass_density
+                    }
+    return property_data
+
+
+def get_material_names(element, index=None):
+    # Build dictionary of names e.g. 'Component 1' = 'Slate Shingle, Roof'
+    names_data = {}
+    for related_data in get_definitions(element, index)['PropertySets'].get('Material Properties', []):
+        for prop in related_data.HasProperties:
+            component_name = prop.Name
+            for sub_property in prop.HasProperties:
+                names_data[component_name] = sub_property.Name
+    return names_data
+
+
+def get_element_type(element, index=None):
+    return get_definitions(element, index)['SlabType']
+
+
+def select_property_sets(property_sets, names):
+    # Select the named property sets, keeping the order in which they were defined
+    selected = [related_data for name in names for related_data in property_sets.get(name, [])]
+    if len(selected) > 1:
+        selected.sort(key=lambda related_data: related_data.id())
+    return selected
+
+
+def yield_material_layers(element, material_names={}, index=None):
+    definitions = get_definitions(element, index)
+
+    if definitions['SlabType'] == 'ROOF':
+        for related_data in definitions['ElementQuantities'].get('Component Quantities', []):
+            for quantity in related_data.Quantities:
+                # print(quantity.Name)
+                for sub_quantity in quantity.HasQuantities:
+                    if sub_quantity.is_a('IfcQuantityLength'):
+                        if sub_quantity.Name == 'Skin Thickness':
+                            material_layer_thickness = sub_quantity.LengthValue
+                yield {'Name': quantity.Name, 'LayerThickness': material_layer_thickness}
+    else:
+        for assoc in element.HasAssociations:
+            if assoc.is_a('IfcRelAssociatesMaterial'):
+                if assoc.RelatingMaterial.is_a('IfcMaterialLayerSetUsage'):
+                    # print('  ', assoc.RelatingMaterial.ForLayerSet.LayerSetName)
+                    for material_layer in assoc.RelatingMaterial.ForLayerSet.MaterialLayers:
+                        yield {'Name': material_layer.Material.Name, 'LayerThickness': material_layer.LayerThickness}
+
+
+def get_building_properties(building):
+    building_properties = {}
+    for definition in building.IsDefinedBy:
+        if definition.is_a('IfcRelDefinesByProperties'):
+            related_data = definition.RelatingPropertyDefinition
+            if related_data.is_a('IfcPropertySet'):
+                if related_data.Name == 'Pset_BuildingCommon':
+                    for prop in related_data.HasProperties:
+                        building_properties[prop.Name] = str(prop.NominalValue.wrappedValue)
+    return building_properties
+
+
+class SpatialIndex(dict):
+    # Building and storey names keyed by the GlobalId of elements, with the buildings keyed by name
+    def __init__(self):
+        super().__init__()
+        self.buildings = {}
+        self.site_name = ''
+
+    def locate(self, global_id):
+        # Building and storey of an element, the elements of a single building model are all in it
+        if global_id in self:
+            return self[global_id]
+        return (next(iter(self.buildings)), '') if len(self.buildings) == 1 else ('', '')
+
+
+def get_unique_name(spatial_element, names):
+    # Name of a building or storey, made unique by its GlobalId if the name is taken
+    name = spatial_element.Name or spatial_element.GlobalId
+    return name if name not in names else '%s (%s)' % (name, spatial_element.GlobalId)
+
+
+def build_spatial_index(ifc_file):
+    '''
+    Build the containment index of a model from its ``IfcRelAggregates``
+    and ``IfcRelContainedInSpatialStructure`` relationships, following
+    site -> building -> storey -> space -> element and the parts of
+    elements.
+
+    :returns:
+        SpatialIndex;
+        The building and storey (empty if the element is not in one)
+        of every contained element keyed by GlobalId.
+
+    '''
+    children = {}
+    for relationship in ifc_file.by_type('IfcRelAggregates'):
+        if relationship.RelatingObject is not None:
+            children.setdefault(relationship.RelatingObject.id(), []).extend(relationship.RelatedObjects)
+    for relationship in ifc_file.by_type('IfcRelContainedInSpatialStructure'):
+        if relationship.RelatingStructure is not None:
+            children.setdefault(relationship.RelatingStructure.id(), []).extend(relationship.RelatedElements)
+
+    spatial_index = SpatialIndex()
+    sites = ifc_file.by_type('IfcSite')
+    spatial_index.site_name = sites[0].Name or '' if sites else ''
+    for building in ifc_file.by_type('IfcBuilding'):
+        building_name = get_unique_name(building, spatial_index.buildings)
+        spatial_index.buildings[building_name] = building
+        storeys = set()
+        stack = [(building, '')]
+        while stack:
+            parent, storey = stack.pop()
+            for child in children.get(parent.id(), ()):
+                # Skip entities the streaming reader does not keep, nested buildings and elements already placed
+                if child is None or child.is_a('IfcBuilding') or child.GlobalId in spatial_index:
+                    continue
+                child_storey = storey
+                if child.is_a('IfcBuildingStorey'):
+                    child_storey = get_unique_name(child, storeys)
+                    storeys.add(child_storey)
+                spatial_index[child.GlobalId] = (building_name, child_storey)
+                stack.append((child, child_storey))
+    return spatial_index
+
+
+def get_site_properties(buildings, site_name):
+    '''
+    Properties of a site: those of its building if it has one, else
+    the values its buildings share (``Various`` where they differ), with
+    the site name as ``BuildingID``.
+
+    :param buildings:
+        dict;
+        The properties of each building, added as ``Buildings``.
+
+    '''
+    if len(buildings) == 1:
+        site_properties = dict(next(iter(buildings.values())))
+    else:
+        site_properties = {}
+        for properties in buildings.values():
+            for name, value in properties.items():
+                site_properties[name] = value if site_properties.get(name, value) == value else 'Various'
+        site_properties['BuildingID'] = site_name or '%d Buildings' % len(buildings)
+    site_properties['Buildings'] = buildings
+    return site_properties
+
+
+#
+# Carbon Computation
+#
+
+# Columns of the layer table
+LAYER_COLUMNS = ('Element', 'GlobalId', 'Category', 'IsExternal', 'Quantity', 'UnitCarbon',
+                 'Layer', 'LayerThickness', 'EmbodiedCarbon', 'MassDensity', 'Building', 'Storey')
+# Typed arrays of an ElementStore with their array typecodes, per element and per layer.
+# Names are stored as codes into the string tables, the layer code of elements without layers is -1
+ELEMENT_ARRAYS = {'Name': 'i', 'Category': 'i', 'IsExternal': 'b', 'Quantity': 'd', 'Building': 'i', 'Storey': 'i'}
+LAYER_ARRAYS = {'Element': 'i', 'Layer': 'i', 'LayerThickness': 'd', 'EmbodiedCarbon': 'd', 'MassDensity': 'd',
+                'UnitCarbon': 'd'}
+STRING_TABLES = ('Name', 'Category', 'Layer', 'Building', 'Storey')
+
+
+class StringTable:
+    # Strings interned to integer codes in order of first use
+    __slots__ = ('codes', 'strings')
+
+    def __init__(self, strings=()):
+        self.codes = {}
+        self.strings = []
+        for string in strings:
+            self.intern(string)
+
+    def intern(self, string):
+        code = self.codes.get(string)
+        if code is None:
+            code = self.codes[string] = len(self.strings)
+            self.strings.append(string)
+        return code
+
+
+def to_float(value):
+    # Property values may be missing or text
+    return np.nan if value is None else float(value)
+
+
+class ElementStore:
+    '''
+    Compact store of extracted elements and their material layers.
+
+    Every element is stored once, with its GlobalId, and every layer
+    refers to its element by index. Names, categories, materials,
+    buildings and storeys are interned to integer codes and all numbers
+    and codes are kept in typed arrays, so a store takes about half the
+    memory of lists of per layer values and is pickled to and from
+    extraction workers as a few buffers.
+
+    Elements without material layers have a single layer with no name.
+
+    '''
+    __slots__ = ('global_ids', 'elements', 'layers', 'strings', 'element_index')
+
+    def __init__(self):
+        self.global_ids = []
+        self.elements = {column: array.array(typecode) for column, typecode in ELEMENT_ARRAYS.items()}
+        self.layers = {column: array.array(typecode) for column, typecode in LAYER_ARRAYS.items()}
+        self.strings = {column: StringTable() for column in STRING_TABLES}
+        self.element_index = None
+
+    def __len__(self):
+        # Number of layers, as in rows of the layer table
+        return len(self.layers['Element'])
+
+    @property
+    def element_count(self):
+        return len(self.global_ids)
+
+    def add_element(self, element, category, is_external, quantity):
+        # Add an element outside of any building or storey, returning its index
+        self.global_ids.append(element.GlobalId)
+        self.elements['Name'].append(self.strings['Name'].intern(element.Name or ''))
+        self.elements['Category'].append(self.strings['Category'].intern(category))
+        self.elements['IsExternal'].append(bool(is_external))
+        self.elements['Quantity'].append(to_float(quantity))
+        self.elements['Building'].append(self.strings['Building'].intern(''))
+        self.elements['Storey'].append(self.strings['Storey'].intern(''))
+        self.element_index = None
+        return len(self.global_ids) - 1
+
+    def add_layer(self, element_number, name=None, thickness=np.nan, embodied_carbon=np.nan, mass_density=np.nan,
+                  unit_carbon=None):
+        # Add one material layer of an element, composite elements have no layer thickness
+        if unit_carbon is None:
+            unit_carbon = np.nan if name is None else get_unit_carbon(thickness, embodied_carbon, mass_density)
+        self.layers['Element'].append(element_number)
+        self.layers['Layer'].append(-1 if name is None else self.strings['Layer'].intern(name))
+        self.layers['LayerThickness'].append(to_float(thickness))
+        self.layers['EmbodiedCarbon'].append(to_float(embodied_carbon))
+        self.layers['MassDensity'].append(to_float(mass_density))
+        self.layers['UnitCarbon'].append(to_float(unit_carbon))
+
+    def find(self, global_id):
+        # Index of the element with a GlobalId, None if not stored
+        if self.element_index is None:
+            self.element_index = {global_id: number for number, global_id in enumerate(self.global_ids)}
+        return self.element_index.get(global_id)
+
+    def material_names(self):
+        # Distinct names of the layers, in order of first use
+        return list(self.strings['Layer'].strings)
+
+    def layer_names(self):
+        # Names of the layers, None for elements without layers
+        strings = self.strings['Layer'].strings
+        return [strings[code] if code >= 0 else None for code in self.layers['Layer']]
+
+    def extend(self, other):
+        # Append the elements and layers of another store, recoding its interned strings
+        element_offset = len(self.global_ids)
+        recode = {column: array.array('i', (self.strings[column].intern(string) for string in other.strings[column].strings))
+                  for column in STRING_TABLES}
+        self.global_ids.extend(other.global_ids)
+        for column, values in other.elements.items():
+            if column in recode:
+                values = array.array('i', (recode[column][code] for code in values))
+            self.elements[column].extend(values)
+        self.layers['Element'].extend(array.array('i', (number + element_offset for number in other.layers['Element'])))
+        self.layers['Layer'].extend(array.array('i', (recode['Layer'][code] if code >= 0 else -1
+                                                      for code in other.layers['Layer'])))
+        for column in ('LayerThickness', 'EmbodiedCarbon', 'MassDensity', 'UnitCarbon'):
+            self.layers[column].extend(other.layers[column])
+        self.element_index = None
+
+    def to_arrays(self):
+        # The store as numpy arrays keyed by column, for saving
+        arrays = {'GlobalId': np.array(self.global_ids, dtype=str)}
+        for prefix, columns in (('Element', self.elements), ('Layer', self.layers)):
+            for column, values in columns.items():
+                arrays['%s.%s' % (prefix, column)] = np.array(values, dtype=values.typecode)
+        for column, table in self.strings.items():
+            arrays['Strings.%s' % column] = np.array(table.strings, dtype=str)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        store = cls()
+        store.global_ids = arrays['GlobalId'].tolist()
+        for prefix, columns in (('Element', store.elements), ('Layer', store.layers)):
+            for column, values in columns.items():
+                values.frombytes(arrays['%s.%s' % (prefix, column)].astype(values.typecode).tobytes())
+        for column in STRING_TABLES:
+            store.strings[column] = StringTable(arrays['Strings.%s' % column].tolist())
+        return store
+
+
+def get_unit_carbon(thickness, embodied_carbon, mass_density):
+    # Carbon per m^2 of a layer (thickness in mm), or per m^3 of a composite element without thickness
+    if np.isnan(thickness):
+        return float(embodied_carbon) * float(mass_density)
+    return thickness / 1000. * float(embodied_carbon) * float(mass_density)
+
+
+def get_categorical(codes, categories):
+    # Categorical column of interned codes, -1 is missing
+    import pandas as pd
+    return pd.Categorical.from_codes(codes, categories=pd.Index(categories, dtype=object))
+
+
+def get_element_categorical(element_numbers, values):
+    # Categorical layer column of a string per element, whose values need not be unique
+    import pandas as pd
+    codes, categories = pd.factorize(np.array(values, dtype=object))
+    return get_categorical(codes[element_numbers], categories)
+
+
+def build_layer_table(element_store):
+    '''
+    Build the layer table from an element store and compute the carbon
+    of every layer.
+
+    Element values are repeated for each of their layers and all text
+    columns are categorical, so the table holds codes rather than a
+    string per layer.
+
+    :param element_store:
+        ElementStore;
+        The extracted elements. Elements without material layers have a
+        single row with no ``Layer``.
+
+    :returns:
+        pandas.DataFrame;
+        One row per material layer with the columns ``LAYER_COLUMNS``
+        and the additional columns ``Material`` (stripped layer name),
+        ``ElementGroup`` (e.g. ``ExternalWall``) and ``Carbon``.
+
+    '''
+    import pandas as pd
+    elements = {column: np.array(values, dtype=values.typecode) for column, values in element_store.elements.items()}
+    layers = {column: np.array(values, dtype=values.typecode) for column, values in element_store.layers.items()}
+    strings = {column: table.strings for column, table in element_store.strings.items()}
+    element_numbers = layers['Element']
+    names = strings['Name']
+    layer_table = pd.DataFrame({
+        'Element': get_element_categorical(element_numbers, ['%s (%s)' % (names[name], global_id) for name, global_id in
+                                                             zip(elements['Name'].tolist(), element_store.global_ids)]),
+        'GlobalId': get_element_categorical(element_numbers, element_store.global_ids),
+        'Category': get_categorical(elements['Category'][element_numbers], strings['Category']),
+        'IsExternal': elements['IsExternal'][element_numbers].astype(bool),
+        'Quantity': elements['Quantity'][element_numbers],
+        'UnitCarbon': layers['UnitCarbon'],
+        'Layer': get_categorical(layers['Layer'], strings['Layer']),
+        'LayerThickness': layers['LayerThickness'],
+        'EmbodiedCarbon': layers['EmbodiedCarbon'],
+        'MassDensity': layers['MassDensity'],
+        'Building': get_categorical(elements['Building'][element_numbers], strings['Building']),
+        'Storey': get_categorical(elements['Storey'][element_numbers], strings['Storey']),
+    }, columns=list(LAYER_COLUMNS))
+    # Layer names differing only by surrounding spaces share a material
+    material_codes, materials = pd.factorize(np.array([name.strip() for name in strings['Layer']], dtype=object))
+    layer_table['Material'] = get_categorical(np.append(material_codes, -1)[layers['Layer']], materials)
+    categories = strings['Category']
+    layer_table['ElementGroup'] = get_categorical(elements['Category'][element_numbers] * 2 + layer_table['IsExternal'].to_numpy(),
+                                                  [group for category in categories for group in (category, 'External' + category)])
+    layer_table['Carbon'] = compute_layer_carbon(layer_table)
+    return layer_table
+
+
+def compute_layer_carbon(layer_table):
+    # Carbon per m^2 (layers) or m^3 (composites) times the area or volume of the element
+    with np.errstate(invalid='ignore'):
+        carbon = layer_table['UnitCarbon'].to_numpy() * layer_table['Quantity'].to_numpy()
+    return np.where(layer_table['Layer'].isna().to_numpy(), 0., carbon)
+
+
+def get_potential_ratios(material_records, min_ec_dict):
+    # Ratio of the minimum EC_Per_Volume of the class to the EC_Per_Volume of each material found in the database
+    return {name: min_ec_dict[name] / float(record['EC_Per_Volume'])
+            for name, record in material_records.items() if record is not None}
+
+
+def compute_potential_carbon(layer_table, potential_ratios):
+    # Materials without a database record keep their current carbon
+    return layer_table['Carbon'].to_numpy() * layer_table['Material'].map(potential_ratios).fillna(1.).to_numpy()
+
+
+def aggregate_layer_table(layer_table, key, value='Carbon'):
+    # Sum a carbon column of all material layers grouped by `key`, in order of first appearance
+    layers = layer_table[layer_table['Layer'].notna()]
+    return layers.groupby(key, sort=False)[value].sum().to_dict()
+
+
+def get_building_area_internal(layer_table):
+    # Sum of the area of internal slabs
+    elements = layer_table.drop_duplicates('GlobalId')
+    return elements.loc[(elements['Category'] == 'Slab') & ~elements['IsExternal'], 'Quantity'].sum()
+
+
+#
+# Geometry Quantities
+#
+
+# Minimum cosine between a face normal and a direction for the face to count towards the area in that direction
+FACE_DIRECTION_TOLERANCE = 0.9
+
+
+def get_shape_quantities(vertices, faces):
+    '''
+    Compute the quantities pycab reads from ``BaseQuantities`` from a
+    triangulated shape in the local coordinates of its element, where
+    walls run along X or Y and slabs lie in the XY plane.
+
+    :param vertices:
+        sequence;
+        The flat x, y, z coordinates of the vertices in m.
+
+    :param faces:
+        sequence;
+        The flat vertex indices of the triangles.
+
+    :returns:
+        dict;
+        ``NetSideArea``, the largest area facing a horizontal axis,
+        ``NetArea``, the area facing up, and the enclosed volume as
+        ``Volume`` and ``NetVolume``.
+
+    '''
+    triangles = np.asarray(vertices, dtype=float).reshape(-1, 3)[np.asarray(faces, dtype=np.int64).reshape(-1, 3)]
+    cross = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+    double_areas = np.linalg.norm(cross, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        normals = cross / double_areas[:, None]
+    areas = double_areas / 2.
+    # Signed volumes of the tetrahedra spanned with the origin
+    volume = abs(np.einsum('ij,ij->i', triangles[:, 0], np.cross(triangles[:, 1], triangles[:, 2])).sum()) / 6.
+    side_areas = [areas[normals[:, axis] * sign > FACE_DIRECTION_TOLERANCE].sum() for axis in (0, 1) for sign in (1, -1)]
+    return {
+        'NetSideArea': float(max(side_areas)),
+        'NetArea': float(areas[normals[:, 2] > FACE_DIRECTION_TOLERANCE].sum()),
+        'Volume': float(volume),
+        'NetVolume': float(volume)
+    }
+
+
+# Quantities of elements whose geometry can not be measured
+EMPTY_QUANTITIES = {'NetSideArea': 0., 'NetArea': 0., 'Volume': 0., 'NetVolume': 0.}
+
+
+def add_shape_quantities(quantities, shape_quantities, shape):
+    # Measure a tessellated shape, once per representation
+    geometry = shape.geometry
+    if geometry.id not in shape_quantities:
+        shape_quantities[geometry.id] = get_shape_quantities(geometry.verts, geometry.faces)
+        profiler.count('GeometryMisses')
+    else:
+        profiler.count('GeometryHits')
+    quantities[shape.id] = shape_quantities[geometry.id]
+
+
+def compute_geometry_quantities(ifc_file, elements, threads=None):
+    '''
+    Compute the quantities of elements from their geometry, running
+    the ifcopenshell geometry iterator over only these elements in
+    `threads` threads (all processors by default). Elements sharing a
+    representation, e.g. through a type's mapped items, are
+    tessellated and measured once.
+
+    If the iterator fails, the elements are tessellated one by one.
+    Elements that have no body geometry (e.g. stairs whose geometry is
+    on their flights) or fail to tessellate get ``EMPTY_QUANTITIES``
+    with a warning.
+
+    :returns:
+        dict;
+        The quantities of :func:`get_shape_quantities` by element id.
+
+    '''
+    import ifcopenshell.geom
+    settings = ifcopenshell.geom.settings()
+    elements = list(elements)
+    quantities = {}
+    shape_quantities = {}
+    try:
+        iterator = ifcopenshell.geom.iterator(settings, ifc_file, threads or os.cpu_count() or 1, include=elements)
+        if iterator.initialize():
+            while True:
+                add_shape_quantities(quantities, shape_quantities, iterator.get())
+                if not iterator.next():
+                    break
+    except RuntimeError as error:
+        print('WARNING: geometry iterator failed (%s), measuring elements one by one' % error)
+        for element in elements:
+            if element.id() not in quantities:
+                try:
+                    add_shape_quantities(quantities, shape_quantities, ifcopenshell.geom.create_shape(settings, element))
+                except RuntimeError:
+                    pass
+    for element in elements:
+        if element.id() not in quantities:
+            print('WARNING: could not compute the quantities of %s %s from its geometry, using 0' % (
+                element.is_a(), element.GlobalId))
+            quantities[element.id()] = dict(EMPTY_QUANTITIES)
+    return quantities
+
+
+def get_missing_quantity_elements(ifc_file, index=None, elements=None):
+    '''
+    Find the elements without ``BaseQuantities``.
+
+    :param index:
+        DefinitionIndex;
+        The definition index of `ifc_file`. Without one, only the
+        ``IfcRelDefinesByProperties`` of ``BaseQuantities`` are read.
+
+    :param elements:
+        list;
+        The elements to check, those of ``EXTRACTION_SECTIONS`` by
+        default.
+
+    '''
+    if elements is None:
+        elements = [element for _, ifc_type, _ in EXTRACTION_SECTIONS for element in ifc_file.by_type(ifc_type)]
+    if index is not None:
+        return [element for element in elements
+                if 'BaseQuantities' not in get_definitions(element, index)['ElementQuantities']]
+    measured = set()
+    for definition in ifc_file.by_type('IfcRelDefinesByProperties'):
+        related_data = definition.RelatingPropertyDefinition
+        if related_data.is_a('IfcElementQuantity') and related_data.Name == 'BaseQuantities':
+            measured.update(element.id() for element in definition.RelatedObjects)
+    return [element for element in elements if element.id() not in measured]
+
+
+def add_geometry_quantities(ifc_file, index=None, threads=None, elements=None):
+    '''
+    Compute quantities from geometry for the elements without
+    ``BaseQuantities``, and complete the definition index with them if
+    one is given, see :func:`get_missing_quantity_elements`.
+
+    :returns:
+        dict;
+        The computed quantities by element id.
+
+    '''
+    missing_elements = get_missing_quantity_elements(ifc_file, index, elements)
+    if not missing_elements:
+        return {}
+    print('Processing Geometry...')
+    with profiler.stage('Processing Geometry'):
+        quantities = compute_geometry_quantities(ifc_file, missing_elements, threads)
+    if index is not None:
+        set_geometry_quantities(index, quantities)
+    return quantities
+
+
+def set_geometry_quantities(index, quantities):
+    for element_id, element_quantities in quantities.items():
+        index.setdefault(element_id, new_definition_entry())['BaseQuantities'] = element_quantities
+
+#
+# Extraction
+#
+
+def resolve_wall_layers(wall, index=None):
+    # (name, thickness, embodied carbon, mass density) of the material layers of a wall
+    material_properties = get_material_properties(wall, index)
+    return [(material_layer['Name'], material_layer['LayerThickness'],
+             material_properties[material_layer['Name']]['EmbodiedCarbon'],
+             material_properties[material_layer['Name']]['MassDensity'])
+            for material_layer in yield_material_layers(wall, index=index)]
+
+
+def resolve_slab_layers(slab, index=None):
+    # (name, thickness, embodied carbon, mass density) of the material layers or roof components of a slab
+    material_properties = get_material_properties(slab, index)
+    material_names = get_material_names(slab, index)
+    layers = []
+    for material_layer in yield_material_layers(slab, material_names, index):
+        if material_layer['Name'] in material_properties:
+            material_name = material_layer['Name']
+        else:
+            material_name = material_names[material_layer['Name']]
+        layers.append((material_name, material_layer['LayerThickness'],
+                       material_properties[material_name]['EmbodiedCarbon'],
+                       material_properties[material_name]['MassDensity']))
+    return layers
+
+
+def get_build_up_key(element, index=None):
+    # Ids of the definitions the layers of an element are resolved from
+    definitions = get_definitions(element, index)
+    if definitions['SlabType'] == 'ROOF':
+        layer_ids = tuple(related_data.id() for related_data in definitions['ElementQuantities'].get('Component Quantities', []))
+    else:
+        layer_ids = tuple(assoc.RelatingMaterial.ForLayerSet.id() for assoc in element.HasAssociations
+                          if assoc.is_a('IfcRelAssociatesMaterial') and assoc.RelatingMaterial.is_a('IfcMaterialLayerSetUsage'))
+    property_ids = tuple(related_data.id() for related_data in definitions['PropertySets'].get('Material Properties', []))
+    return definitions['SlabType'] == 'ROOF', layer_ids, property_ids
+
+
+class BuildUpCache:
+    '''
+    Memoize the layers of material build-ups shared between elements.
+
+    Elements with the same ``IfcMaterialLayerSet`` (or roof
+    ``Component Quantities``) and ``Material Properties`` resolve to
+    the same layers, so each build-up is resolved once and stored with
+    the carbon per m² of every layer. An element then only multiplies
+    by its own area.
+
+    '''
+
+    def __init__(self):
+        self.build_ups = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, element, resolve, index=None):
+        # Layers of an element as (name, thickness, embodied carbon, mass density, unit carbon)
+        key = (resolve.__name__,) + get_build_up_key(element, index)
+        build_up = self.build_ups.get(key)
+        if build_up is None:
+            build_up = self.build_ups[key] = resolve_build_up(element, resolve, index)
+            self.misses += 1
+            profiler.count('BuildUpMisses')
+        else:
+            self.hits += 1
+            profiler.count('BuildUpHits')
+        return build_up
+
+    @property
+    def hit_rate(self):
+        return self.hits / max(1, self.hits + self.misses)
+
+
+def resolve_build_up(element, resolve, index=None):
+    return [(name, thickness, embodied_carbon, mass_density, get_unit_carbon(thickness, embodied_carbon, mass_density))
+            for name, thickness, embodied_carbon, mass_density in resolve(element, index)]
+
+
+def get_build_up(element, resolve, index=None):
+    # Look up the build-up of an element in the cache of the definition index, if any
+    if isinstance(index, DefinitionIndex):
+        return index.build_ups.get(element, resolve, index)
+    return resolve_build_up(element, resolve, index)
+
+
+def extract_layers(element_store, element, category, quantity, resolve, index=None):
+    element_number = element_store.add_element(element, category, get_is_external(element, index), quantity)
+    build_up = get_build_up(element, resolve, index)
+    for name, thickness, embodied_carbon, mass_density, unit_carbon in build_up:
+        element_store.add_layer(element_number, name, thickness, embodied_carbon, mass_density, unit_carbon)
+    if not build_up:
+        element_store.add_layer(element_number)
+
+
+def extract_wall(element_store, wall, index=None):
+    quantities = get_extent(wall, index)
+    extract_layers(element_store, wall, 'Wall', quantities['NetSideArea'], resolve_wall_layers, index)
+
+
+def extract_slab(element_store, slab, index=None):
+    category = 'Roof' if get_element_type(slab, index) == 'ROOF' else 'Slab'
+    quantities = get_extent(slab, index)
+    extract_layers(element_store, slab, category, quantities['NetArea'], resolve_slab_layers, index)
+
+
+def extract_composite(element_store, element, category, composite_layer, volume_name, index=None):
+    quantities = get_extent(element, index)
+    element_properties = get_element_properties(element, index)
+    if composite_layer is None:
+        composite_layer = 'External Door Composite' if element_properties['IsExternal'] else 'Internal Door Composite'
+    element_number = element_store.add_element(element, category, element_properties['IsExternal'], quantities[volume_name])
+    element_store.add_layer(element_number, composite_layer,
+                            embodied_carbon=element_properties['Element']['EmbodiedCarbon'],
+                            mass_density=element_properties['Element']['MassDensity'])
+
+
+def extract_door(element_store, door, index=None):
+    extract_composite(element_store, door, 'Door', None, 'Volume', index)
+
+
+def extract_window(element_store, window, index=None):
+    extract_composite(element_store, window, 'Window', 'Window Composite', 'Volume', index)
+
+
+def extract_stair(element_store, stair, index=None):
+    extract_composite(element_store, stair, 'Stair', 'Stair Composite', 'NetVolume', index)
+
+
+# (section name, IFC type, extractor) in processing order
+EXTRACTION_SECTIONS = (
+    ('Walls', 'IfcWall', extract_wall),
+    ('Slabs/Roofs', 'IfcSlab', extract_slab),
+    ('Doors', 'IfcDoor', extract_door),
+    ('Windows/Skylights', 'IfcWindow', extract_window),
+    ('Stairs', 'IfcStair', extract_stair),
+)
+
+# Per process state of extraction workers
+extraction_worker = {}
+
+
+def init_extraction_worker(ifc_path, geometry_quantities=None):
+    # Each worker parses the file and indexes its definitions once
+    import ifcopenshell
+    extraction_worker['ifc_file'] = ifcopenshell.open(ifc_path)
+    extraction_worker['index'] = build_definition_index(extraction_worker['ifc_file'])
+    set_geometry_quantities(extraction_worker['index'], geometry_quantities or {})
+
+
+def extract_chunk(task):
+    # Extract a chunk of elements of one section inside a worker
+    section_number, element_ids = task
+    _, _, extractor = EXTRACTION_SECTIONS[section_number]
+    element_store = ElementStore()
+    for element_id in element_ids:
+        extractor(element_store, extraction_worker['ifc_file'].by_id(element_id), extraction_worker['index'])
+    return element_store
+
+
+def extract_section(element_store, section, elements, extractor, index=None):
+    # Extract the elements of one section, timing every element when profiling
+    with profiler.stage('Processing %s' % section):
+        layer_count = len(element_store)
+        if profiler.enabled:
+            for element in elements:
+                start = time.perf_counter()
+                extractor(element_store, element, index)
+                profiler.add_element(time.perf_counter() - start, section, element)
+        else:
+            for element in elements:
+                extractor(element_store, element, index)
+        profiler.count('Elements', len(elements))
+        profiler.count('Layers', len(element_store) - layer_count)
+
+
+def assign_spatial_columns(element_store, spatial_index):
+    # Set the building and storey of the extracted elements from their GlobalId
+    buildings, storeys = element_store.strings['Building'], element_store.strings['Storey']
+    locations = [spatial_index.locate(global_id) for global_id in element_store.global_ids]
+    element_store.elements['Building'] = array.array('i', (buildings.intern(building) for building, _ in locations))
+    element_store.elements['Storey'] = array.array('i', (storeys.intern(storey) for _, storey in locations))
+
+
+def split_chunks(items, chunk_count):
+    chunk_size = max(1, -(-len(items) // chunk_count))
+    return [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+
+
+def extract_parallel(element_store, ifc_file, ifc_path, jobs, geometry_quantities=None):
+    '''
+    Extract the layers of all sections in a pool of `jobs` processes.
+
+    Element ids are split into chunks which workers extract from their
+    own copy of the file. Chunks are merged in the order of
+    ``by_type``, so `element_store` is identical to a serial run.
+
+    '''
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_extraction_worker,
+                             initargs=(ifc_path, geometry_quantities)) as pool:
+        # Submit all sections up front so workers stay busy
+        section_futures = []
+        element_counts = []
+        for section_number, (_, ifc_type, _) in enumerate(EXTRACTION_SECTIONS):
+            element_ids = [element.id() for element in ifc_file.by_type(ifc_type)]
+            element_counts.append(len(element_ids))
+            section_futures.append([pool.submit(extract_chunk, (section_number, chunk))
+                                    for chunk in split_chunks(element_ids, jobs * 4)])
+        for (section, _, _), futures, element_count in zip(EXTRACTION_SECTIONS, section_futures, element_counts):
+            print('Processing %s...' % section)
+            with profiler.stage('Processing %s' % section):
+                layer_count = len(element_store)
+                for future in futures:
+                    element_store.extend(future.result())
+                profiler.count('Elements', element_count)
+                profiler.count('Layers', len(element_store) - layer_count)
+
+
+#
+# Streaming Extraction
+#
+
+# Entity types kept by the streaming reader, with their attribute names
+ROOT_ATTRIBUTES = ('GlobalId', 'OwnerHistory', 'Name', 'Description')
+ELEMENT_ATTRIBUTES = ROOT_ATTRIBUTES + ('ObjectType', 'ObjectPlacement', 'Representation', 'Tag')
+STREAM_ATTRIBUTES = {
+    'IFCSITE': ROOT_ATTRIBUTES,
+    'IFCBUILDING': ROOT_ATTRIBUTES,
+    'IFCBUILDINGSTOREY': ROOT_ATTRIBUTES,
+    'IFCSPACE': ROOT_ATTRIBUTES,
+    'IFCROOF': ROOT_ATTRIBUTES,
+    'IFCWALL': ELEMENT_ATTRIBUTES,
+    'IFCWALLSTANDARDCASE': ELEMENT_ATTRIBUTES,
+    'IFCWALLELEMENTEDCASE': ELEMENT_ATTRIBUTES,
+    'IFCSLAB': ELEMENT_ATTRIBUTES,
+    'IFCSLABSTANDARDCASE': ELEMENT_ATTRIBUTES,
+    'IFCSLABELEMENTEDCASE': ELEMENT_ATTRIBUTES,
+    'IFCDOOR': ELEMENT_ATTRIBUTES,
+    'IFCDOORSTANDARDCASE': ELEMENT_ATTRIBUTES,
+    'IFCWINDOW': ELEMENT_ATTRIBUTES,
+    'IFCWINDOWSTANDARDCASE': ELEMENT_ATTRIBUTES,
+    'IFCSTAIR': ELEMENT_ATTRIBUTES,
+    'IFCRELDEFINESBYPROPERTIES': ROOT_ATTRIBUTES + ('RelatedObjects', 'RelatingPropertyDefinition'),
+    'IFCRELOVERRIDESPROPERTIES': ROOT_ATTRIBUTES + ('RelatedObjects', 'RelatingPropertyDefinition'),
+    'IFCRELDEFINESBYTYPE': ROOT_ATTRIBUTES + ('RelatedObjects', 'RelatingType'),
+    'IFCRELASSOCIATESMATERIAL': ROOT_ATTRIBUTES + ('RelatedObjects', 'RelatingMaterial'),
+    'IFCRELAGGREGATES': ROOT_ATTRIBUTES + ('RelatingObject', 'RelatedObjects'),
+    'IFCRELCONTAINEDINSPATIALSTRUCTURE': ROOT_ATTRIBUTES + ('RelatedElements', 'RelatingStructure'),
+    'IFCPROPERTYSET': ROOT_ATTRIBUTES + ('HasProperties',),
+    'IFCELEMENTQUANTITY': ROOT_ATTRIBUTES + ('MethodOfMeasurement', 'Quantities'),
+    'IFCPROPERTYSINGLEVALUE': ('Name', 'Description', 'NominalValue', 'Unit'),
+    'IFCPROPERTYENUMERATEDVALUE': ('Name', 'Description'),
+    'IFCPROPERTYBOUNDEDVALUE': ('Name', 'Description'),
+    'IFCPROPERTYLISTVALUE': ('Name', 'Description'),
+    'IFCPROPERTYTABLEVALUE': ('Name', 'Description'),
+    'IFCPROPERTYREFERENCEVALUE': ('Name', 'Description'),
+    'IFCCOMPLEXPROPERTY': ('Name', 'Description', 'UsageName', 'HasProperties'),
+    'IFCQUANTITYLENGTH': ('Name', 'Description', 'Unit', 'LengthValue'),
+    'IFCQUANTITYAREA': ('Name', 'Description', 'Unit', 'AreaValue'),
+    'IFCQUANTITYVOLUME': ('Name', 'Description', 'Unit', 'VolumeValue'),
+    'IFCQUANTITYCOUNT': ('Name', 'Description', 'Unit', 'CountValue'),
+    'IFCQUANTITYWEIGHT': ('Name', 'Description', 'Unit', 'WeightValue'),
+    'IFCQUANTITYTIME': ('Name', 'Description', 'Unit', 'TimeValue'),
+    'IFCPHYSICALCOMPLEXQUANTITY': ('Name', 'Description', 'HasQuantities', 'Discrimination', 'Quality', 'Usage'),
+    'IFCSLABTYPE': ROOT_ATTRIBUTES + ('ApplicableOccurrence', 'HasPropertySets', 'RepresentationMaps', 'Tag',
+                                      'ElementType', 'PredefinedType'),
+    'IFCMATERIALLAYERSETUSAGE': ('ForLayerSet', 'LayerSetDirection', 'DirectionSense', 'OffsetFromReferenceLine'),
+    'IFCMATERIALLAYERSET': ('MaterialLayers', 'LayerSetName'),
+    'IFCMATERIALLAYER': ('Material', 'LayerThickness', 'IsVentilated'),
+    'IFCMATERIAL': ('Name',),
+}
+
+# Supertypes of the kept entity types as far as pycab checks them with is_a
+STREAM_SUPERTYPES = {
+    'IFCWALLSTANDARDCASE': ('IFCWALL',),
+    'IFCWALLELEMENTEDCASE': ('IFCWALL',),
+    'IFCSLABSTANDARDCASE': ('IFCSLAB',),
+    'IFCSLABELEMENTEDCASE': ('IFCSLAB',),
+    'IFCDOORSTANDARDCASE': ('IFCDOOR',),
+    'IFCWINDOWSTANDARDCASE': ('IFCWINDOW',),
+    'IFCRELOVERRIDESPROPERTIES': ('IFCRELDEFINESBYPROPERTIES',),
+    'IFCPROPERTYSINGLEVALUE': ('IFCSIMPLEPROPERTY', 'IFCPROPERTY'),
+    'IFCPROPERTYENUMERATEDVALUE': ('IFCSIMPLEPROPERTY', 'IFCPROPERTY'),
+    'IFCPROPERTYBOUNDEDVALUE': ('IFCSIMPLEPROPERTY', 'IFCPROPERTY'),
+    'IFCPROPERTYLISTVALUE': ('IFCSIMPLEPROPERTY', 'IFCPROPERTY'),
+    'IFCPROPERTYTABLEVALUE': ('IFCSIMPLEPROPERTY', 'IFCPROPERTY'),
+    'IFCPROPERTYREFERENCEVALUE': ('IFCSIMPLEPROPERTY', 'IFCPROPERTY'),
+    'IFCCOMPLEXPROPERTY': ('IFCPROPERTY',),
+    'IFCQUANTITYLENGTH': ('IFCPHYSICALSIMPLEQUANTITY', 'IFCPHYSICALQUANTITY'),
+    'IFCQUANTITYAREA': ('IFCPHYSICALSIMPLEQUANTITY', 'IFCPHYSICALQUANTITY'),
+    'IFCQUANTITYVOLUME': ('IFCPHYSICALSIMPLEQUANTITY', 'IFCPHYSICALQUANTITY'),
+    'IFCQUANTITYCOUNT': ('IFCPHYSICALSIMPLEQUANTITY', 'IFCPHYSICALQUANTITY'),
+    'IFCQUANTITYWEIGHT': ('IFCPHYSICALSIMPLEQUANTITY', 'IFCPHYSICALQUANTITY'),
+    'IFCQUANTITYTIME': ('IFCPHYSICALSIMPLEQUANTITY', 'IFCPHYSICALQUANTITY'),
+    'IFCPHYSICALCOMPLEXQUANTITY': ('IFCPHYSICALQUANTITY',),
+    'IFCPROPERTYSET': ('IFCPROPERTYSETDEFINITION',),
+    'IFCELEMENTQUANTITY': ('IFCPROPERTYSETDEFINITION',),
+}
+
+STEP_ENTITY = re.compile(r'\s*#(\d+)\s*=\s*([A-Za-z0-9_]+)\s*\((.*)\)\s*;\s*$', re.DOTALL)
+STEP_TOKEN = re.compile(r"""\s*(?:(?P<string>'(?:[^']|'')*')|(?P<reference>#\d+)|(?P<enumeration>\.[A-Za-z0-9_]+\.)|"""
+                        r"""(?P<typed>[A-Za-z][A-Za-z0-9_]*)\s*\(|(?P<open>\()|(?P<close>\))|(?P<comma>,)|"""
+                        r"""(?P<null>[$*])|(?P<number>[-+]?[0-9.]+(?:[eE][-+]?[0-9]+)?)|(?P<binary>"[0-9A-Fa-f]*"))""")
+STEP_STRING_OR_COMMENT = re.compile(r"'(?:[^']|'')*'|/\*.*?\*/", re.DOTALL)
+STEP_STRING_ESCAPE = re.compile(r"\\X2\\((?:[0-9A-Fa-f]{4})+)\\X0\\|\\X4\\((?:[0-9A-Fa-f]{8})+)\\X0\\|"
+                                r"\\X\\([0-9A-Fa-f]{2})|\\S\\(.)|\\P[A-I]\\|\\\\")
+
+
+def decode_step_string(string):
+    # Decode the quoting and the \X2\, \X4\, \X\ and \S\ escapes of a STEP string
+    def replace(match):
+        if match.group(1):
+            return bytes.fromhex(match.group(1)).decode('utf-16-be')
+        if match.group(2):
+            return bytes.fromhex(match.group(2)).decode('utf-32-be')
+        if match.group(3):
+            return bytes.fromhex(match.group(3)).decode('latin-1')
+        if match.group(4):
+            return chr(ord(match.group(4)) + 128)
+        return '\\' if match.group(0) == '\\\\' else ''
+    return STEP_STRING_ESCAPE.sub(replace, string[1:-1].replace("''", "'"))
+
+
+class StreamReference:
+    __slots__ = ('step_id',)
+
+    def __init__(self, step_id):
+        self.step_id = step_id
+
+
+class StreamValue:
+    # A typed value such as IFCLABEL('...'), mirroring ``wrappedValue`` of ifcopenshell
+    __slots__ = ('type', 'wrappedValue')
+
+    def __init__(self, type, wrapped_value):
+        self.type = type
+        self.wrappedValue = wrapped_value
+
+    def is_a(self, type_name=None):
+        return self.type if type_name is None else self.type == type_name.upper()
+
+
+def parse_step_arguments(text):
+    # Parse the argument list of a STEP entity into python values
+    stack = [[]]
+    typed = [None]
+    position = 0
+    while True:
+        match = STEP_TOKEN.match(text, position)
+        if match is None:
+            if text[position:].strip():
+                raise ValueError('Can not parse STEP arguments: ' + text)
+            break
+        position = match.end()
+        kind = match.lastgroup
+        if kind == 'string':
+            stack[-1].append(decode_step_string(match.group(kind)))
+        elif kind == 'reference':
+            stack[-1].append(StreamReference(int(match.group(kind)[1:])))
+        elif kind == 'enumeration':
+            value = match.group(kind)[1:-1]
+            stack[-1].append({'T': True, 'F': False}.get(value, 'UNKNOWN' if value == 'U' else value))
+        elif kind == 'number':
+            number = match.group(kind)
+            stack[-1].append(float(number) if '.' in number or 'E' in number.upper() else int(number))
+        elif kind == 'null':
+            stack[-1].append(None)
+        elif kind == 'binary':
+            stack[-1].append(match.group(kind)[1:-1])
+        elif kind in ('typed', 'open'):
+            stack.append([])
+            typed.append(match.group('typed').upper() if kind == 'typed' else None)
+        elif kind == 'close':
+            values = stack.pop()
+            type_name = typed.pop()
+            if type_name is None:
+                stack[-1].append(tuple(values))
+            else:
+                stack[-1].append(StreamValue(type_name, values[0] if values else None))
+    return stack[0]
+
+
+class StreamEntity:
+    '''
+    A lightweight entity of a :class:`StreamingModel` exposing the
+    attributes, ``is_a``, ``id`` and the ``IsDefinedBy`` /
+    ``HasAssociations`` inverses the way ifcopenshell does.
+
+    Arguments are parsed when the entity is created, references are
+    resolved on attribute access.
+
+    '''
+    __slots__ = ('model', 'step_id', 'type', 'arguments')
+
+    def __init__(self, model, step_id, type, arguments):
+        self.model = model
+        self.step_id = step_id
+        self.type = type
+        self.arguments = arguments
+
+    def id(self):
+        return self.step_id
+
+    def is_a(self, type_name=None):
+        if type_name is None:
+            return self.type
+        type_name = type_name.upper()
+        return type_name == self.type or type_name in STREAM_SUPERTYPES.get(self.type, ())
+
+    def __getattr__(self, name):
+        if name in ('IsDefinedBy', 'HasAssociations'):
+            return tuple(self.model.by_id(step_id) for step_id in self.model.inverses[name].get(self.step_id, ()))
+        attributes = STREAM_ATTRIBUTES[self.type]
+        if name not in attributes:
+            raise AttributeError(name)
+        position = attributes.index(name)
+        return self.model.resolve(self.arguments[position] if position < len(self.arguments) else None)
+
+    def __repr__(self):
+        return '#%d=%s(...)' % (self.step_id, self.type)
+
+
+class StreamingModel:
+    '''
+    A partial IFC model built by scanning a STEP file once and keeping
+    only the entity types in ``STREAM_ATTRIBUTES``.
+
+    Geometry, placements, representations and all other entities are
+    dropped while reading. Memory is bounded by the text of the kept
+    statements (stored unparsed) plus about 150 bytes of index per kept
+    entity, so peak memory is roughly twice the size of the property
+    set, quantity, material and relationship statements of the file,
+    independent of the geometry. Kept entities are parsed when they are
+    accessed and are not cached.
+
+    '''
+
+    def __init__(self, path):
+        self.statements = {}
+        self.types = {}
+        self.inverses = {'IsDefinedBy': {}, 'HasAssociations': {}}
+        self.schema = None
+        for statement in read_step_statements(path):
+            if self.schema is None and statement.startswith('FILE_SCHEMA'):
+                self.schema = re.findall(r"'([^']*)'", statement)[0]
+                continue
+            match = STEP_ENTITY.match(statement)
+            if match is None:
+                continue
+            step_id, type = int(match.group(1)), match.group(2).upper()
+            if type not in STREAM_ATTRIBUTES:
+                continue
+            self.statements[step_id] = (type, match.group(3))
+            self.types.setdefault(type, []).append(step_id)
+
+        # Inverse relationships of the elements
+        for type, inverse in (('IFCRELDEFINESBYPROPERTIES', 'IsDefinedBy'), ('IFCRELOVERRIDESPROPERTIES', 'IsDefinedBy'),
+                              ('IFCRELDEFINESBYTYPE', 'IsDefinedBy'), ('IFCRELASSOCIATESMATERIAL', 'HasAssociations')):
+            for step_id in self.types.get(type, []):
+                for related_object in self.by_id(step_id).arguments[4]:
+                    self.inverses[inverse].setdefault(related_object.step_id, []).append(step_id)
+        for related in self.inverses.values():
+            for step_ids in related.values():
+                step_ids.sort()
+
+    def by_id(self, step_id):
+        type, text = self.statements[step_id]
+        return StreamEntity(self, step_id, type, parse_step_arguments(text))
+
+    def by_type(self, type_name):
+        # Entities of a type followed by those of its subtypes, each in file order
+        type_name = type_name.upper()
+        types = sorted(type for type in self.types
+                       if type != type_name and type_name in STREAM_SUPERTYPES.get(type, ()))
+        return [self.by_id(step_id) for type in [type_name] + types for step_id in self.types.get(type, [])]
+
+    def resolve(self, value):
+        if isinstance(value, StreamReference):
+            return self.by_id(value.step_id) if value.step_id in self.statements else None
+        if isinstance(value, tuple):
+            return tuple(self.resolve(item) for item in value)
+        return value
+
+
+def strip_step_comments(statement):
+    # Drop the /* */ comments of a statement, or return None when it ends inside a string or comment
+    parts = []
+    position = 0
+    for match in STEP_STRING_OR_COMMENT.finditer(statement):
+        gap = statement[position:match.start()]
+        if "'" in gap or '/*' in gap:
+            return None
+        parts.append(gap)
+        if match.group().startswith("'"):
+            parts.append(match.group())
+        position = match.end()
+    rest = statement[position:]
+    if "'" in rest or '/*' in rest:
+        return None
+    parts.append(rest)
+    return ''.join(parts)
+
+
+def read_step_statements(path, block_size=1 << 20):
+    # Yield the statements of a STEP file one by one, splitting on ';' outside of strings and comments
+    with open(path, 'r', encoding='latin-1') as f:
+        pending = ''
+        for block in iter(lambda: f.read(block_size), ''):
+            parts = (pending + block).split(';')
+            pending = parts.pop()
+            statement = ''
+            for part in parts:
+                statement += part + ';'
+                if '/*' in statement:
+                    # the ';' may be inside a comment, scan the statement properly
+                    stripped = strip_step_comments(statement)
+                    if stripped is not None:
+                        yield stripped.strip()
+                        statement = ''
+                # an odd number of quotes means the ';' is inside a string
+                elif statement.count("'") % 2 == 0:
+                    yield statement.strip()
+                    statement = ''
+            pending = statement + pending
+        if '/*' in pending:
+            # trailing text that ends inside a comment or string is not a statement
+            pending = strip_step_comments(pending) or ''
+        if pending.strip():
+            yield pending.strip()
+
+
+#
+# Extraction Cache
+#
+
+# Increment when the extracted element store changes, so cached extractions are invalidated
+EXTRACTION_VERSION = 4
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'pycab')
+DEFAULT_CACHE_SIZE = 1024 # MB
+
+
+def hash_file(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def get_cache_path(cache_dir, ifc_path):
+    # Cache entries are keyed by the content of the IFC file and the extraction version
+    key = hashlib.sha256(('%d:%s' % (EXTRACTION_VERSION, hash_file(ifc_path))).encode()).hexdigest()
+    return os.path.join(cache_dir, key + '.npz')
+
+
+def save_extraction(cache_path, element_store, building_properties):
+    '''
+    Save an extracted element store and building properties as a
+    compressed ``.npz`` file of typed arrays.
+
+    The file is written under a temporary name and renamed, so
+    concurrent runs never see a partial entry.
+
+    '''
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    arrays = element_store.to_arrays()
+    arrays['BuildingProperties'] = np.array(json.dumps(building_properties))
+    temporary_path = '%s.%d.tmp' % (cache_path, os.getpid())
+    with open(temporary_path, 'wb') as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(temporary_path, cache_path)
+
+
+def load_extraction(cache_path):
+    # Load a cached extraction, None if there is no usable entry
+    try:
+        with np.load(cache_path, allow_pickle=False) as arrays:
+            element_store = ElementStore.from_arrays(arrays)
+            building_properties = json.loads(str(arrays['BuildingProperties']))
+    except (OSError, KeyError, ValueError):
+        return None
+    # Mark the entry as recently used
+    os.utime(cache_path)
+    return element_store, building_properties
+
+
+def evict_cache(cache_dir, cache_size):
+    # Remove least recently used entries until the cache is smaller than `cache_size` MB
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.npz'):
+            stat = os.stat(os.path.join(cache_dir, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total_size <= cache_size * 1024 * 1024:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except FileNotFoundError:
+            pass
+        total_size -= size
+
+
+#
+# Portfolio
+#
+
+# Percentiles of the portfolio shown in the benchmark plot and report
+PORTFOLIO_PERCENTILES = (10, 25, 50, 75, 90)
+# Fewest comparable projects for a portfolio comparison, otherwise the comparison is widened
+PORTFOLIO_MIN_PROJECTS = 10
+# Projects within this many years of construction are comparable
+PORTFOLIO_YEAR_RANGE = 10
+# One row per project (file or building of a site), keyed by the absolute path of the file and shown by its name,
+# its totals per element group and material, and the indexes answering percentile queries by building type and year
+# from the index alone
+PORTFOLIO_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS projects (
+    id INTEGER PRIMARY KEY,
+    ifc_path TEXT NOT NULL,
+    ifc_filename TEXT NOT NULL,
+    building TEXT NOT NULL,
+    recorded TEXT NOT NULL,
+    building_id TEXT,
+    building_type TEXT,
+    year INTEGER,
+    location TEXT,
+    area_internal REAL,
+    ec REAL,
+    ec_per_area REAL,
+    potential_ec REAL,
+    potential_ec_per_area REAL,
+    UNIQUE (ifc_path, building)
+);
+CREATE TABLE IF NOT EXISTS totals (
+    project_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    ec REAL,
+    potential_ec REAL
+);
+CREATE INDEX IF NOT EXISTS projects_type_year ON projects (building_type, year, ec_per_area);
+CREATE INDEX IF NOT EXISTS projects_year ON projects (year, ec_per_area);
+CREATE INDEX IF NOT EXISTS totals_project ON totals (project_id);
+CREATE INDEX IF NOT EXISTS totals_name ON totals (kind, name, ec);
+'''
+
+
+def get_year(value):
+    # Year of a YearOfConstruction property, None if it has none
+    match = re.search(r'\d{4}', str(value or ''))
+    return int(match.group()) if match else None
+
+
+def get_portfolio_value(value):
+    # Totals of results, NULL where missing (null in JSON, empty in CSV, nan per m² without an internal area)
+    value = to_float(value if value != '' else None)
+    return value if np.isfinite(value) else None
+
+
+def get_portfolio_projects(result):
+    # (building, result) of the buildings of a site result, or of the file
+    if 'Buildings' in result:
+        return list(result['Buildings'].items())
+    return [(result.get('Building', ''), result)]
+
+
+class PortfolioStore:
+    '''
+    SQLite store of the results of past runs, to benchmark a building
+    against the portfolio of buildings of the same type and era.
+
+    A project is a file, or a building of a site, identified by the
+    absolute path of the file, and recording it again replaces its
+    results. Results without a path, such as those of summary CSV
+    files, are identified by the file name. Percentiles of ``BuildingECPerAreaInternal``
+    are read from the ``projects_type_year`` index, so a comparison with
+    thousands of projects takes milliseconds.
+
+    Example::
+
+        store = PortfolioStore('portfolio.db')
+        store.record([get_json_result(evaluation)])
+        store.compare(420., 380., {'BuildingType': 'Office', 'YearOfConstruction': '2021'})
+
+    :param path:
+        str;
+        The database file, created if missing.
+
+    '''
+
+    def __init__(self, path):
+        import sqlite3
+        # Concurrent batch workers wait for each other's writes
+        self.connection = sqlite3.connect(path, timeout=60)
+        columns = [column[1] for column in self.connection.execute('PRAGMA table_info(projects)')]
+        if columns and 'ifc_path' not in columns:
+            # Stores of earlier versions keyed projects by file name, which becomes their path
+            self.connection.executescript(
+                'BEGIN; ALTER TABLE projects RENAME TO old_projects; '
+                'DROP INDEX projects_type_year; DROP INDEX projects_year;' + PORTFOLIO_SCHEMA +
+                'INSERT INTO projects SELECT id, ifc_filename, ifc_filename, building, recorded, building_id, '
+                'building_type, year, location, area_internal, ec, ec_per_area, potential_ec, potential_ec_per_area '
+                'FROM old_projects; DROP TABLE old_projects; COMMIT;')
+        self.connection.executescript(PORTFOLIO_SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM projects').fetchone()[0]
+
+    def record(self, results):
+        '''
+        Add or replace the projects of results in one transaction.
+
+        :param results:
+            list;
+            Results in the form of :func:`get_json_result`, the
+            ``Buildings`` of a site are recorded as projects of their own.
+
+        :returns:
+            int;
+            The number of projects recorded.
+
+        '''
+        recorded = datetime.datetime.now().isoformat(timespec='seconds')
+        count = 0
+        with self.connection:
+            for result in results:
+                for building, project in get_portfolio_projects(result):
+                    properties = project.get('BuildingProperties', {})
+                    key = (result.get('IFCPath') or result['IFCFilename'], building)
+                    self.connection.execute('DELETE FROM totals WHERE project_id IN '
+                                            '(SELECT id FROM projects WHERE ifc_path = ? AND building = ?)', key)
+                    self.connection.execute('DELETE FROM projects WHERE ifc_path = ? AND building = ?', key)
+                    project_id = self.connection.execute(
+                        'INSERT INTO projects (ifc_path, ifc_filename, building, recorded, building_id, building_type, year, '
+                        'location, area_internal, ec, ec_per_area, potential_ec, potential_ec_per_area) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        key[:1] + (result['IFCFilename'], building, result.get('Recorded', recorded), properties.get('BuildingID'),
+                               properties.get('BuildingType') or None, get_year(properties.get('YearOfConstruction')),
+                               properties.get('Location')) +
+                        tuple(get_portfolio_value(project[column]) for column in SUMMARY_COLUMNS if column != 'IFCFilename')).lastrowid
+                    self.connection.executemany(
+                        'INSERT INTO totals VALUES (?, ?, ?, ?, ?)',
+                        [(project_id, kind, name, float(counts['Current']), float(counts['Potential']))
+                         for kind in ('Elements', 'Materials') for name, counts in project.get(kind, {}).items()])
+                    count += 1
+        return count
+
+    def select(self, building_type=None, year=None, exclude=None):
+        '''
+        The ``BuildingECPerAreaInternal`` of the projects of a building
+        type, built within ``PORTFOLIO_YEAR_RANGE`` years of `year`.
+
+        :param exclude:
+            tuple;
+            The (IFC path, building) of a project to leave out, usually
+            the one being compared.
+
+        :returns:
+            numpy.ndarray;
+            The sorted values.
+
+        '''
+        query = 'SELECT ec_per_area FROM projects WHERE ec_per_area IS NOT NULL'
+        parameters = []
+        if building_type is not None:
+            query += ' AND building_type = ?'
+            parameters.append(building_type)
+        if year is not None:
+            query += ' AND year BETWEEN ? AND ?'
+            parameters += [year - PORTFOLIO_YEAR_RANGE, year + PORTFOLIO_YEAR_RANGE]
+        if exclude is not None:
+            query += ' AND NOT (ifc_path = ? AND building = ?)'
+            parameters += list(exclude)
+        values = np.array([value for value, in self.connection.execute(query, parameters)], dtype=float)
+        values.sort()
+        return values
+
+    def compare(self, value, potential_value, building_properties, exclude=None):
+        '''
+        Place a building among the comparable projects of the portfolio.
+
+        Projects of the same building type and era are compared first,
+        then of the same type and then all projects, until at least
+        ``PORTFOLIO_MIN_PROJECTS`` are found.
+
+        :param value:
+            float;
+            The ``BuildingECPerAreaInternal`` of the building.
+
+        :param potential_value:
+            float;
+            Its ``BuildingPotentialECPerAreaInternal``.
+
+        :returns:
+            dict;
+            The ``Count``, ``BuildingType`` and ``Years`` of the compared
+            projects (None where not filtered), the ``Percentiles`` of
+            ``PORTFOLIO_PERCENTILES`` and the ``Rank`` and
+            ``PotentialRank``, the percentage of projects with less
+            carbon per m², or None if the portfolio is too small.
+
+        '''
+        building_type = building_properties.get('BuildingType') or None
+        year = get_year(building_properties.get('YearOfConstruction'))
+        scopes = [(building_type, year), (building_type, None), (None, None)]
+        for scope_type, scope_year in dict.fromkeys(scopes):
+            values = self.select(scope_type, scope_year, exclude)
+            if len(values) >= PORTFOLIO_MIN_PROJECTS:
+                break
+        else:
+            return None
+        return {
+            'Count': len(values),
+            'BuildingType': scope_type,
+            'Years': None if scope_year is None else [scope_year - PORTFOLIO_YEAR_RANGE, scope_year + PORTFOLIO_YEAR_RANGE],
+            'Percentiles': dict(zip(PORTFOLIO_PERCENTILES, np.percentile(values, PORTFOLIO_PERCENTILES).tolist())),
+            'Rank': 100. * np.searchsorted(values, value) / len(values),
+            'PotentialRank': 100. * np.searchsorted(values, potential_value) / len(values),
+        }
+
+
+def compare_portfolio(portfolio, evaluation, building_properties, ifc_path, building=''):
+    # Portfolio comparison of an evaluated building, None without a portfolio or an internal area
+    if portfolio is None or not np.isfinite(evaluation['BuildingECPerAreaInternal']):
+        return None
+    store = PortfolioStore(portfolio)
+    try:
+        return store.compare(evaluation['BuildingECPerAreaInternal'], evaluation['BuildingPotentialECPerAreaInternal'],
+                             building_properties, (os.path.abspath(ifc_path), building))
+    finally:
+        store.close()
+
+
+def record_portfolio(portfolio, evaluation):
+    # Record an evaluation of evaluate_ifc_file to the portfolio store
+    store = PortfolioStore(portfolio)
+    try:
+        store.record([get_json_result(evaluation)])
+    finally:
+        store.close()
+
+
+def read_portfolio_results(path):
+    '''
+    Read historical results for :meth:`PortfolioStore.record`.
+
+    :param path:
+        str;
+        The ``--format json`` output of one or several files (a JSON
+        object, list or one object per line), or a CSV file such as
+        ``reports/summary.csv`` with the ``SUMMARY_COLUMNS`` and
+        optionally ``Building`` and the ``REPORT_PROPERTIES``.
+
+    :returns:
+        list;
+        The results, without the files that failed.
+
+    '''
+    if path.endswith('.csv'):
+        import pandas as pd
+        table = pd.read_csv(path, keep_default_na=False, dtype=str)
+        results = [{
+            'IFCFilename': row['IFCFilename'],
+            'Building': row.get('Building', ''),
+            'BuildingProperties': {name: row[name] for name in REPORT_PROPERTIES if name in row},
+            **{column: float(row[column] or 'nan') for column in SUMMARY_COLUMNS if column != 'IFCFilename'}
+        } for row in table.to_dict(orient='records') if not row.get('Error')]
+    else:
+        with open(path) as f:
+            text = f.read()
+        try:
+            results = json.loads(text)
+        except json.JSONDecodeError:
+            results = [json.loads(line) for line in text.splitlines() if line.strip()]
+        if isinstance(results, dict):
+            results = [results]
+        results = [result for result in results if not result.get('Error')]
+    return results
+
+
+def import_portfolio(portfolio, paths):
+    # Bulk import the results of past runs into the portfolio store
+    store = PortfolioStore(portfolio)
+    try:
+        with profiler.stage('Portfolio Import'):
+            count = sum(store.record(read_portfolio_results(path)) for path in paths)
+        print('Imported %d projects into %s (%d projects)' % (count, portfolio, len(store)))
+    finally:
+        store.close()
+    return count
+
+
+#
+# Pipeline
+#
+
+# Columns of the summary of an evaluated file
+SUMMARY_COLUMNS = ('IFCFilename', 'BuildingAreaInternal', 'BuildingEC', 'BuildingECPerAreaInternal',
+                   'BuildingPotentialEC', 'BuildingPotentialECPerAreaInternal')
+
+
+def load_model(ifc_path, stream=False):
+    # Open an IFC file with ifcopenshell, or as a bounded memory StreamingModel
+    with profiler.stage('Open Model'):
+        if stream:
+            return StreamingModel(ifc_path)
+        import ifcopenshell
+        return ifcopenshell.open(ifc_path)
+
+
+def get_project_properties(ifc_file, spatial_index=None):
+    # Check the project is supported and return the properties of its site and buildings, see get_site_properties
+    print('Processing Project...')
+    with profiler.stage('Processing Project'):
+        if spatial_index is None:
+            spatial_index = build_spatial_index(ifc_file)
+        building_properties = get_site_properties({name: get_building_properties(building)
+                                                   for name, building in spatial_index.buildings.items()},
+                                                  spatial_index.site_name)
+
+    #print('Processing Roofs...')
+    roofs = ifc_file.by_type('IfcRoof')
+    if len(roofs) > 0:
+        raise Exception('Can not parse IFC files containing IfcRoof (user must export roofs as IfcSlab)')
+    return building_properties
+
+
+def extract_model(ifc_file, ifc_path=None, jobs=1, geometry_threads=None):
+    '''
+    Extract the element store and building properties of a loaded model.
+
+    :param ifc_file:
+        ifcopenshell.file or StreamingModel;
+        The model returned by :func:`load_model`.
+
+    :param ifc_path:
+        str;
+        The path of the model, required when `jobs` is larger than one
+        since every worker opens the file itself.
+
+    :param jobs:
+        int;
+        The number of processes used to extract elements.
+
+    :param geometry_threads:
+        int;
+        The number of threads computing the quantities of elements
+        without ``BaseQuantities`` from their geometry, all processors
+        by default. A :class:`StreamingModel` has no geometry.
+
+    :returns:
+        tuple;
+        The element store and the properties of the site, with those of
+        each building as ``Buildings``.
+
+    '''
+    area_type_dictionary = {
+        'Wall': 'NetSideArea',
+        'Slab': 'NetArea'
+    }
+
+    element_store = ElementStore()
+
+    # Index the containment of elements in buildings and storeys once
+    with profiler.stage('Index Spatial Structure'):
+        spatial_index = build_spatial_index(ifc_file)
+    building_properties = get_project_properties(ifc_file, spatial_index)
+
+    if jobs > 1:
+        # Compute missing quantities once and hand them to the workers
+        geometry_quantities = add_geometry_quantities(ifc_file, threads=geometry_threads)
+        extract_parallel(element_store, ifc_file, ifc_path, jobs, geometry_quantities)
+    else:
+        # Index property sets, quantities and types of all elements in one pass
+        with profiler.stage('Index Definitions'):
+            definition_index = build_definition_index(ifc_file)
+        if not isinstance(ifc_file, StreamingModel):
+            add_geometry_quantities(ifc_file, definition_index, geometry_threads)
+        for section, ifc_type, extractor in EXTRACTION_SECTIONS:
+            print('Processing %s...' % section)
+            extract_section(element_store, section, ifc_file.by_type(ifc_type), extractor, definition_index)
+    assign_spatial_columns(element_store, spatial_index)
+
+    return element_store, building_properties
+
+
+def extract_ifc_file(ifc_path, jobs=1, cache_dir=None, cache_size=DEFAULT_CACHE_SIZE, stream=False):
+    '''
+    Extract the element store and building properties of an IFC file.
+
+    With `stream`, the file is read by a :class:`StreamingModel`
+    instead of ``ifcopenshell.open`` and extracted in a single process.
+
+    If `cache_dir` is given, the extraction is looked up in and
+    stored to the extraction cache keyed by the file content.
+
+    :returns:
+        tuple;
+        The element store and the building properties.
+
+    '''
+    cache_path = None
+    if cache_dir is not None:
+        with profiler.stage('Cache Load'):
+            cache_path = get_cache_path(cache_dir, ifc_path)
+            cached_extraction = load_extraction(cache_path)
+        if cached_extraction is not None:
+            print('Loading Cached Extraction...')
+            profiler.count('CacheHits')
+            return cached_extraction
+        profiler.count('CacheMisses')
+
+    ifc_file = load_model(ifc_path, stream)
+    element_store, building_properties = extract_model(ifc_file, ifc_path, 1 if stream else jobs)
+
+    if cache_path is not None:
+        with profiler.stage('Cache Save'):
+            save_extraction(cache_path, element_store, building_properties)
+            evict_cache(cache_dir, cache_size)
+
+    return element_store, building_properties
+
+
+def find_replacements(material_list, material_db):
+    '''
+    Find the lowest carbon replacement of each material in its class.
+
+    :returns:
+        tuple;
+        The database records of the (stripped) material names, None if
+        not found, the minimum EC_Per_Volume per material and the
+        replacement tables of materials with a lower carbon alternative.
+
+    '''
+    # process replacement database
+    cmp_tol = 1e-5 # Tolerance when comparing floats
+    material_records = material_db.lookup_many(material.strip() for material in material_list)
+    # build replacement dict
+    ec_replacements_dict = {}
+    min_ec_dict = {}
+    for material in material_list:
+        material_record = material_records[material.strip()]
+        if material_record is None:
+            material_record = material_records[material.strip()] = match_material(material.strip(), material_db)
+        if material_record is not None:
+            # Attempt to find replacement material
+            class_min_ec = material_db.class_minimum(material_record['EC_Class'])
+            if class_min_ec < material_record['EC_Per_Volume'] - cmp_tol:
+                min_ec_dict[material.strip()] = class_min_ec
+                possible_replacements = material_db.class_minimum_records(material_record['EC_Class'])
+                if len(possible_replacements) > 0:
+                    ec_replacements_dict[material.strip()] = material_db.table([material_record] + possible_replacements)
+            else:
+                min_ec_dict[material.strip()] = material_record['EC_Per_Volume']
+    return material_records, min_ec_dict, ec_replacements_dict
+
+
+def evaluate_layer_table(layer_table, material_db):
+    '''
+    Evaluate a layer table against the material database.
+
+    Adds the ``PotentialCarbon`` column to `layer_table`, the carbon of
+    each layer built with the lowest carbon material of its class.
+
+    :param layer_table:
+        pandas.DataFrame;
+        The table returned by :func:`build_layer_table`.
+
+    :param material_db:
+        MaterialDatabase;
+        The material database used to find replacements.
+
+    :returns:
+        dict;
+        The building totals of ``SUMMARY_COLUMNS`` (without
+        ``IFCFilename``), the current and potential carbon per
+        element group and material and the replacement tables.
+
+    '''
+    #
+    # Find Replacements
+    #
+    print('Processing Replacements...')
+
+    with profiler.stage('Processing Replacements'):
+        # get list of materials
+        material_list = list(layer_table['Layer'].dropna().unique())
+        replacements = find_replacements(material_list, material_db)
+        add_potential_carbon(layer_table, replacements)
+
+    return summarize_layer_table(layer_table, replacements[2])
+
+
+def add_potential_carbon(layer_table, replacements):
+    # Carbon of each layer when built with the lowest carbon material of its class, see find_replacements
+    material_records, min_ec_dict, _ = replacements
+    layer_table['PotentialCarbon'] = compute_potential_carbon(layer_table, get_potential_ratios(material_records, min_ec_dict))
+
+
+def get_per_area(value, area):
+    # Carbon per m², nan for buildings or storeys without internal slabs
+    return value / area if area else np.nan
+
+
+def summarize_layer_table(layer_table, replacements):
+    '''
+    Aggregate the layers of an evaluated layer table, which has the
+    ``PotentialCarbon`` column of :func:`evaluate_layer_table`.
+
+    :param replacements:
+        dict;
+        The replacement tables of :func:`find_replacements`, only those
+        of materials in `layer_table` are kept.
+
+    :returns:
+        dict;
+        The totals and counts of :func:`evaluate_layer_table`.
+
+    '''
+    with profiler.stage('Aggregation'):
+        building_area_internal = get_building_area_internal(layer_table)
+        material_counts = aggregate_layer_table(layer_table, 'Material')
+        element_counts = aggregate_layer_table(layer_table, 'ElementGroup')
+        min_material_counts = aggregate_layer_table(layer_table, 'Material', 'PotentialCarbon')
+        min_element_counts = aggregate_layer_table(layer_table, 'ElementGroup', 'PotentialCarbon')
+
+    building_ec = sum(element_counts.values())
+    building_potential_ec = sum(min_material_counts.values())
+    return {
+        'BuildingAreaInternal': building_area_internal,
+        'BuildingEC': building_ec,
+        'BuildingECPerAreaInternal': get_per_area(building_ec, building_area_internal),
+        'BuildingPotentialEC': building_potential_ec,
+        'BuildingPotentialECPerAreaInternal': get_per_area(building_potential_ec, building_area_internal),
+        'ElementCounts': element_counts,
+        'PotentialElementCounts': min_element_counts,
+        'MaterialCounts': material_counts,
+        'PotentialMaterialCounts': min_material_counts,
+        'Replacements': {name: table for name, table in replacements.items() if name in material_counts}
+    }
+
+
+# Name of the layers outside of any building or storey in breakdowns
+UNASSIGNED_NAME = 'Unassigned'
+
+
+def get_storey_breakdown(layer_table):
+    '''
+    Internal area, current and potential carbon of each storey of an
+    evaluated layer table, in order of first appearance.
+
+    :returns:
+        dict;
+        ``AreaInternal``, ``EC`` and ``PotentialEC`` keyed by storey
+        name, layers outside of a storey are ``UNASSIGNED_NAME``.
+
+    '''
+    storeys = layer_table['Storey'].replace('', UNASSIGNED_NAME)
+    layers = layer_table['Layer'].notna()
+    carbon = layer_table[layers].groupby(storeys[layers], sort=False)[['Carbon', 'PotentialCarbon']].sum()
+    elements = layer_table.drop_duplicates('GlobalId')
+    internal_slabs = elements[(elements['Category'] == 'Slab') & ~elements['IsExternal']]
+    areas = internal_slabs.groupby(storeys[internal_slabs.index], sort=False)['Quantity'].sum()
+    return {storey: {'AreaInternal': float(areas.get(storey, 0.)),
+                     'EC': float(carbon['Carbon'].get(storey, 0.)),
+                     'PotentialEC': float(carbon['PotentialCarbon'].get(storey, 0.))}
+            for storey in storeys.unique()}
+
+
+def get_safe_name(name):
+    # Directory name of the report of a building
+    return re.sub(r'[^\w.-]+', '_', name).strip('_') or '_'
+
+
+def get_report_names(names):
+    # Report directory names of the buildings of a site, numbered where safe names collide, also
+    # on case-insensitive file systems (e.g. "Block A" and "Block_A" become Block_A and Block_A_2)
+    report_names = {}
+    taken = set()
+    for name in names:
+        report_name = safe_name = get_safe_name(name)
+        number = 2
+        while report_name.lower() in taken:
+            report_name = '%s_%d' % (safe_name, number)
+            number += 1
+        taken.add(report_name.lower())
+        report_names[name] = report_name
+    return report_names
+
+
+def evaluate_building(task):
+    # Summarize the layers of one building and write its report to reports/<file>/<report name>/
+    (ifc_path, building_name, report_name, layer_table, replacements, building_properties, report, chart_format,
+     portfolio) = task
+    ifc_filename, _ = os.path.splitext(os.path.basename(ifc_path))
+    evaluation = summarize_layer_table(layer_table, replacements)
+    evaluation['Storeys'] = get_storey_breakdown(layer_table)
+    evaluation['Portfolio'] = compare_portfolio(portfolio, evaluation, building_properties, ifc_path, building_name)
+    if report:
+        write_report(ifc_filename, evaluation, building_properties, chart_format,
+                     report_name=os.path.join(ifc_filename, report_name))
+    evaluation['IFCFilename'] = ifc_filename
+    evaluation['BuildingProperties'] = building_properties
+    return evaluation
+
+
+def evaluate_buildings(ifc_path, layer_table, replacements, building_properties, jobs=1, report=True,
+                       chart_format='svg', portfolio=None):
+    '''
+    Evaluate every building of a site independently, with its own
+    internal area, benchmark, storey breakdown and report.
+
+    :param ifc_path:
+        str;
+        The path of the IFC file of the site.
+
+    :param layer_table:
+        pandas.DataFrame;
+        The layer table evaluated by :func:`evaluate_layer_table`.
+
+    :param replacements:
+        dict;
+        The replacement tables of the site evaluation.
+
+    :param building_properties:
+        dict;
+        The site properties of :func:`get_site_properties`.
+
+    :param jobs:
+        int;
+        The number of processes evaluating buildings.
+
+    :param portfolio:
+        str;
+        The :class:`PortfolioStore` each building is compared with,
+        None to skip the comparison.
+
+    :returns:
+        dict;
+        The evaluation of each building, keyed by building name.
+
+    '''
+    buildings = building_properties.get('Buildings', {})
+    building_tables = dict(iter(layer_table.groupby('Building', sort=False)))
+    report_names = get_report_names(buildings)
+    tasks = [(ifc_path, name, report_names[name], building_tables.get(name, layer_table.iloc[:0]), replacements,
+              properties, report, chart_format, portfolio) for name, properties in buildings.items()]
+    print('Processing Buildings...')
+    with profiler.stage('Processing Buildings'):
+        if jobs > 1 and len(tasks) > 1:
+            with ProcessPoolExecutor(max_workers=min(jobs, len(tasks))) as pool:
+                evaluations = list(pool.map(evaluate_building, tasks))
+        else:
+            evaluations = [evaluate_building(task) for task in tasks]
+        profiler.count('Buildings', len(tasks))
+    return dict(zip(buildings, evaluations))
+
+
+
+def get_chart_markdown(title, name, chart_format, svg=None):
+    # Image reference of a chart in the report, or its markup when inline
+    if chart_format == 'inline':
+        return '<div class="chart" title="%s">\n%s\n</div>' % (title, svg.strip())
+    return '![%s](%s.%s)' % (title, name, chart_format)
+
+
+def get_spatial_breakdown(evaluation):
+    # Report section of the buildings of a site, linking to their reports, or of the storeys of a building
+    if 'Buildings' in evaluation:
+        report_names = get_report_names(evaluation['Buildings'])
+        rows = ['| [%s](%s/report.html) | %.2f m² | %.2f kgCO₂ | %.2f kgCO₂/m² | %.2f kgCO₂/m² |' % (
+                    name, report_names[name], building['BuildingAreaInternal'], building['BuildingEC'],
+                    building['BuildingECPerAreaInternal'], building['BuildingPotentialECPerAreaInternal'])
+                for name, building in evaluation['Buildings'].items()]
+        return ('### Embodied Carbon by Building\n\n'
+                '| Building | Internal Area | Embodied Carbon | Embodied Carbon/m² | Potential Embodied Carbon/m² |\n'
+                '| :-- | --: | --: | --: | --: |\n%s\n\n' % '\n'.join(rows))
+    storeys = evaluation.get('Storeys', {})
+    if not storeys or list(storeys) == [UNASSIGNED_NAME]:
+        return ''
+    rows = ['| %s | %.2f m² | %.2f kgCO₂ | %.2f kgCO₂ |' % (name, storey['AreaInternal'], storey['EC'], storey['PotentialEC'])
+            for name, storey in storeys.items()]
+    return ('### Embodied Carbon by Storey\n\n'
+            '| Storey | Internal Area | Embodied Carbon | Potential Embodied Carbon |\n'
+            '| :-- | --: | --: | --: |\n%s\n\n' % '\n'.join(rows))
+
+
+def get_portfolio_section(evaluation):
+    # Report section of the percentiles of the portfolio and the rank of the building among them
+    portfolio = evaluation.get('Portfolio')
+    if portfolio is None:
+        return ''
+    scope = ' '.join(filter(None, [portfolio['BuildingType'],
+                                   portfolio['Years'] and '%d-%d' % tuple(portfolio['Years'])]))
+    rows = ['| P%d | %.2f kgCO₂/m² |' % (percentile, value) for percentile, value in portfolio['Percentiles'].items()]
+    rows += ['| Current Building (P%.0f) | %.2f kgCO₂/m² |' % (portfolio['Rank'], evaluation['BuildingECPerAreaInternal']),
+             '| Potential Building (P%.0f) | %.2f kgCO₂/m² |' % (portfolio['PotentialRank'],
+                                                                 evaluation['BuildingPotentialECPerAreaInternal'])]
+    return '\n\n### Portfolio (%d %sprojects)\n\n| Percentile | Embodied Carbon/m² |\n| :-- | :-- |\n%s' % (
+        portfolio['Count'], scope + ' ' if scope else '', '\n'.join(rows))
+
+
+# Names of the element groups in report charts
+ELEMENT_GROUP_NAMES = {
+    'ExternalSlab': 'Substructure',
+    'ExternalWall': 'External Walls',
+    'Slab': 'Upper Floors',
+    'Wall': 'Internal Walls',
+    'ExternalRoof': 'Roof',
+    'ExternalDoor': 'External Doors',
+    'Window': 'Windows',
+    'Stair': 'Stairs',
+    'Door': 'Internal Doors'
+}
+
+# Building properties shown in the report, empty if the model does not set them
+REPORT_PROPERTIES = ('BuildingID', 'YearOfConstruction', 'Location', 'BuildingType')
+# Charts of every report, followed by the uncertainty and whole-life charts when analysed
+REPORT_CHARTS = ('material_counts', 'element_counts', 'benchmark')
+
+
+def get_report_charts(report_dir, evaluation, chart_format='svg'):
+    '''
+    List the charts of the report of an evaluation.
+
+    :returns:
+        list;
+        ``(title, name, plot function, arguments)`` of every chart,
+        written to `report_dir` unless inline.
+
+    '''
+    material_counts = evaluation['MaterialCounts']
+    min_material_counts = evaluation['PotentialMaterialCounts']
+    element_counts = evaluation['ElementCounts']
+    min_element_counts = evaluation['PotentialElementCounts']
+
+    sorted_material_names = list(material_counts.keys())
+    sorted_material_values = [material_counts[sorted_material_names] for sorted_material_names in sorted_material_names]
+    sorted_material_names, sorted_material_values = zip_sort(sorted_material_names, sorted_material_values)
+    # if no suggestion, the potential equals the current value and no suggested bar is plotted
+    plot_min_values = [min_material_counts[name] for name in sorted_material_names]
+
+    # Plot 2
+    charts = [('Material Plot', 'material_counts', plot_barchart, (os.path.join(report_dir,'material_counts'), sorted_material_names, sorted_material_values, 'Total kgCO₂', plot_min_values, chart_format))]
+
+    # Plot 3
+    names = list(element_counts.keys())
+    values = list(element_counts[name] for name in names)
+    min_values = list(min_element_counts[name] for name in names)
+    new_names = [ELEMENT_GROUP_NAMES[n] for n in names]
+    new_names, values, min_values = zip_sort(new_names, values, min_values)
+    charts.append(('Element Plot', 'element_counts', plot_barchart, (os.path.join(report_dir,'element_counts'), new_names, values, 'Total kgCO₂', min_values, chart_format)))
+
+    # Plot 1
+    charts.append(('Benchmark Plot', 'benchmark', plot_benchmark, (os.path.join(report_dir,'benchmark'), evaluation['BuildingECPerAreaInternal'], evaluation['BuildingPotentialECPerAreaInternal'], chart_format, evaluation.get('Portfolio'))))
+
+    # Uncertainty, follows the benchmark plot when analysed
+    if 'Uncertainty' in evaluation:
+        uncertainty = evaluation['Uncertainty']
+        # Bin the samples here, drawing millions of samples is slow and sending them to a worker is large
+        samples = uncertainty['Samples']
+        counts, edges = np.histogram(samples[np.isfinite(samples)], bins=100)
+        charts.append(('Uncertainty Plot', 'uncertainty', plot_uncertainty, (os.path.join(report_dir,'uncertainty'), counts, edges, uncertainty['Percentiles'], evaluation['BuildingECPerAreaInternal'], chart_format)))
+
+    # Whole-life carbon, cumulative over the period and per element group
+    if 'WholeLife' in evaluation:
+        whole_life = evaluation['WholeLife']
+        charts.append(('Whole-Life Plot', 'whole_life', plot_whole_life, (os.path.join(report_dir,'whole_life'), whole_life['Cumulative']['Current'], whole_life['Cumulative']['Potential'], chart_format)))
+        names = list(whole_life['ElementCounts'])
+        new_names, values, min_values = zip_sort([ELEMENT_GROUP_NAMES[name] for name in names],
+                                                 [whole_life['ElementCounts'][name] for name in names],
+                                                 [whole_life['PotentialElementCounts'][name] for name in names])
+        charts.append(('Whole-Life Element Plot', 'whole_life_elements', plot_barchart, (os.path.join(report_dir,'whole_life_elements'), new_names, values, 'Whole-Life kgCO₂', min_values, chart_format)))
+    return charts
+
+
+def get_report_replacements(ifc_filename, evaluation, building_properties, chart_markdown, git_id):
+    '''
+    Fill in the placeholders of the report template.
+
+    :param chart_markdown:
+        dict;
+        The markdown of every chart of :func:`get_report_charts` by
+        name, see :func:`get_chart_markdown`.
+
+    :param git_id:
+        str;
+        The commit of pycab, see :func:`get_git_id`.
+
+    '''
+    material_counts = evaluation['MaterialCounts']
+    min_material_counts = evaluation['PotentialMaterialCounts']
+    ec_replacements_dict = evaluation['Replacements']
+
+    sorted_material_names = list(material_counts.keys())
+    sorted_material_values = [material_counts[name] for name in sorted_material_names]
+    sorted_material_names, sorted_material_values = zip_sort(sorted_material_names, sorted_material_values)
+    true_min_values = [min_material_counts[name] for name in sorted_material_names]
+    true_saving_values = [material_counts[name] - min_material_counts[name] for name in sorted_material_names]
+
+    # Replacement Tables
+    names, values, true_min_values, true_saving_values = zip_sort(sorted_material_names, sorted_material_values, true_min_values, true_saving_values)
+    true_min_values_dict = {names[i]: true_min_values[i] for i in range(len(names))}
+    true_saving_values_dict = {names[i]: true_saving_values[i] for i in range(len(names))}
+    ec_replacements_str = []
+    i = 1
+    for name in names:
+        if name in ec_replacements_dict:
+            ec_replacements_str.append(
+                '\n#### %d. %s: <span style="color:#4C7998">%.0f kgCO₂</span> / <span style="color:#9BCA7E">%.0f kgCO₂</span> (Saving %.0f kgCO₂)  \n' % (
+                i, name, material_counts[name], true_min_values_dict[name], true_saving_values_dict[name]))
+            ec_replacements_str.append(ec_replacements_dict[name].to_markdown(
+                index=False,
+                headers=['ID','Name','EC/m³'],
+                floatfmt='.2f')
+            )
+            i = i + 1
+    ec_replacements_str = '\n'.join(ec_replacements_str)
+
+    # Generate Report
+    replacement_dict = {}
+    replacement_dict['Date'] = datetime.date.today().strftime("%d/%m/%Y")
+    replacement_dict['GitID'] = git_id[:7]
+    replacement_dict['ECReplacements'] = ec_replacements_str
+    replacement_dict['BuildingPotentialEC'] = evaluation['BuildingPotentialEC']
+    replacement_dict['BuildingPotentialECPerAreaInternal'] = evaluation['BuildingPotentialECPerAreaInternal']
+    replacement_dict['BuildingAreaInternal'] = evaluation['BuildingAreaInternal']
+    replacement_dict['BuildingEC'] = evaluation['BuildingEC']
+    replacement_dict['BuildingECPerAreaInternal'] = evaluation['BuildingECPerAreaInternal']
+    replacement_dict['IFCFilename'] = ifc_filename
+    replacement_dict['SpatialBreakdown'] = get_spatial_breakdown(evaluation)
+    replacement_dict.update({name: '' for name in REPORT_PROPERTIES})
+    replacement_dict.update(building_properties)
+
+    replacement_dict['MaterialPlot'] = chart_markdown['material_counts']
+    replacement_dict['ElementPlot'] = chart_markdown['element_counts']
+    replacement_dict['BenchmarkPlot'] = chart_markdown['benchmark']
+
+    replacement_dict['Portfolio'] = get_portfolio_section(evaluation)
+    replacement_dict['Uncertainty'] = ''
+    if 'Uncertainty' in evaluation:
+        uncertainty = evaluation['Uncertainty']
+        rows = ['| Mean | %.2f kgCO₂/m² |' % uncertainty['Mean'],
+                '| Standard Deviation | %.2f kgCO₂/m² |' % uncertainty['StandardDeviation']]
+        rows += ['| P%d | %.2f kgCO₂/m² |' % (percentile, value) for percentile, value in uncertainty['Percentiles'].items()]
+        replacement_dict['Uncertainty'] = '\n\n### Uncertainty (%d samples)\n\n| Statistic | Embodied Carbon/m² |\n| :-- | :-- |\n%s\n\n%s' % (
+            len(uncertainty['Samples']), '\n'.join(rows), chart_markdown['uncertainty'])
+
+    replacement_dict['WholeLife'] = ''
+    if 'WholeLife' in evaluation:
+        whole_life = evaluation['WholeLife']
+        rows = []
+        for description, current, potential in (
+                ('Upfront Embodied Carbon [A1-A3]', whole_life['Yearly']['Current'][0], whole_life['Yearly']['Potential'][0]),
+                ('Replacements [B4]', whole_life['WholeLifeEC'] - whole_life['Yearly']['Current'][0],
+                 whole_life['WholeLifePotentialEC'] - whole_life['Yearly']['Potential'][0]),
+                ('Whole-Life Embodied Carbon', whole_life['WholeLifeEC'], whole_life['WholeLifePotentialEC'])):
+            rows.append('| %s | %.2f kgCO₂ | %.2f kgCO₂ |' % (description, current, potential))
+        rows.append('| Whole-Life Embodied Carbon/m² | %.2f kgCO₂/m² | %.2f kgCO₂/m² |' % (
+            whole_life['WholeLifeECPerAreaInternal'], whole_life['WholeLifePotentialECPerAreaInternal']))
+        replacement_dict['WholeLife'] = ('\n\n## Whole-Life Carbon (%d years)\n\n| Description | Current | Potential |\n'
+                                         '| :-- | --: | --: |\n%s\n\n%s\n\n### Whole-Life Carbon by Building Elements\n\n%s') % (
+            whole_life['Period'], '\n'.join(rows), chart_markdown['whole_life'], chart_markdown['whole_life_elements'])
+    return replacement_dict
+
+
+def write_report(ifc_filename, evaluation, building_properties, chart_format='svg', render_jobs=1, report_name=None):
+    '''
+    Plot the evaluation and write the markdown and HTML report to
+    ``reports/<report_name>/``.
+
+    :param chart_format:
+        str;
+        One of ``CHART_FORMATS``, ``inline`` embeds the SVG markup of
+        the charts in the report.
+
+    :param render_jobs:
+        int;
+        The number of processes rendering the charts.
+
+    :param report_name:
+        str;
+        The report directory within ``reports``, `ifc_filename` by
+        default.
+
+    '''
+    report_name = report_name or ifc_filename
+    os.makedirs(os.path.join('reports',report_name), exist_ok=True)
+    charts = get_report_charts(os.path.join('reports',report_name), evaluation, chart_format)
+
+    with profiler.stage('Plots'):
+        rendered_charts = render_charts([(plot, arguments) for _, _, plot, arguments in charts], render_jobs)
+    chart_markdown = {name: get_chart_markdown(title, name, chart_format, svg)
+                      for (title, name, _, _), svg in zip(charts, rendered_charts)}
+    replacement_dict = get_report_replacements(ifc_filename, evaluation, building_properties, chart_markdown, get_git_id())
+
+    with profiler.stage('Report'):
+        generate_report(report_name, replacement_dict)
+
+    # TODO, compare with Leti guide and recompute with new materials (for Bahriye)
+
+
+def evaluate_ifc_file(ifc_path, material_db, jobs=1, cache_dir=None, cache_size=DEFAULT_CACHE_SIZE, stream=False,
+                      report=True, uncertainty=None, chart_format='svg', render_jobs=1, portfolio=None, whole_life=None):
+    '''
+    Evaluate the embodied carbon of an IFC file and, unless `report`
+    is False, write its report to ``reports/<name>/``.
+
+    :param ifc_path:
+        str;
+        The path to the IFC file.
+
+    :param material_db:
+        MaterialDatabase;
+        The material database used to find replacements.
+
+    :param jobs:
+        int;
+        The number of processes used to extract elements.
+
+    :param cache_dir:
+        str;
+        The extraction cache directory, None to disable the cache.
+
+    :param cache_size:
+        int;
+        The maximum size of the extraction cache in MB.
+
+    :param stream:
+        bool;
+        Read the file with a bounded memory :class:`StreamingModel`.
+
+    :param report:
+        bool;
+        Plot the results and write the report.
+
+    :param uncertainty:
+        dict;
+        The options of :func:`new_uncertainty_options`, None to skip
+        the uncertainty analysis.
+
+    :param chart_format:
+        str;
+        The format of the charts, one of ``CHART_FORMATS``.
+
+    :param render_jobs:
+        int;
+        The number of processes rendering the charts.
+
+    :param portfolio:
+        str;
+        The :class:`PortfolioStore` the buildings are compared with and
+        recorded to, None to skip the portfolio.
+
+    :param whole_life:
+        dict;
+        The options of :func:`new_whole_life_options`, None to skip the
+        whole-life analysis.
+
+    :returns:
+        dict;
+        The evaluation of :func:`evaluate_layer_table` with the
+        ``IFCFilename``, ``BuildingProperties``, the ``Buildings`` of
+        :func:`evaluate_buildings` for sites of several buildings or
+        else the ``Storeys`` of :func:`get_storey_breakdown`, the
+        ``Portfolio`` comparison of a single building and, when
+        analysed, the ``Uncertainty`` of :func:`evaluate_uncertainty`
+        and the ``WholeLife`` carbon of :func:`evaluate_whole_life`.
+
+    '''
+
+    ifc_filename, _ = os.path.splitext(os.path.basename(ifc_path))
+
+    element_store, building_properties = extract_ifc_file(ifc_path, jobs, cache_dir, cache_size, stream)
+
+    # Compute the carbon of all layers at once
+    with profiler.stage('Layer Table'):
+        layer_table = build_layer_table(element_store)
+
+    evaluation = evaluate_layer_table(layer_table, material_db)
+    # Sites of several buildings are evaluated per building, single buildings per storey
+    if len(building_properties.get('Buildings', {})) > 1:
+        evaluation['Buildings'] = evaluate_buildings(ifc_path, layer_table, evaluation['Replacements'],
+                                                     building_properties, jobs, report, chart_format, portfolio)
+    else:
+        evaluation['Storeys'] = get_storey_breakdown(layer_table)
+        evaluation['Portfolio'] = compare_portfolio(portfolio, evaluation, building_properties, ifc_path)
+    if uncertainty is not None:
+        print('Processing Uncertainty...')
+        evaluation['Uncertainty'] = evaluate_uncertainty(evaluation, material_db, uncertainty, jobs)
+    if whole_life is not None:
+        print('Processing Whole-Life Carbon...')
+        evaluation['WholeLife'] = evaluate_whole_life(layer_table, material_db, whole_life,
+                                                      evaluation['BuildingAreaInternal'])
+    if report:
+        write_report(ifc_filename, evaluation, building_properties, chart_format, render_jobs)
+
+    evaluation['IFCFilename'] = ifc_filename
+    evaluation['IFCPath'] = os.path.abspath(ifc_path)
+    evaluation['BuildingProperties'] = building_properties
+    if portfolio is not None:
+        record_portfolio(portfolio, evaluation)
+    return evaluation
+
+
+def get_json_float(value):
+    # JSON has no NaN, values per m² of buildings without an internal area are null
+    return float(value) if np.isfinite(value) else None
+
+
+def get_json_result(evaluation):
+    # Totals, building properties and current/potential carbon per element group and material as plain JSON types
+    result = {key: get_json_float(evaluation[key]) for key in SUMMARY_COLUMNS if key != 'IFCFilename'}
+    result['IFCFilename'] = evaluation['IFCFilename']
+    if 'IFCPath' in evaluation:
+        result['IFCPath'] = evaluation['IFCPath']
+    result['BuildingProperties'] = {name: value for name, value in evaluation['BuildingProperties'].items()
+                                    if name != 'Buildings'}
+    for key, counts, potential_counts in (('Elements', 'ElementCounts', 'PotentialElementCounts'),
+                                          ('Materials', 'MaterialCounts', 'PotentialMaterialCounts')):
+        result[key] = {name: {'Current': float(value), 'Potential': float(evaluation[potential_counts][name])}
+                       for name, value in evaluation[counts].items()}
+    if 'Uncertainty' in evaluation:
+        uncertainty = evaluation['Uncertainty']
+        result['Uncertainty'] = {'Mean': get_json_float(uncertainty['Mean']),
+                                 'StandardDeviation': get_json_float(uncertainty['StandardDeviation']),
+                                 'Percentiles': {percentile: get_json_float(value)
+                                                 for percentile, value in uncertainty['Percentiles'].items()},
+                                 'Samples': len(uncertainty['Samples'])}
+    if 'Storeys' in evaluation:
+        result['Storeys'] = evaluation['Storeys']
+    if evaluation.get('Portfolio') is not None:
+        result['Portfolio'] = evaluation['Portfolio']
+    if 'WholeLife' in evaluation:
+        result['WholeLife'] = dict(evaluation['WholeLife'])
+        for key in ('WholeLifeECPerAreaInternal', 'WholeLifePotentialECPerAreaInternal'):
+            result['WholeLife'][key] = get_json_float(result['WholeLife'][key])
+        for key in ('Yearly', 'Cumulative'):
+            result['WholeLife'][key] = {name: values.tolist() for name, values in evaluation['WholeLife'][key].items()}
+    if 'Buildings' in evaluation:
+        result['Buildings'] = {name: get_json_result(building) for name, building in evaluation['Buildings'].items()}
+    return result
+
+
+# Per process state of batch workers
+batch_worker = {}
+
+
+def init_batch_worker(material_db, cache_dir=None, cache_size=DEFAULT_CACHE_SIZE, stream=False, report=True,
+                      uncertainty=None, chart_format='svg', render_jobs=1, portfolio=None, whole_life=None):
+    batch_worker['material_db'] = material_db
+    batch_worker['portfolio'] = portfolio
+    batch_worker['whole_life'] = whole_life
+    batch_worker['uncertainty'] = uncertainty
+    batch_worker['chart_format'] = chart_format
+    batch_worker['render_jobs'] = render_jobs
+    batch_worker['cache_dir'] = cache_dir
+    batch_worker['cache_size'] = cache_size
+    batch_worker['stream'] = stream
+    batch_worker['report'] = report
+
+
+def evaluate_batch_file(ifc_path):
+    # Evaluate one file of a batch, a failing file is reported in the summary instead of stopping the batch
+    try:
+        result = get_json_result(evaluate_ifc_file(ifc_path, batch_worker['material_db'],
+                                                   cache_dir=batch_worker['cache_dir'],
+                                                   cache_size=batch_worker['cache_size'],
+                                                   stream=batch_worker['stream'], report=batch_worker['report'],
+                                                   uncertainty=batch_worker['uncertainty'],
+                                                   chart_format=batch_worker['chart_format'],
+                                                   render_jobs=batch_worker['render_jobs'],
+                                                   portfolio=batch_worker['portfolio'],
+                                                   whole_life=batch_worker['whole_life']))
+        result['Error'] = ''
+    except Exception as error:
+        print('ERROR: failed to process %s: %r' % (ifc_path, error))
+        result = {'IFCFilename': os.path.splitext(os.path.basename(ifc_path))[0], 'Error': repr(error)}
+    return result
+
+
+def evaluate_batch(ifc_paths, material_db, jobs=1, cache_dir=None, cache_size=DEFAULT_CACHE_SIZE, stream=False,
+                   report=True, uncertainty=None, chart_format='svg', render_jobs=1, portfolio=None, whole_life=None):
+    '''
+    Evaluate several IFC files, `jobs` at a time. Unless `report` is
+    False, a combined summary is written to ``reports/summary.csv``
+    and ``reports/summary.md``.
+
+    The material database is loaded once and handed to every worker.
+    Charts are rendered in `render_jobs` processes only when files are
+    evaluated one at a time.
+
+    :returns:
+        list;
+        The :func:`get_json_result` of every file with an ``Error``
+        entry, which is empty unless the file failed.
+
+    '''
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_batch_worker,
+                                 initargs=(material_db, cache_dir, cache_size, stream, report, uncertainty,
+                                           chart_format, 1, portfolio, whole_life)) as pool:
+            results = list(pool.map(evaluate_batch_file, ifc_paths))
+    else:
+        init_batch_worker(material_db, cache_dir, cache_size, stream, report, uncertainty, chart_format, render_jobs,
+                          portfolio, whole_life)
+        results = [evaluate_batch_file(ifc_path) for ifc_path in ifc_paths]
+
+    if report:
+        import pandas as pd
+        summary_table = pd.DataFrame(results, columns=list(SUMMARY_COLUMNS) + ['Error'])
+        os.makedirs('reports', exist_ok=True)
+        summary_table.to_csv(os.path.join('reports', 'summary.csv'), index=False)
+        with open(os.path.join('reports', 'summary.md'), 'w') as f:
+            f.write(summary_table.to_markdown(index=False, floatfmt='.2f'))
+    return results
+
+
+def list_ifc_files(ifc_dir):
+    return sorted(os.path.join(ifc_dir, name) for name in os.listdir(ifc_dir) if name.lower().endswith('.ifc'))
+
+
+def resolve_materials(ifc_paths, material_db, alias_path=None, jobs=1, cache_dir=None, cache_size=DEFAULT_CACHE_SIZE,
+                      stream=False, count=MATCH_CANDIDATES):
+    '''
+    Triage the materials of many models that are not in the database.
+
+    :param alias_path:
+        str;
+        An alias file to which materials without an alias are added
+        with their best match, for the user to confirm.
+
+    :returns:
+        pandas.DataFrame;
+        The candidates of each material not in the database, with the
+        number of files and layers using it.
+
+    '''
+    import pandas as pd
+    material_files = {}
+    material_layers = {}
+    for ifc_path in ifc_paths:
+        element_store, _ = extract_ifc_file(ifc_path, jobs, cache_dir, cache_size, stream)
+        for layer in element_store.layer_names():
+            if isinstance(layer, str) and layer.strip() not in material_db:
+                material_files.setdefault(layer.strip(), set()).add(ifc_path)
+                material_layers[layer.strip()] = material_layers.get(layer.strip(), 0) + 1
+
+    print('Processing Matches...')
+    rows = []
+    with profiler.stage('Processing Matches'):
+        for material in sorted(material_layers, key=lambda material: (-material_layers[material], material)):
+            candidates = material_db.match(material, count) or [('', 0.)]
+            for rank, (database_name, confidence) in enumerate(candidates, 1):
+                rows.append([material, len(material_files[material]), material_layers[material], rank, database_name, confidence])
+    match_table = pd.DataFrame(rows, columns=['Material', 'Files', 'Layers', 'Rank', 'DatabaseName', 'Confidence'])
+
+    if alias_path is not None:
+        alias_table = read_alias_table(alias_path)
+        best = match_table[(match_table['Rank'] == 1) & ~match_table['Material'].isin(alias_table['Material'].str.strip())]
+        new_aliases = pd.DataFrame({'Material': best['Material'], 'DatabaseName': best['DatabaseName'],
+                                    'Confidence': best['Confidence'].map(lambda confidence: '%.2f' % confidence), 'Confirmed': ''})
+        pd.concat([alias_table, new_aliases]).to_csv(alias_path, sep=';', index=False)
+        print('Added %d materials to %s' % (len(new_aliases), alias_path))
+    return match_table
+
+
+#
+# Uncertainty Analysis
+#
+
+DEFAULT_UNCERTAINTY_SPREAD = 0.2
+UNCERTAINTY_PERCENTILES = (5, 25, 50, 75, 95)
+# Samples drawn at once, bounding memory to materials x chunk factors
+UNCERTAINTY_CHUNK = 100000
+
+
+def new_uncertainty_options(samples, spread=DEFAULT_UNCERTAINTY_SPREAD, class_spreads=None, distribution='lognormal',
+                            seed=0):
+    '''
+    Options of an uncertainty analysis.
+
+    :param samples:
+        int;
+        The number of sampled building totals, at least one.
+
+    :param spread:
+        float;
+        The relative spread of the embodied carbon and the density of
+        materials not covered by `class_spreads`, e.g. 0.2 for ±20%.
+
+    :param class_spreads:
+        dict;
+        The ``(embodied carbon spread, density spread)`` of each
+        ``EC_Class``, see :func:`read_class_spreads`.
+
+    :param distribution:
+        str;
+        ``lognormal``, with a median of the point estimate and a
+        geometric standard deviation of 1 + spread, or ``uniform``
+        within ± spread.
+
+    :param seed:
+        int;
+        The seed of the random samples.
+
+    '''
+    return {'Samples': samples, 'Spread': spread, 'ClassSpreads': class_spreads or {}, 'Distribution': distribution,
+            'Seed': seed}
+
+
+def read_class_spreads(filename):
+    # Read EC_Class;EmbodiedCarbonSpread;DensitySpread rows into a dictionary of spreads per class
+    import pandas as pd
+    spread_table = pd.read_csv(filename, sep=';', dtype={'EC_Class': str})
+    return {row['EC_Class']: (float(row['EmbodiedCarbonSpread']), float(row['DensitySpread']))
+            for row in spread_table.to_dict('records')}
+
+
+def get_material_spreads(materials, material_db, options):
+    # Embodied carbon and density spreads of every material, by the EC_Class of its database record
+    material_records = material_db.lookup_many(materials)
+    default_spreads = (options['Spread'], options['Spread'])
+    spreads = np.array([default_spreads if material_records[material] is None else
+                        options['ClassSpreads'].get(material_records[material]['EC_Class'], default_spreads)
+                        for material in materials]).reshape(len(materials), 2)
+    return spreads[:, 0], spreads[:, 1]
+
+
+def sample_factors(rng, spreads, sample_count, distribution):
+    # Relative deviations from the point estimates, materials x samples
+    if distribution == 'uniform':
+        return rng.uniform(1. - spreads[:, None], 1. + spreads[:, None], (len(spreads), sample_count))
+    return rng.lognormal(0., np.log1p(spreads)[:, None], (len(spreads), sample_count))
+
+
+def sample_building_ec(task):
+    # Sample building totals of one chunk, the carbon of a material scales with its embodied carbon and density
+    material_carbon, ec_spreads, density_spreads, sample_count, seed, distribution = task
+    rng = np.random.default_rng(seed)
+    factors = sample_factors(rng, ec_spreads, sample_count, distribution)
+    factors *= sample_factors(rng, density_spreads, sample_count, distribution)
+    return material_carbon @ factors
+
+
+def evaluate_uncertainty(evaluation, material_db, options, jobs=1):
+    '''
+    Sample the building embodied carbon per internal area by drawing
+    the embodied carbon and density of every material from its
+    distribution, in chunks of ``UNCERTAINTY_CHUNK`` samples spread
+    over `jobs` processes. Chunks are seeded from ``options['Seed']``
+    alone, so results do not depend on `jobs`.
+
+    :param evaluation:
+        dict;
+        The evaluation returned by :func:`evaluate_layer_table`.
+
+    :param options:
+        dict;
+        The options returned by :func:`new_uncertainty_options`.
+
+    :returns:
+        dict;
+        The ``Mean``, ``StandardDeviation`` and ``Percentiles`` of the
+        BuildingECPerAreaInternal samples, and the ``Samples``.
+
+    '''
+    materials = list(evaluation['MaterialCounts'])
+    material_carbon = np.array([evaluation['MaterialCounts'][material] for material in materials], dtype=float)
+    ec_spreads, density_spreads = get_material_spreads(materials, material_db, options)
+
+    chunk_sizes = [min(UNCERTAINTY_CHUNK, options['Samples'] - start) for start in range(0, options['Samples'], UNCERTAINTY_CHUNK)]
+    seeds = np.random.SeedSequence(options['Seed']).spawn(len(chunk_sizes))
+    tasks = [(material_carbon, ec_spreads, density_spreads, chunk_size, seed, options['Distribution'])
+             for chunk_size, seed in zip(chunk_sizes, seeds)]
+    with profiler.stage('Processing Uncertainty'):
+        if jobs > 1 and len(tasks) > 1:
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                chunks = list(pool.map(sample_building_ec, tasks))
+        else:
+            chunks = [sample_building_ec(task) for task in tasks]
+        samples = np.concatenate(chunks)
+        # nan without an internal area, see get_per_area
+        samples = samples / evaluation['BuildingAreaInternal'] if evaluation['BuildingAreaInternal'] else np.full_like(samples, np.nan)
+        percentiles = np.percentile(samples, UNCERTAINTY_PERCENTILES)
+    return {
+        'Mean': float(samples.mean()),
+        'StandardDeviation': float(samples.std()),
+        'Percentiles': {percentile: float(value) for percentile, value in zip(UNCERTAINTY_PERCENTILES, percentiles)},
+        'Samples': samples
+    }
+
+
+#
+# Scenario Sweep
+#
+
+# Columns of a scenario file, rows select materials by Material or EC_Class and set their EC_Per_Volume
+# directly or from the database record of a Replacement
+SCENARIO_COLUMNS = ('Scenario', 'Material', 'EC_Class', 'Replacement', 'EC_Per_Volume')
+
+
+def build_quantity_matrix(layer_table):
+    '''
+    Aggregate the layers of a layer table into element group by
+    material matrices.
+
+    Elements only enter the building, element group and material
+    totals through their group, so rows are element groups rather than
+    elements, which keeps the matrices small and dense.
+
+    :returns:
+        tuple;
+        The element groups and materials in the order of
+        :func:`aggregate_layer_table`, the volumes in m³ and the
+        carbon computed from the IFC properties.
+
+    '''
+    import pandas as pd
+    layers = layer_table[layer_table['Layer'].notna()]
+    thickness = layers['LayerThickness'].to_numpy()
+    quantity = layers['Quantity'].to_numpy()
+    # Layers are thickness times area, composites are volumes
+    volume = np.where(np.isnan(thickness), quantity, thickness / 1000. * quantity)
+    group_codes, element_groups = pd.factorize(layers['ElementGroup'])
+    material_codes, materials = pd.factorize(layers['Material'])
+    volumes = np.zeros((len(element_groups), len(materials)))
+    carbon = np.zeros((len(element_groups), len(materials)))
+    np.add.at(volumes, (group_codes, material_codes), volume)
+    np.add.at(carbon, (group_codes, material_codes), layers['Carbon'].to_numpy())
+    return list(element_groups), list(materials), volumes, carbon
+
+
+def get_scenario_vector(materials, material_db):
+    # EC_Per_Volume of every material in a database, NaN (the IFC properties) where it is missing
+    records = material_db.lookup_many(materials)
+    return np.array([np.nan if records[material] is None else records[material]['EC_Per_Volume']
+                     for material in materials])
+
+
+def read_scenario_file(filename, materials, material_db):
+    '''
+    Read substitution scenarios from a semicolon separated file with
+    the columns of ``SCENARIO_COLUMNS``. Every row selects the
+    materials named ``Material``, or all materials of ``EC_Class`` in
+    `material_db`, and sets their ``EC_Per_Volume``, or the one of the
+    database record named ``Replacement``. Materials not selected by
+    any row of a scenario keep the carbon of their IFC properties.
+
+    :returns:
+        dict;
+        The EC_Per_Volume vector of each scenario over `materials`.
+
+    '''
+    import pandas as pd
+    scenario_table = pd.read_csv(filename, sep=';', dtype=str, keep_default_na=False)
+    scenario_table = scenario_table.reindex(columns=list(SCENARIO_COLUMNS), fill_value='')
+    material_records = material_db.lookup_many(materials)
+    scenarios = {}
+    # Rows are numbered as lines of the file, after its header
+    for line, row in enumerate(scenario_table.to_dict('records'), 2):
+        location = 'Scenario %s, line %d of %s' % (row['Scenario'], line, filename)
+        selected_material, ec_class, replacement = (row[column].strip() for column in ('Material', 'EC_Class', 'Replacement'))
+        if not selected_material and not ec_class:
+            raise ValueError('%s: selects no material, set Material or EC_Class' % location)
+        vector = scenarios.setdefault(row['Scenario'], np.full(len(materials), np.nan))
+        if replacement:
+            record = material_db.lookup(replacement)
+            if record is None:
+                raise LookupError('%s: did not find replacement %s in database' % (location, replacement))
+            ec_per_volume = record['EC_Per_Volume']
+        elif row['EC_Per_Volume'].strip():
+            ec_per_volume = parse_decimal_value(row['EC_Per_Volume'], 'EC_Per_Volume', location)
+        else:
+            raise ValueError('%s: set a Replacement or an EC_Per_Volume' % location)
+        for position, material in enumerate(materials):
+            record = material_records[material]
+            if material == selected_material or \
+                    (ec_class and record is not None and record['EC_Class'] == ec_class):
+                vector[position] = ec_per_volume
+    return scenarios
+
+
+def evaluate_scenarios(quantity_matrix, scenarios, building_area_internal):
+    '''
+    Evaluate all scenarios at once as matrix products.
+
+    :param quantity_matrix:
+        tuple;
+        The matrices returned by :func:`build_quantity_matrix`.
+
+    :param scenarios:
+        dict;
+        The EC_Per_Volume vector of each scenario, NaN for materials
+        that keep the carbon of their IFC properties.
+
+    :param building_area_internal:
+        float;
+        The internal area of the building.
+
+    :returns:
+        tuple;
+        The comparison table of ``BuildingEC``,
+        ``BuildingECPerAreaInternal`` and the total of every element
+        group per scenario, and the material totals per scenario.
+
+    '''
+    import pandas as pd
+    element_groups, materials, volumes, carbon = quantity_matrix
+    scenario_names = list(scenarios)
+    # materials x scenarios
+    ec_per_volume = np.column_stack([scenarios[name] for name in scenario_names]) if scenario_names else \
+        np.empty((len(materials), 0))
+    undefined = np.isnan(ec_per_volume)
+    ec_per_volume = np.where(undefined, 0., ec_per_volume)
+
+    group_totals = volumes @ ec_per_volume + carbon @ undefined
+    material_totals = volumes.sum(axis=0)[:, None] * ec_per_volume + carbon.sum(axis=0)[:, None] * undefined
+    building_ec = group_totals.sum(axis=0)
+
+    comparison_table = pd.DataFrame(group_totals.T, index=scenario_names, columns=element_groups)
+    comparison_table.insert(0, 'BuildingECPerAreaInternal', get_per_area(building_ec, building_area_internal))
+    comparison_table.insert(0, 'BuildingEC', building_ec)
+    comparison_table.index.name = 'Scenario'
+    material_table = pd.DataFrame(material_totals, index=materials, columns=scenario_names)
+    material_table.index.name = 'Material'
+    return comparison_table, material_table
+
+
+def sweep_ifc_file(ifc_path, material_db, scenario_dbs=(), scenario_file=None, jobs=1, cache_dir=None,
+                   cache_size=DEFAULT_CACHE_SIZE, stream=False, report=True, whole_life=None):
+    '''
+    Extract an IFC file once and evaluate it under several scenarios:
+    the ``Current`` carbon of its IFC properties, every material
+    database in `scenario_dbs` (named after the file) and the
+    substitution scenarios of `scenario_file`. Unless `report` is
+    False, the tables are written to ``reports/<name>/scenarios.csv``,
+    ``scenarios.md`` and ``scenario_materials.csv``.
+
+    With `whole_life` options (see :func:`new_whole_life_options`),
+    the comparison table gains the ``WholeLifeEC`` and
+    ``WholeLifeECPerAreaInternal`` of every scenario.
+
+    :returns:
+        tuple;
+        The comparison and material tables of :func:`evaluate_scenarios`.
+
+    '''
+    ifc_filename, _ = os.path.splitext(os.path.basename(ifc_path))
+    element_store, _ = extract_ifc_file(ifc_path, jobs, cache_dir, cache_size, stream)
+    layer_table = build_layer_table(element_store)
+
+    print('Processing Scenarios...')
+    with profiler.stage('Processing Scenarios'):
+        quantity_matrix = build_quantity_matrix(layer_table)
+        materials = quantity_matrix[1]
+        scenarios = {'Current': np.full(len(materials), np.nan)}
+        for db_path in scenario_dbs:
+            scenarios[os.path.splitext(os.path.basename(db_path))[0]] = \
+                get_scenario_vector(materials, load_material_db(db_path))
+        if scenario_file is not None:
+            scenarios.update(read_scenario_file(scenario_file, materials, material_db))
+        building_area_internal = get_building_area_internal(layer_table)
+        comparison_table, material_table = evaluate_scenarios(quantity_matrix, scenarios, building_area_internal)
+        if whole_life is not None:
+            service_lives = get_cell_service_lives(layer_table, quantity_matrix, material_db, whole_life)
+            whole_life_ec = evaluate_whole_life_scenarios(quantity_matrix, scenarios, service_lives, whole_life['Period'])
+            comparison_table.insert(2, 'WholeLifeEC', whole_life_ec)
+            comparison_table.insert(3, 'WholeLifeECPerAreaInternal', get_per_area(whole_life_ec, building_area_internal))
+
+    if report:
+        os.makedirs(os.path.join('reports', ifc_filename), exist_ok=True)
+        comparison_table.to_csv(os.path.join('reports', ifc_filename, 'scenarios.csv'))
+        material_table.to_csv(os.path.join('reports', ifc_filename, 'scenario_materials.csv'))
+        with open(os.path.join('reports', ifc_filename, 'scenarios.md'), 'w') as f:
+            f.write(comparison_table.to_markdown(floatfmt='.2f'))
+    return comparison_table, material_table
+
+
+#
+# Whole-Life Carbon
+#
+
+DEFAULT_WHOLE_LIFE_PERIOD = 60
+# Service lives in years of element categories whose materials have none, other layers last the whole period
+CATEGORY_SERVICE_LIVES = {'Door': 30, 'Window': 30}
+# Columns of a service life file, rows select materials by Material or EC_Class
+SERVICE_LIFE_COLUMNS = ('Material', 'EC_Class', 'ServiceLife')
+
+
+def new_whole_life_options(period=DEFAULT_WHOLE_LIFE_PERIOD, material_lives=None, class_lives=None):
+    '''
+    Options of a whole-life carbon analysis.
+
+    :param period:
+        int;
+        The analysis period in years, e.g. 60.
+
+    :param material_lives:
+        dict;
+        The service life in years of materials by stripped name, see
+        :func:`read_service_lives`.
+
+    :param class_lives:
+        dict;
+        The service life in years of the materials of each
+        ``EC_Class``, used for materials without their own.
+
+    '''
+    return {'Period': period, 'MaterialLives': material_lives or {}, 'ClassLives': class_lives or {}}
+
+
+def read_service_lives(filename):
+    '''
+    Read service lives from a semicolon separated file with the columns
+    of ``SERVICE_LIFE_COLUMNS``, every row sets the ``ServiceLife`` of
+    the material named ``Material`` or of all materials of ``EC_Class``.
+
+    :returns:
+        tuple;
+        The service lives by material and by class.
+
+    '''
+    import pandas as pd
+    life_table = pd.read_csv(filename, sep=';', dtype=str, keep_default_na=False)
+    life_table = life_table.reindex(columns=list(SERVICE_LIFE_COLUMNS), fill_value='')
+    material_lives = {}
+    class_lives = {}
+    # Rows are numbered as lines of the file, after its header
+    for line, row in enumerate(life_table.to_dict('records'), 2):
+        location = 'Line %d of %s' % (line, filename)
+        material, ec_class = row['Material'].strip(), row['EC_Class'].strip()
+        if not material and not ec_class:
+            raise ValueError('%s: selects no material, set Material or EC_Class' % location)
+        if not row['ServiceLife'].strip():
+            raise ValueError('%s: set a ServiceLife' % location)
+        service_life = parse_decimal_value(row['ServiceLife'], 'ServiceLife', location)
+        if service_life <= 0:
+            raise ValueError('%s: service life of %s must be positive' % (location, material or ec_class))
+        if material:
+            material_lives[material] = service_life
+        else:
+            class_lives[ec_class] = service_life
+    return material_lives, class_lives
+
+
+def get_material_lives(materials, material_db, options):
+    # Service life of every material by name, else by the EC_Class of its database record, NaN if neither is set
+    material_records = material_db.lookup_many(materials)
+    service_lives = np.full(len(materials), np.nan)
+    for position, material in enumerate(materials):
+        if material in options['MaterialLives']:
+            service_lives[position] = options['MaterialLives'][material]
+        elif material_records[material] is not None:
+            service_lives[position] = options['ClassLives'].get(material_records[material]['EC_Class'], np.nan)
+    return service_lives
+
+
+def get_layer_service_lives(layers, material_db, options):
+    '''
+    Service life of every material layer: the one of its material or
+    material class, else the one of its element category in
+    ``CATEGORY_SERVICE_LIVES``, else infinite.
+
+    :param layers:
+        pandas.DataFrame;
+        The rows of a layer table with a ``Layer``.
+
+    '''
+    import pandas as pd
+    material_codes, materials = pd.factorize(layers['Material'])
+    category_codes, categories = pd.factorize(layers['Category'])
+    material_lives = get_material_lives(list(materials), material_db, options)[material_codes]
+    category_lives = np.array([CATEGORY_SERVICE_LIVES.get(category, np.inf) for category in categories],
+                              dtype=float)[category_codes]
+    return np.where(np.isnan(material_lives), category_lives, material_lives)
+
+
+def get_replacement_schedule(service_lives, period):
+    '''
+    Construction and replacement years of items with service lives.
+
+    Items are built in year 0 and replaced every service life (rounded
+    to whole years) before the end of the period, e.g. once in year 30
+    of a 60 year period for a 30 year service life.
+
+    :returns:
+        numpy.ndarray;
+        Service lives x years 0 to `period`, 1 where an item is built.
+
+    '''
+    years = np.arange(period + 1)
+    # An infinite service life leaves the year unchanged, so it is only built in year 0
+    built = np.mod(years[None, :], np.maximum(np.round(service_lives), 1.)[:, None]) == 0
+    built[:, period:] = False
+    built[:, 0] = True
+    return built.astype(float)
+
+
+def compute_whole_life(service_lives, carbon, period):
+    '''
+    Yearly carbon of items built in year 0 and replaced at the end of
+    their service lives.
+
+    Items are collapsed by service life before the schedule is applied,
+    so the cost is linear in the items plus a service lives x years
+    matrix product, whatever the number of scenarios.
+
+    :param service_lives:
+        numpy.ndarray;
+        The service life of every item in years, infinite if never
+        replaced.
+
+    :param carbon:
+        numpy.ndarray;
+        The carbon of every item (rows) under each scenario (columns).
+
+    :returns:
+        numpy.ndarray;
+        The carbon of every scenario (rows) in years 0 to `period`.
+
+    '''
+    import pandas as pd
+    life_codes, lives = pd.factorize(service_lives)
+    life_carbon = np.column_stack([np.bincount(life_codes, weights=carbon[:, column], minlength=len(lives))
+                                   for column in range(carbon.shape[1])]).reshape(len(lives), carbon.shape[1])
+    return life_carbon.T @ get_replacement_schedule(np.asarray(lives, dtype=float), period)
+
+
+def evaluate_whole_life(layer_table, material_db, options, building_area_internal):
+    '''
+    Evaluate the whole-life carbon of the current and potential
+    materials of a layer table evaluated by :func:`evaluate_layer_table`,
+    over ``options['Period']`` years.
+
+    :param options:
+        dict;
+        The options returned by :func:`new_whole_life_options`.
+
+    :returns:
+        dict;
+        The ``Period``, the ``Yearly`` and ``Cumulative`` carbon arrays
+        of the ``Current`` and ``Potential`` materials, the
+        ``WholeLifeEC`` and ``WholeLifePotentialEC`` totals and per
+        internal area and the totals of every element group.
+
+    '''
+    import pandas as pd
+    with profiler.stage('Processing Whole-Life Carbon'):
+        layers = layer_table[layer_table['Layer'].notna()]
+        service_lives = get_layer_service_lives(layers, material_db, options)
+        carbon = np.column_stack([layers['Carbon'].to_numpy(), layers['PotentialCarbon'].to_numpy()])
+        yearly = compute_whole_life(service_lives, carbon, options['Period'])
+        # Number of times every layer is built over the period
+        life_codes, lives = pd.factorize(service_lives)
+        constructions = get_replacement_schedule(np.asarray(lives, dtype=float), options['Period']).sum(axis=1)[life_codes]
+        group_totals = pd.DataFrame(carbon * constructions[:, None], columns=['Current', 'Potential']).groupby(
+            layers['ElementGroup'].to_numpy(), sort=False).sum()
+    whole_life_ec, whole_life_potential_ec = yearly.sum(axis=1)
+    return {
+        'Period': options['Period'],
+        'Yearly': {'Current': yearly[0], 'Potential': yearly[1]},
+        'Cumulative': {'Current': np.cumsum(yearly[0]), 'Potential': np.cumsum(yearly[1])},
+        'WholeLifeEC': float(whole_life_ec),
+        'WholeLifeECPerAreaInternal': get_per_area(float(whole_life_ec), building_area_internal),
+        'WholeLifePotentialEC': float(whole_life_potential_ec),
+        'WholeLifePotentialECPerAreaInternal': get_per_area(float(whole_life_potential_ec), building_area_internal),
+        'ElementCounts': group_totals['Current'].to_dict(),
+        'PotentialElementCounts': group_totals['Potential'].to_dict(),
+    }
+
+
+def get_cell_service_lives(layer_table, quantity_matrix, material_db, options):
+    # Service lives of the element group by material cells of build_quantity_matrix
+    import pandas as pd
+    element_groups, materials, _, _ = quantity_matrix
+    layers = layer_table[layer_table['Layer'].notna()]
+    service_lives = np.full((len(element_groups), len(materials)), np.inf)
+    # Service lives depend on the material and the category of the group, so they are equal within a cell
+    service_lives[pd.Index(element_groups).get_indexer(layers['ElementGroup']),
+                  pd.Index(materials).get_indexer(layers['Material'])] = get_layer_service_lives(layers, material_db, options)
+    return service_lives
+
+
+def evaluate_whole_life_scenarios(quantity_matrix, scenarios, service_lives, period):
+    '''
+    Whole-life carbon of every scenario of :func:`evaluate_scenarios`
+    at once, from the carbon of every element group by material cell.
+
+    :param service_lives:
+        numpy.ndarray;
+        The service life of every cell, see :func:`get_cell_service_lives`.
+
+    :returns:
+        numpy.ndarray;
+        The whole-life carbon of every scenario.
+
+    '''
+    _, materials, volumes, carbon = quantity_matrix
+    scenario_names = list(scenarios)
+    ec_per_volume = np.column_stack([scenarios[name] for name in scenario_names]) if scenario_names else \
+        np.empty((len(materials), 0))
+    undefined = np.isnan(ec_per_volume)
+    ec_per_volume = np.where(undefined, 0., ec_per_volume)
+    # cells x scenarios
+    cell_carbon = (volumes[:, :, None] * ec_per_volume[None, :, :] + carbon[:, :, None] * undefined[None, :, :]).reshape(
+        -1, len(scenario_names))
+    return compute_whole_life(service_lives.ravel(), cell_carbon, period).sum(axis=1)
+
+
+#
+# Concurrent Pipeline
+#
+
+class StageGraph:
+    '''
+    A graph of pipeline stages run concurrently with asyncio.
+
+    Every stage is a function called with the results of the stages it
+    depends on, in a thread, as soon as those are done. Stages waiting
+    on files, subprocesses or libraries releasing the GIL (such as
+    ``ifcopenshell.open``) overlap with the others. Stages are added
+    after their dependencies, so the graph is acyclic and its stages
+    are in topological order.
+
+    The graph can be inspected before a run with :attr:`dependencies`
+    and :meth:`to_dot`. After a run, :meth:`summary` gives the start
+    and end of every stage and the critical path, the chain of
+    dependent stages that bounds the run time.
+
+    Example::
+
+        graph = StageGraph()
+        graph.add('Open Model', lambda: load_model('model.ifc'))
+        graph.add('Load Database', lambda: load_material_db('EC_MaterialsDB.csv'))
+        graph.add('Extract Model', extract_model, ['Open Model'])
+        results = graph.run()
+        print(graph.format_summary())
+
+    '''
+
+    def __init__(self):
+        # stage name -> (function, names of the stages it depends on)
+        self.stages = {}
+        # stage name -> (start, end) in seconds from the start of the last run
+        self.timings = {}
+        self.wall = None
+
+    def add(self, name, function, dependencies=()):
+        if name in self.stages:
+            raise ValueError('duplicate stage %s' % name)
+        missing = [dependency for dependency in dependencies if dependency not in self.stages]
+        if missing:
+            raise ValueError('stage %s depends on unknown stages %s' % (name, ', '.join(missing)))
+        self.stages[name] = (function, tuple(dependencies))
+
+    @property
+    def dependencies(self):
+        return {name: dependencies for name, (_, dependencies) in self.stages.items()}
+
+    async def run_async(self, jobs=None):
+        '''
+        Run every stage once its dependencies are done.
+
+        :param jobs:
+            int;
+            The number of threads running stages, one per processor by
+            default. A single thread runs the stages in order without
+            contention, and its timings give the critical path of a
+            run with enough processors.
+
+        :returns:
+            dict;
+            The result of every stage by name.
+
+        '''
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+        loop = asyncio.get_running_loop()
+        origin = time.perf_counter()
+        self.timings = {}
+
+        def run_stage(name, function, arguments):
+            start = time.perf_counter()
+            try:
+                return function(*arguments)
+            finally:
+                self.timings[name] = (start - origin, time.perf_counter() - origin)
+
+        async def schedule_stage(name, function, dependencies):
+            arguments = [await tasks[dependency] for dependency in dependencies]
+            return await loop.run_in_executor(executor, run_stage, name, function, arguments)
+
+        tasks = {}
+        with ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as executor:
+            for name, (function, dependencies) in self.stages.items():
+                tasks[name] = asyncio.ensure_future(schedule_stage(name, function, dependencies))
+            try:
+                results = await asyncio.gather(*tasks.values())
+            except BaseException:
+                # Do not start the stages left, the executor waits for the running ones
+                for task in tasks.values():
+                    task.cancel()
+                raise
+        self.wall = time.perf_counter() - origin
+        return dict(zip(tasks, results))
+
+    def run(self, jobs=None):
+        # Run the graph in a new event loop, see run_async
+        import asyncio
+        return asyncio.run(self.run_async(jobs))
+
+    def critical_path(self):
+        # The chain of dependent stages with the longest total time in the last run, and that time in seconds
+        finish, previous = {}, {}
+        for name, (_, dependencies) in self.stages.items():
+            start, end = self.timings[name]
+            previous[name] = max(dependencies, key=finish.get, default=None)
+            finish[name] = end - start + finish.get(previous[name], 0.)
+        name = max(finish, key=finish.get)
+        path = [name]
+        while previous[path[-1]] is not None:
+            path.append(previous[path[-1]])
+        return path[::-1], finish[name]
+
+    def summary(self):
+        '''
+        :returns:
+            dict;
+            The ``Stages`` of the last run with their ``Start``, ``End``
+            and ``Dependencies``, the ``Wall`` seconds of the run, the
+            ``StageTime``, the sum of the stage times, and the
+            ``CriticalPath`` with its ``CriticalPathTime``.
+
+        '''
+        critical_path, critical_path_time = self.critical_path()
+        return {
+            'Stages': {name: {'Start': start, 'End': end, 'Dependencies': list(self.stages[name][1])}
+                       for name, (start, end) in sorted(self.timings.items(), key=lambda item: item[1])},
+            'Wall': self.wall,
+            'StageTime': sum(end - start for start, end in self.timings.values()),
+            'CriticalPath': critical_path,
+            'CriticalPathTime': critical_path_time
+        }
+
+    def format_summary(self):
+        # Plain text table of the summary, stages on the critical path are marked with *
+        summary = self.summary()
+        lines = ['%-28s %10s %10s %10s' % ('Pipeline Stage', 'Start (s)', 'End (s)', 'Time (s)')]
+        for name, stage in summary['Stages'].items():
+            lines.append('%-28s %10.3f %10.3f %10.3f%s' % (name, stage['Start'], stage['End'], stage['End'] - stage['Start'],
+                                                           ' *' if name in summary['CriticalPath'] else ''))
+        lines.append('')
+        lines.append('%-28s %10.3f' % ('Stage Time (s)', summary['StageTime']))
+        lines.append('%-28s %10.3f' % ('Critical Path (s)', summary['CriticalPathTime']))
+        lines.append('%-28s %10.3f' % ('Wall (s)', summary['Wall']))
+        return '\n'.join(lines)
+
+    def to_dot(self):
+        # The graph in the Graphviz DOT language, after a run with the time of every stage and the critical path in bold
+        critical_path = self.critical_path()[0] if len(self.timings) == len(self.stages) else []
+        critical_edges = set(zip(critical_path, critical_path[1:]))
+        lines = ['digraph pipeline {', '    rankdir=LR;', '    node [shape=box];']
+        for name, (_, dependencies) in self.stages.items():
+            label = name
+            if name in self.timings:
+                label += '\\n%.3f s' % (self.timings[name][1] - self.timings[name][0])
+            lines.append('    "%s" [label="%s"%s];' % (name, label, ', style=bold' if name in critical_path else ''))
+            for dependency in dependencies:
+                lines.append('    "%s" -> "%s"%s;' % (dependency, name,
+                                                      ' [style=bold]' if (dependency, name) in critical_edges else ''))
+        lines.append('}')
+        return '\n'.join(lines)
+
+
+def render_report_chart(charts, name, jobs=1):
+    # Render the chart `name` of get_report_charts, in the render pool when jobs > 1
+    _, _, plot, arguments = next(chart for chart in charts if chart[1] == name)
+    with profiler.stage('Plots'):
+        if jobs > 1:
+            return get_render_pool(jobs).submit(plot, *arguments).result()
+        return plot(*arguments)
+
+
+def build_pipeline(ifc_path, material_db, jobs=1, cache_dir=None, cache_size=DEFAULT_CACHE_SIZE, stream=False,
+                   report=True, uncertainty=None, chart_format='svg', render_jobs=1, portfolio=None, whole_life=None):
+    '''
+    Build the :class:`StageGraph` of :func:`evaluate_ifc_file`.
+
+    The material database, the commit id and the renderer are loaded
+    while the model is read. Replacements are found as soon as the
+    materials of the model are known, while the layer table is built.
+    The analyses, the charts and the markdown and HTML files of the
+    report are then written concurrently.
+
+    :param material_db:
+        MaterialDatabase or callable;
+        The material database, or a function loading it such as
+        ``lambda: load_material_db(path)``.
+
+    The other parameters are those of :func:`evaluate_ifc_file`.
+
+    :returns:
+        StageGraph;
+        The graph, whose ``Evaluation`` stage returns the evaluation of
+        :func:`evaluate_ifc_file`.
+
+    '''
+    ifc_filename, _ = os.path.splitext(os.path.basename(ifc_path))
+    report_dir = os.path.join('reports', ifc_filename)
+    graph = StageGraph()
+
+    graph.add('Load Database', material_db if callable(material_db) else lambda: material_db)
+    graph.add('Extract Model', lambda: extract_ifc_file(ifc_path, jobs, cache_dir, cache_size, stream))
+
+    def get_layer_table(extraction):
+        # Compute the carbon of all layers at once
+        with profiler.stage('Layer Table'):
+            return build_layer_table(extraction[0])
+    graph.add('Layer Table', get_layer_table, ['Extract Model'])
+
+    def find_model_replacements(extraction, material_db):
+        print('Processing Replacements...')
+        with profiler.stage('Processing Replacements'):
+            return find_replacements(extraction[0].material_names(), material_db)
+    graph.add('Find Replacements', find_model_replacements, ['Extract Model', 'Load Database'])
+
+    def evaluate(extraction, layer_table, replacements):
+        add_potential_carbon(layer_table, replacements)
+        evaluation = summarize_layer_table(layer_table, replacements[2])
+        evaluation['IFCFilename'] = ifc_filename
+        evaluation['IFCPath'] = os.path.abspath(ifc_path)
+        evaluation['BuildingProperties'] = extraction[1]
+        return evaluation
+    graph.add('Evaluate', evaluate, ['Extract Model', 'Layer Table', 'Find Replacements'])
+
+    # Analyses add their results to the evaluation
+    def add_breakdown(layer_table, evaluation):
+        building_properties = evaluation['BuildingProperties']
+        # Sites of several buildings are evaluated per building, single buildings per storey
+        if len(building_properties.get('Buildings', {})) > 1:
+            evaluation['Buildings'] = evaluate_buildings(ifc_path, layer_table, evaluation['Replacements'],
+                                                         building_properties, jobs, report, chart_format, portfolio)
+        else:
+            evaluation['Storeys'] = get_storey_breakdown(layer_table)
+            evaluation['Portfolio'] = compare_portfolio(portfolio, evaluation, building_properties, ifc_path)
+    graph.add('Breakdown', add_breakdown, ['Layer Table', 'Evaluate'])
+    analyses = ['Breakdown']
+
+    if uncertainty is not None:
+        def add_uncertainty(evaluation, material_db):
+            print('Processing Uncertainty...')
+            evaluation['Uncertainty'] = evaluate_uncertainty(evaluation, material_db, uncertainty, jobs)
+        graph.add('Uncertainty', add_uncertainty, ['Evaluate', 'Load Database'])
+        analyses.append('Uncertainty')
+
+    if whole_life is not None:
+        def add_whole_life(layer_table, evaluation, material_db):
+            print('Processing Whole-Life Carbon...')
+            evaluation['WholeLife'] = evaluate_whole_life(layer_table, material_db, whole_life,
+                                                          evaluation['BuildingAreaInternal'])
+        graph.add('Whole-Life Carbon', add_whole_life, ['Layer Table', 'Evaluate', 'Load Database'])
+        analyses.append('Whole-Life Carbon')
+
+    outputs = []
+    if report:
+        graph.add('Load Renderer', lambda: load_renderer(render_jobs))
+        graph.add('Git ID', get_git_id)
+
+        def get_charts(evaluation, *analysed):
+            os.makedirs(report_dir, exist_ok=True)
+            return get_report_charts(report_dir, evaluation, chart_format)
+        graph.add('Report Charts', get_charts, ['Evaluate'] + analyses)
+
+        chart_names = list(REPORT_CHARTS)
+        if uncertainty is not None:
+            chart_names.append('uncertainty')
+        if whole_life is not None:
+            chart_names += ['whole_life', 'whole_life_elements']
+        for name in chart_names:
+            graph.add('Plot %s' % name, lambda charts, renderer, name=name: render_report_chart(charts, name, render_jobs),
+                      ['Report Charts', 'Load Renderer'])
+
+        def render_report(evaluation, charts, git_id, *rendered_charts):
+            rendered_charts = dict(zip(chart_names, rendered_charts))
+            chart_markdown = {name: get_chart_markdown(title, name, chart_format, rendered_charts[name])
+                              for title, name, _, _ in charts}
+            replacement_dict = get_report_replacements(ifc_filename, evaluation, evaluation['BuildingProperties'],
+                                                       chart_markdown, git_id)
+            return get_report_builder().template % replacement_dict
+        graph.add('Render Report', render_report,
+                  ['Evaluate', 'Report Charts', 'Git ID'] + ['Plot %s' % name for name in chart_names])
+        graph.add('Write Markdown', lambda markdown: get_report_builder().write_markdown(report_dir, markdown),
+                  ['Render Report'])
+        graph.add('Write HTML', lambda markdown: get_report_builder().write_html(report_dir, get_report_builder().convert(markdown)),
+                  ['Render Report'])
+        outputs += ['Write Markdown', 'Write HTML']
+
+    if portfolio is not None:
+        graph.add('Record Portfolio', lambda evaluation, *analysed: record_portfolio(portfolio, evaluation),
+                  ['Evaluate'] + analyses)
+        outputs.append('Record Portfolio')
+
+    graph.add('Evaluation', lambda evaluation, *done: evaluation, ['Evaluate'] + analyses + outputs)
+    return graph
+
+
+#
+# Incremental Evaluation
+#
+
+def get_attribute_items(entity):
+    # Attribute names and values of an ifcopenshell or streamed entity
+    if isinstance(entity, StreamEntity):
+        return [(name, getattr(entity, name)) for name in STREAM_ATTRIBUTES[entity.type]]
+    return [(entity.attribute_name(i), entity[i]) for i in range(len(entity))]
+
+
+def hash_definition(entity, memo):
+    # Content hash of an entity and everything it references, independent of step ids and owner history
+    step_id = entity.id()
+    if step_id in memo:
+        return memo[step_id]
+    digest = hashlib.sha1(entity.is_a().encode())
+    for name, value in get_attribute_items(entity):
+        if name != 'OwnerHistory':
+            digest.update(name.encode())
+            digest.update(hash_value(value, memo).encode())
+    content_hash = digest.hexdigest()
+    # typed values such as IfcLabel have no step id
+    if step_id:
+        memo[step_id] = content_hash
+    return content_hash
+
+
+def hash_value(value, memo):
+    if isinstance(value, (tuple, list)):
+        return '(' + ','.join(hash_value(item, memo) for item in value) + ')'
+    if isinstance(value, StreamValue):
+        return value.type + repr(value.wrappedValue)
+    if hasattr(value, 'is_a'):
+        return hash_definition(value, memo)
+    return repr(value)
+
+
+def get_element_signature(element, index, memo):
+    '''
+    Content hash of everything pycab extracts from an element: its
+    GlobalId and Name, property sets, element quantities, slab type
+    and associated materials, and its representation if it has no
+    ``BaseQuantities`` and is measured from its geometry. Definitions
+    shared between elements are hashed once through `memo`.
+
+    '''
+    definitions = get_definitions(element, index)
+    digest = hashlib.sha1((element.GlobalId + '/' + str(element.Name)).encode())
+    for kind in ('PropertySets', 'ElementQuantities'):
+        for name in sorted(definitions[kind]):
+            for related_data in definitions[kind][name]:
+                digest.update(hash_definition(related_data, memo).encode())
+    if 'BaseQuantities' not in definitions['ElementQuantities'] and not isinstance(element, StreamEntity) \
+            and element.Representation is not None:
+        digest.update(hash_definition(element.Representation, memo).encode())
+    digest.update(repr(definitions['SlabType']).encode())
+    for assoc in element.HasAssociations:
+        if assoc.is_a('IfcRelAssociatesMaterial'):
+            digest.update(hash_definition(assoc.RelatingMaterial, memo).encode())
+    return digest.hexdigest()
+
+
+def add_count(counts, potential_counts, users, key, carbon, potential_carbon, sign=1):
+    # Add (sign=1) or remove (sign=-1) a layer contribution, dropping keys without contributions
+    users[key] = users.get(key, 0) + sign
+    if users[key] == 0:
+        del users[key]
+        del counts[key]
+        del potential_counts[key]
+    else:
+        counts[key] = counts.get(key, 0.) + sign * carbon
+        potential_counts[key] = potential_counts.get(key, 0.) + sign * potential_carbon
+
+
+class IncrementalEvaluation:
+    '''
+    Evaluate successive revisions of a model, re-extracting only the
+    elements that changed.
+
+    Every element is identified by its GlobalId and a signature of its
+    property sets, quantities and materials
+    (:func:`get_element_signature`). On :meth:`update`, new and changed
+    elements are extracted and the aggregates are updated by removing
+    the contributions of changed and deleted elements and adding the
+    new ones. Database lookups are kept across revisions.
+
+    Example::
+
+        session = IncrementalEvaluation(MaterialDatabase.read_csv('EC_MaterialsDB.csv'))
+        evaluation = session.update(load_model('rev1.ifc'))
+        evaluation = session.update(load_model('rev2.ifc'))
+
+    :param material_db:
+        MaterialDatabase;
+        The material database used to find replacements.
+
+    '''
+
+    def __init__(self, material_db):
+        self.material_db = material_db
+        self.building_properties = {}
+        self.signatures = {}
+        # (Material, ElementGroup, Carbon, PotentialCarbon) of the layers of each element
+        self.element_layers = {}
+        # Internal area of each internal slab, summed when evaluated so removals leave no rounding behind
+        self.element_areas = {}
+        self.material_counts = {}
+        self.potential_material_counts = {}
+        self.material_users = {}
+        self.element_counts = {}
+        self.potential_element_counts = {}
+        self.element_group_users = {}
+        # Database lookups of all materials seen so far
+        self.material_records = {}
+        self.potential_ratios = {}
+        self.replacements = {}
+        self.extracted_count = 0
+
+    def update(self, ifc_file):
+        '''
+        Update the evaluation to a new revision of the model.
+
+        :param ifc_file:
+            ifcopenshell.file or StreamingModel;
+            The revision returned by :func:`load_model`.
+
+        :returns:
+            dict;
+            The evaluation, as returned by :func:`evaluate_layer_table`.
+
+        '''
+        spatial_index = build_spatial_index(ifc_file)
+        self.building_properties = get_project_properties(ifc_file, spatial_index)
+        definition_index = build_definition_index(ifc_file)
+        memo = {}
+        signatures = {element.GlobalId: get_element_signature(element, definition_index, memo)
+                      for _, ifc_type, _ in EXTRACTION_SECTIONS for element in ifc_file.by_type(ifc_type)}
+        if not isinstance(ifc_file, StreamingModel):
+            # Unchanged elements keep their layers, so only changed ones are measured from their geometry
+            add_geometry_quantities(ifc_file, definition_index, elements=[
+                element for _, ifc_type, _ in EXTRACTION_SECTIONS for element in ifc_file.by_type(ifc_type)
+                if self.signatures.get(element.GlobalId) != signatures[element.GlobalId]])
+        changed_elements = ElementStore()
+        self.extracted_count = 0
+        for section, ifc_type, extractor in EXTRACTION_SECTIONS:
+            print('Processing %s...' % section)
+            for element in ifc_file.by_type(ifc_type):
+                signature = signatures[element.GlobalId]
+                if self.signatures.get(element.GlobalId) != signature:
+                    self.remove_element(element.GlobalId)
+                    extractor(changed_elements, element, definition_index)
+                    self.extracted_count += 1
+        for global_id in set(self.signatures) - set(signatures):
+            self.remove_element(global_id)
+        self.signatures = signatures
+
+        print('Processing Replacements...')
+        assign_spatial_columns(changed_elements, spatial_index)
+        self.add_layers(build_layer_table(changed_elements))
+        print('Re-extracted %d of %d elements' % (self.extracted_count, len(signatures)))
+        return self.evaluation()
+
+    def add_layers(self, layer_table):
+        # Look up materials not seen before
+        new_materials = [material for material in layer_table['Layer'].dropna().unique()
+                         if material.strip() not in self.material_records]
+        material_records, min_ec_dict, ec_replacements_dict = find_replacements(new_materials, self.material_db)
+        self.material_records.update(material_records)
+        self.potential_ratios.update(get_potential_ratios(material_records, min_ec_dict))
+        self.replacements.update(ec_replacements_dict)
+        layer_table['PotentialCarbon'] = compute_potential_carbon(layer_table, self.potential_ratios)
+
+        elements = layer_table.drop_duplicates('GlobalId')
+        internal_slabs = elements[(elements['Category'] == 'Slab') & ~elements['IsExternal']]
+        for global_id, area in zip(internal_slabs['GlobalId'], internal_slabs['Quantity']):
+            self.element_areas[global_id] = area
+
+        layers = layer_table[layer_table['Layer'].notna()]
+        for global_id, material, element_group, carbon, potential_carbon in zip(
+                layers['GlobalId'], layers['Material'], layers['ElementGroup'], layers['Carbon'], layers['PotentialCarbon']):
+            self.element_layers.setdefault(global_id, []).append((material, element_group, carbon, potential_carbon))
+            self.add_layer(material, element_group, carbon, potential_carbon)
+
+    def add_layer(self, material, element_group, carbon, potential_carbon, sign=1):
+        add_count(self.material_counts, self.potential_material_counts, self.material_users,
+                  material, carbon, potential_carbon, sign)
+        add_count(self.element_counts, self.potential_element_counts, self.element_group_users,
+                  element_group, carbon, potential_carbon, sign)
+
+    def remove_element(self, global_id):
+        for material, element_group, carbon, potential_carbon in self.element_layers.pop(global_id, []):
+            self.add_layer(material, element_group, carbon, potential_carbon, -1)
+        self.element_areas.pop(global_id, None)
+
+    def evaluation(self):
+        # The current aggregates in the form of evaluate_layer_table
+        building_ec = sum(self.element_counts.values())
+        building_potential_ec = sum(self.potential_material_counts.values())
+        building_area_internal = float(sum(self.element_areas.values()))
+        return {
+            'BuildingAreaInternal': building_area_internal,
+            'BuildingEC': building_ec,
+            'BuildingECPerAreaInternal': get_per_area(building_ec, building_area_internal),
+            'BuildingPotentialEC': building_potential_ec,
+            'BuildingPotentialECPerAreaInternal': get_per_area(building_potential_ec, building_area_internal),
+            'ElementCounts': dict(self.element_counts),
+            'PotentialElementCounts': dict(self.potential_element_counts),
+            'MaterialCounts': dict(self.material_counts),
+            'PotentialMaterialCounts': dict(self.potential_material_counts),
+            'Replacements': {name: table for name, table in self.replacements.items() if name in self.material_counts}
+        }
+
+
+
+#
+# Evaluation Server
+#
+
+DEFAULT_SERVER_PORT = 8765
+DEFAULT_MODEL_CACHE_SIZE = 2048 # MB of IFC files
+# Latencies kept for the server statistics
+LATENCY_WINDOW = 10000
+
+# Per process state of server workers
+server_worker = {}
+
+
+def init_server_worker(material_db, model_cache_size=DEFAULT_MODEL_CACHE_SIZE):
+    from collections import OrderedDict
+    server_worker['material_db'] = material_db
+    server_worker['model_cache_size'] = model_cache_size
+    # session key -> entry of the evaluation session of a model, least recently used first
+    server_worker['models'] = OrderedDict()
+    server_worker['cache_hits'] = 0
+
+
+def warm_server_worker():
+    # Import what evaluations and reports use, so the first request does not pay for it
+    import pandas
+    import ifcopenshell
+    import markdown
+    import matplotlib.figure
+
+
+def serve_evaluation(request):
+    '''
+    Evaluate a request inside a server worker.
+
+    Models are kept in an LRU of :class:`IncrementalEvaluation`
+    sessions keyed by ``session`` (the file path by default). An
+    unchanged file is answered from its session, a new revision only
+    re-extracts its changed elements. Sessions are evicted least
+    recently used first once the IFC files they hold exceed
+    ``model_cache_size`` MB.
+
+    :param request:
+        dict;
+        ``ifcfile``, the path to the IFC file, and optionally
+        ``session`` and ``report``, whether to write the report.
+
+    :returns:
+        dict;
+        The :func:`get_json_result` of the file, with the ``Report``
+        path if requested and whether the session was a ``CacheHit``.
+
+    '''
+    models = server_worker['models']
+    ifc_path = os.path.abspath(request['ifcfile'])
+    key = request.get('session') or ifc_path
+    stat = os.stat(ifc_path)
+    revision = (ifc_path, stat.st_mtime_ns, stat.st_size)
+
+    entry = models.pop(key, None)
+    cache_hit = entry is not None and entry['Revision'] == revision
+    if entry is None:
+        entry = {'Session': IncrementalEvaluation(server_worker['material_db']), 'Revision': None}
+    if not cache_hit:
+        entry['Evaluation'] = entry['Session'].update(load_model(ifc_path))
+        entry['Revision'] = revision
+        entry['Size'] = stat.st_size
+    else:
+        server_worker['cache_hits'] += 1
+    models[key] = entry
+    # Evict least recently used sessions, always keeping the current one
+    while len(models) > 1 and sum(model['Size'] for model in models.values()) > server_worker['model_cache_size'] * 1024 ** 2:
+        models.popitem(last=False)
+
+    ifc_filename, _ = os.path.splitext(os.path.basename(ifc_path))
+    evaluation = dict(entry['Evaluation'], IFCFilename=ifc_filename,
+                      BuildingProperties=entry['Session'].building_properties)
+    result = get_json_result(evaluation)
+    if request.get('report'):
+        write_report(ifc_filename, evaluation, entry['Session'].building_properties)
+        result['Report'] = os.path.abspath(os.path.join('reports', ifc_filename, 'report.html'))
+    result['CacheHit'] = cache_hit
+    return result
+
+
+class EvaluationServer:
+    '''
+    Local asyncio HTTP server evaluating IFC files with warm imports,
+    a loaded material database and cached models.
+
+    Requests are evaluated in `jobs` single process workers, each
+    holding its own LRU of models (see :func:`serve_evaluation`).
+    Requests are routed by session key, so repeated requests for a
+    file reach the worker that holds it.
+
+    Endpoints:
+
+    * ``POST /evaluate`` with a JSON body of ``ifcfile`` and optionally
+      ``session`` and ``report``, answered with the JSON totals.
+    * ``GET /stats``, the request count and p50/p90/p99 latency in ms.
+
+    :param material_db:
+        MaterialDatabase;
+        The material database used to find replacements.
+
+    :param jobs:
+        int;
+        The number of worker processes.
+
+    :param model_cache_size:
+        int;
+        The maximum size of the IFC files cached per worker in MB.
+
+    '''
+
+    def __init__(self, material_db, jobs=1, model_cache_size=DEFAULT_MODEL_CACHE_SIZE):
+        import collections
+        self.workers = [ProcessPoolExecutor(max_workers=1, initializer=init_server_worker,
+                                            initargs=(material_db, model_cache_size)) for _ in range(max(1, jobs))]
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.request_count = 0
+        self.cache_hits = 0
+
+    def get_worker(self, request):
+        import zlib
+        key = request.get('session') or os.path.abspath(request['ifcfile'])
+        return self.workers[zlib.crc32(key.encode()) % len(self.workers)]
+
+    def stats(self):
+        latencies = np.array(self.latencies) * 1000.
+        stats = {'Requests': self.request_count, 'CacheHits': self.cache_hits, 'Workers': len(self.workers)}
+        if len(latencies):
+            stats.update({'LatencyP50': float(np.percentile(latencies, 50)),
+                          'LatencyP90': float(np.percentile(latencies, 90)),
+                          'LatencyP99': float(np.percentile(latencies, 99)),
+                          'LatencyMax': float(latencies.max())})
+        return stats
+
+    async def handle_request(self, method, path, body):
+        # Return the status and JSON response of a request
+        import asyncio
+        if method == 'GET' and path == '/stats':
+            return 200, self.stats()
+        if method != 'POST' or path != '/evaluate':
+            return 404, {'Error': 'unknown endpoint %s %s' % (method, path)}
+        try:
+            request = json.loads(body or b'{}')
+            if not isinstance(request, dict) or not isinstance(request.get('ifcfile'), str):
+                raise ValueError('the request must be a JSON object with an ifcfile path')
+            if not isinstance(request.get('session', ''), str):
+                raise ValueError('the session must be a string')
+            if not os.path.isfile(request['ifcfile']):
+                return 404, {'Error': 'no such file %s' % request['ifcfile']}
+        except ValueError as error:
+            return 400, {'Error': str(error)}
+        start = time.perf_counter()
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self.get_worker(request), serve_evaluation, request)
+        except Exception as error:
+            return 500, {'Error': repr(error)}
+        self.latencies.append(time.perf_counter() - start)
+        self.request_count += 1
+        self.cache_hits += result['CacheHit']
+        return 200, result
+
+    async def handle_connection(self, reader, writer):
+        # Minimal HTTP/1.1 with keep-alive, one request at a time per connection
+        reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                status, response = await self.handle_request(method, path, body)
+                payload = json.dumps(response).encode()
+                writer.write(b'HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n'
+                             % (status, reasons[status].encode(), len(payload)) + payload)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, ValueError, EOFError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=DEFAULT_SERVER_PORT, socket_path=None):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(worker, warm_server_worker) for worker in self.workers))
+        if socket_path is not None:
+            server = await asyncio.start_unix_server(self.handle_connection, path=socket_path)
+            print('Serving on %s' % socket_path)
+        else:
+            server = await asyncio.start_server(self.handle_connection, host, port)
+            print('Serving on http://%s:%d' % (host, port))
+        async with server:
+            await server.serve_forever()
+
+    def shutdown(self):
+        for worker in self.workers:
+            worker.shutdown(cancel_futures=True)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='A python tool for calculating the embodied carbon of IFC files.')
+    parser.add_argument('-i','--ifcfile', action='extend', nargs='+', type=str, required=False, help='the IFC file(s) to process', default=[], metavar="IFC_FILE")
+    parser.add_argument('--ifcdir', action='store', type=str, required=False, help='a directory of IFC files to process', metavar="IFC_DIR")
+    parser.add_argument('-d','--dbfile', action='store', type=str, required=False, help='the material database file', default='EC_MaterialsDB.csv', metavar="DATABASE_FILE")
+    parser.add_argument('-j','--jobs', action='store', type=int, required=False, help='the number of processes used to extract elements, or to process files when several are given', default=1, metavar="JOBS")
+    parser.add_argument('--cache-dir', action='store', type=str, required=False, help='the extraction cache directory', default=DEFAULT_CACHE_DIR, metavar="CACHE_DIR")
+    parser.add_argument('--cache-size', action='store', type=int, required=False, help='the maximum size of the extraction cache in MB', default=DEFAULT_CACHE_SIZE, metavar="CACHE_SIZE")
+    parser.add_argument('--no-cache', action='store_true', help='do not read or write the extraction cache')
+    parser.add_argument('--stream', action='store_true', help='read IFC files in a single pass with bounded memory')
+    parser.add_argument('-f','--format', action='store', type=str, required=False, help='print the results as JSON instead of writing a report', default='report', choices=['report', 'json'])
+    parser.add_argument('--no-report', action='store_true', help='do not plot the results or write a report')
+    parser.add_argument('--scenario-db', action='extend', nargs='+', type=str, required=False, help='evaluate the model under each of these material databases', default=[], metavar="DATABASE_FILE")
+    parser.add_argument('--scenarios', action='store', type=str, required=False, help='a file of material substitution scenarios to evaluate the model under', metavar="SCENARIO_FILE")
+    parser.add_argument('--uncertainty', action='store', type=int, required=False, help='sample this many building totals from the uncertainty of material carbon and density', default=0, metavar="SAMPLES")
+    parser.add_argument('--uncertainty-spread', action='store', type=float, required=False, help='the relative spread of material carbon and density (default: %(default)s)', default=DEFAULT_UNCERTAINTY_SPREAD, metavar="SPREAD")
+    parser.add_argument('--uncertainty-classes', action='store', type=str, required=False, help='a file of EC_Class;EmbodiedCarbonSpread;DensitySpread rows', metavar="SPREAD_FILE")
+    parser.add_argument('--uncertainty-distribution', action='store', type=str, required=False, help='the distribution of material carbon and density', default='lognormal', choices=['lognormal', 'uniform'])
+    parser.add_argument('--seed', action='store', type=int, required=False, help='the seed of the uncertainty samples', default=0)
+    parser.add_argument('--whole-life', action='store', type=int, required=False, help='add the whole-life carbon over this many years, with materials replaced at the end of their service lives', default=0, metavar="YEARS")
+    parser.add_argument('--service-lives', action='store', type=str, required=False, help='a file of Material;EC_Class;ServiceLife rows, the service lives in years of materials or material classes', metavar="SERVICE_LIFE_FILE")
+    parser.add_argument('--chart-format', action='store', type=str, required=False, help='the format of the report charts, inline embeds SVG in the report', default='svg', choices=list(CHART_FORMATS))
+    parser.add_argument('--render-jobs', action='store', type=int, required=False, help='the number of processes rendering the report charts', default=1, metavar="JOBS")
+    parser.add_argument('--pipeline', action='store_true', help='evaluate a single IFC file in a concurrent pipeline, loading the database and writing the report while the model is read and evaluated')
+    parser.add_argument('--pipeline-graph', action='store', type=str, required=False, help='write the stage graph of --pipeline with the time of every stage and the critical path to this Graphviz DOT file (implies --pipeline)', metavar="DOT_FILE")
+    parser.add_argument('--aliases', action='store', type=str, required=False, help='a file of Material;DatabaseName;Confidence;Confirmed rows, the confirmed ones name the database material of a model material', metavar="ALIAS_FILE")
+    parser.add_argument('--match-threshold', action='store', type=float, required=False, help='look up materials not in the database by their closest match from this confidence (0 to 1), otherwise matches are only suggested', metavar="CONFIDENCE")
+    parser.add_argument('--resolve-materials', action='store_true', help='list the closest database matches of the materials of the IFC files not in the database, and add them to --aliases for confirmation')
+    parser.add_argument('--portfolio', action='store', type=str, required=False, help='a portfolio database (SQLite) to benchmark buildings against and record their results to', metavar="PORTFOLIO_FILE")
+    parser.add_argument('--portfolio-import', action='extend', nargs='+', type=str, required=False, help='import the results of past runs (--format json output or summary.csv files) into --portfolio', default=[], metavar="RESULT_FILE")
+    parser.add_argument('--compile-db', action='store', type=str, required=False, help='validate the material database and compile it to this file, which can then be passed to --dbfile', metavar="COMPILED_FILE")
+    parser.add_argument('--serve', action='store_true', help='run a local evaluation server, see EvaluationServer')
+    parser.add_argument('--host', action='store', type=str, required=False, help='the address the server listens on', default='127.0.0.1')
+    parser.add_argument('--port', action='store', type=int, required=False, help='the port the server listens on', default=DEFAULT_SERVER_PORT)
+    parser.add_argument('--socket', action='store', type=str, required=False, help='listen on this Unix socket instead of a port', metavar="SOCKET_PATH")
+    parser.add_argument('--model-cache-size', action='store', type=int, required=False, help='the maximum size of the IFC files kept in memory by each server worker in MB', default=DEFAULT_MODEL_CACHE_SIZE, metavar="CACHE_SIZE")
+    parser.add_argument('--profile', action='store_true', help='print the time of each stage, counters, peak memory and the slowest elements')
+    parser.add_argument('--profile-trace', action='store', type=str, required=False, help='write the profiled stages as a Chrome trace to this file (implies --profile)', metavar="TRACE_FILE")
+    parser.add_argument('--profile-slowest', action='store', type=int, required=False, help='the number of slowest elements listed by --profile', default=10, metavar="COUNT")
+    args = parser.parse_args()
+
+    cache_dir = None if args.no_cache else args.cache_dir
+
+    if args.compile_db:
+        try:
+            compile_material_db(args.dbfile, args.compile_db)
+        except ValueError as error:
+            sys.exit('ERROR: %s' % error)
+        print('Compiled %s to %s' % (args.dbfile, args.compile_db))
+        sys.exit(0)
+
+    if args.portfolio_import:
+        if not args.portfolio:
+            parser.error('--portfolio-import requires --portfolio')
+        import_portfolio(args.portfolio, args.portfolio_import)
+        sys.exit(0)
+
+    if args.serve:
+        import asyncio
+        server = EvaluationServer(load_material_db(args.dbfile, args.aliases, args.match_threshold), args.jobs,
+                                  args.model_cache_size)
+        try:
+            asyncio.run(server.serve(args.host, args.port, args.socket))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.shutdown()
+        sys.exit(0)
+
+    ifc_paths = list(args.ifcfile)
+    if args.ifcdir:
+        ifc_paths += list_ifc_files(args.ifcdir)
+    if not ifc_paths:
+        parser.error('at least one of --ifcfile or --ifcdir is required')
+
+    report = args.format == 'report' and not args.no_report
+
+    pipeline = args.pipeline or args.pipeline_graph
+    if pipeline and (len(ifc_paths) > 1 or args.resolve_materials or args.scenario_db or args.scenarios):
+        parser.error('--pipeline evaluates a single IFC file, without --resolve-materials or scenarios')
+
+    if args.profile or args.profile_trace:
+        profiler.enable(args.profile_slowest)
+
+    uncertainty = None
+    if args.uncertainty > 0:
+        uncertainty = new_uncertainty_options(args.uncertainty, args.uncertainty_spread,
+                                              read_class_spreads(args.uncertainty_classes) if args.uncertainty_classes else None,
+                                              args.uncertainty_distribution, args.seed)
+
+    whole_life = None
+    if args.whole_life > 0:
+        whole_life = new_whole_life_options(args.whole_life, *(read_service_lives(args.service_lives) if args.service_lives else ()))
+
+    # Keep stdout for the JSON results
+    with contextlib.redirect_stdout(sys.stderr if args.format == 'json' else sys.stdout):
+        # The pipeline loads the database itself, while the model is read
+        material_db = None if pipeline else load_material_db(args.dbfile, args.aliases, args.match_threshold)
+
+        if pipeline:
+            graph = build_pipeline(ifc_paths[0], lambda: load_material_db(args.dbfile, args.aliases, args.match_threshold),
+                                   args.jobs, cache_dir, args.cache_size, args.stream, report, uncertainty,
+                                   args.chart_format, args.render_jobs, args.portfolio, whole_life)
+            results = get_json_result(graph.run()['Evaluation'])
+            if args.pipeline_graph:
+                with open(args.pipeline_graph, 'w') as f:
+                    f.write(graph.to_dot())
+        elif args.resolve_materials:
+            match_table = resolve_materials(ifc_paths, material_db, args.aliases, args.jobs, cache_dir, args.cache_size,
+                                            args.stream)
+            print(match_table.to_markdown(index=False, floatfmt='.2f'))
+            results = json.loads(match_table.to_json(orient='records'))
+        elif args.scenario_db or args.scenarios:
+            # Scenario sweep of every file
+            results = {}
+            for ifc_path in ifc_paths:
+                comparison_table, material_table = sweep_ifc_file(ifc_path, material_db, args.scenario_db, args.scenarios,
+                                                                  args.jobs, cache_dir, args.cache_size, args.stream,
+                                                                  report, whole_life)
+                print(comparison_table.to_markdown(floatfmt='.2f'))
+                results[os.path.splitext(os.path.basename(ifc_path))[0]] = {
+                    'Scenarios': json.loads(comparison_table.to_json(orient='index')),
+                    'Materials': json.loads(material_table.to_json(orient='index'))
+                }
+        elif len(ifc_paths) == 1:
+            results = get_json_result(evaluate_ifc_file(ifc_paths[0], material_db, args.jobs, cache_dir, args.cache_size,
+                                                        args.stream, report, uncertainty, args.chart_format,
+                                                        args.render_jobs, args.portfolio, whole_life))
+        else:
+            results = evaluate_batch(ifc_paths, material_db, args.jobs, cache_dir, args.cache_size, args.stream, report,
+                                     uncertainty, args.chart_format, args.render_jobs, args.portfolio, whole_life)
+
+    if args.format == 'json':
+        print(json.dumps(results, indent=2))
+
+    if profiler.enabled:
+        print(profiler.format_summary(), file=sys.stderr)
+        if pipeline:
+            print('', file=sys.stderr)
+            print(graph.format_summary(), file=sys.stderr)
+        if args.profile_trace:
+            profiler.write_trace(args.profile_trace)
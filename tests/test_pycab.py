@@ -0,0 +1,444 @@
+import asyncio
+import json
+import os
+import sys
+import types
+import warnings
+
+import ifcopenshell
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark
+import pycab
+
+DB_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'EC_MaterialsDB.csv')
+
+
+def test_building_without_internal_area(tmp_path, monkeypatch):
+    # A building without floor slabs has no internal area, its EC/m² is nan in the evaluation and null in JSON
+    ifc_path = str(tmp_path / 'no_slabs.ifc')
+    benchmark.generate_ifc(ifc_path, benchmark.get_element_counts(60, {'Wall': 0.6, 'Slab': 0., 'Roof': 0.1,
+                                                                        'Door': 0.1, 'Window': 0.1, 'Stair': 0.1}))
+    monkeypatch.chdir(tmp_path)
+    evaluation = pycab.evaluate_ifc_file(ifc_path, pycab.load_material_db(DB_PATH), chart_format='png',
+                                         uncertainty=pycab.new_uncertainty_options(100),
+                                         whole_life=pycab.new_whole_life_options(60))
+
+    assert evaluation['BuildingAreaInternal'] == 0.
+    assert np.isnan(evaluation['BuildingECPerAreaInternal'])
+    for name in ('report.md', 'report.html', 'benchmark.png', 'uncertainty.png', 'whole_life.png'):
+        assert os.path.isfile(os.path.join('reports', 'no_slabs', name))
+
+    result = json.loads(json.dumps(pycab.get_json_result(evaluation), allow_nan=False))
+    assert result['BuildingEC'] > 0.
+    assert result['BuildingECPerAreaInternal'] is None
+    assert result['BuildingPotentialECPerAreaInternal'] is None
+    assert result['Uncertainty']['Mean'] is None
+    assert result['WholeLife']['WholeLifeECPerAreaInternal'] is None
+
+
+def test_element_without_quantities_or_geometry(tmp_path, monkeypatch):
+    # A stair without BaseQuantities or body geometry is measured as 0 instead of crashing the geometry iterator
+    ifc_path = str(tmp_path / 'stair.ifc')
+    benchmark.generate_ifc(ifc_path, benchmark.get_element_counts(60))
+    ifc_file = ifcopenshell.open(ifc_path)
+    stair = ifc_file.by_type('IfcStair')[0]
+    for definition in stair.IsDefinedBy:
+        if definition.RelatingPropertyDefinition.is_a('IfcElementQuantity'):
+            ifc_file.remove(definition)
+    stair.Representation = None
+    ifc_file.write(ifc_path)
+    monkeypatch.chdir(tmp_path)
+
+    ifc_file = ifcopenshell.open(ifc_path)
+    assert pycab.get_missing_quantity_elements(ifc_file) == [ifc_file.by_id(stair.id())]
+    evaluation = pycab.evaluate_ifc_file(ifc_path, pycab.load_material_db(DB_PATH))
+    assert evaluation['BuildingEC'] > 0.
+    session = pycab.IncrementalEvaluation(pycab.load_material_db(DB_PATH))
+    session.update(ifcopenshell.open(ifc_path))
+    session.update(ifcopenshell.open(ifc_path))
+    assert session.extracted_count == 0
+
+
+def test_invalid_scenario_rows(tmp_path):
+    # Scenario rows that select no material or set no carbon are reported with their scenario and line
+    material_db = pycab.load_material_db(DB_PATH)
+    scenario_path = tmp_path / 'scenarios.csv'
+    for rows, message in ((['LowBrick;Clay, Brick;;;250', 'LowBrick;Plasterboard;;;'],
+                           'Scenario LowBrick, line 3 of .*: set a Replacement or an EC_Per_Volume'),
+                          (['LowBrick;;;;250'], 'Scenario LowBrick, line 2 of .*: selects no material'),
+                          (['LowBrick; ; ;;250'], 'Scenario LowBrick, line 2 of .*: selects no material'),
+                          (['LowBrick;Clay, Brick;;;abc'], "Scenario LowBrick, line 2 of .*: EC_Per_Volume 'abc'")):
+        scenario_path.write_text('\n'.join(['Scenario;Material;EC_Class;Replacement;EC_Per_Volume'] + rows) + '\n')
+        with pytest.raises(ValueError, match=message):
+            pycab.read_scenario_file(str(scenario_path), ['Clay, Brick', 'Plasterboard'], material_db)
+
+
+def test_invalid_service_life_rows(tmp_path):
+    # Service life rows without a life or without a material are reported with their line
+    lives_path = tmp_path / 'lives.csv'
+    for rows, message in ((['Clay, Brick;;60', 'Plasterboard;;'], 'Line 3 of .*: set a ServiceLife'),
+                          ([';;60'], 'Line 2 of .*: selects no material'),
+                          ([' ; ;60'], 'Line 2 of .*: selects no material'),
+                          (['Clay, Brick;;sixty'], "Line 2 of .*: ServiceLife 'sixty' is not a number"),
+                          (['Clay, Brick;;0'], 'Line 2 of .*: service life of Clay, Brick must be positive')):
+        lives_path.write_text('\n'.join(['Material;EC_Class;ServiceLife'] + rows) + '\n')
+        with pytest.raises(ValueError, match=message):
+            pycab.read_service_lives(str(lives_path))
+
+
+def test_portfolio_projects_keyed_by_path(tmp_path):
+    # Files of the same name in different directories are different projects, recording a file again replaces it
+    store = pycab.PortfolioStore(str(tmp_path / 'portfolio.db'))
+    result = {'IFCFilename': 'model', 'BuildingProperties': {'BuildingType': 'Office'}, 'BuildingAreaInternal': 100.,
+              'BuildingEC': 1000., 'BuildingECPerAreaInternal': 10., 'BuildingPotentialEC': 900.,
+              'BuildingPotentialECPerAreaInternal': 9.}
+    store.record([dict(result, IFCPath='/a/model.ifc'), dict(result, IFCPath='/b/model.ifc')])
+    store.record([dict(result, IFCPath='/a/model.ifc', BuildingECPerAreaInternal=12.)])
+    assert len(store) == 2
+    assert store.select('Office').tolist() == [10., 12.]
+    assert store.select('Office', exclude=('/a/model.ifc', '')).tolist() == [10.]
+    store.close()
+
+
+def test_report_names_of_buildings_are_unique():
+    # Building names that only differ in characters unsafe in paths, or in case, get report directories of their own
+    assert pycab.get_report_names(['Block A', 'Block_A', 'block a', 'Block B']) == {
+        'Block A': 'Block_A', 'Block_A': 'Block_A_2', 'block a': 'block_a_3', 'Block B': 'Block_B'}
+
+
+def test_incremental_update_without_slabs(tmp_path):
+    # A revision without internal slabs has no internal area, and removing the slabs again leaves exactly none
+    no_slabs_path = str(tmp_path / 'no_slabs.ifc')
+    benchmark.generate_ifc(no_slabs_path, benchmark.get_element_counts(60, {'Wall': 0.6, 'Slab': 0., 'Roof': 0.1,
+                                                                              'Door': 0.1, 'Window': 0.1, 'Stair': 0.1}))
+    slabs_path = str(tmp_path / 'slabs.ifc')
+    benchmark.generate_ifc(slabs_path, benchmark.get_element_counts(60))
+    material_db = pycab.load_material_db(DB_PATH)
+    session = pycab.IncrementalEvaluation(material_db)
+
+    evaluation = session.update(ifcopenshell.open(no_slabs_path))
+    assert evaluation['BuildingAreaInternal'] == 0.
+    assert np.isnan(evaluation['BuildingECPerAreaInternal'])
+    assert np.isnan(evaluation['BuildingPotentialECPerAreaInternal'])
+
+    evaluation = session.update(ifcopenshell.open(slabs_path))
+    full_evaluation = pycab.evaluate_ifc_file(slabs_path, material_db, report=False)
+    assert evaluation['BuildingAreaInternal'] == pytest.approx(full_evaluation['BuildingAreaInternal'])
+    assert evaluation['BuildingECPerAreaInternal'] == pytest.approx(full_evaluation['BuildingECPerAreaInternal'])
+
+    evaluation = session.update(ifcopenshell.open(no_slabs_path))
+    assert evaluation['BuildingAreaInternal'] == 0.
+    assert np.isnan(evaluation['BuildingECPerAreaInternal'])
+
+
+def test_evaluation_server(tmp_path, monkeypatch):
+    # Requests and responses over the HTTP protocol of the server, on a Unix socket
+    ifc_path = str(tmp_path / 'no_slabs.ifc')
+    benchmark.generate_ifc(ifc_path, benchmark.get_element_counts(60, {'Wall': 0.6, 'Slab': 0., 'Roof': 0.1,
+                                                                        'Door': 0.1, 'Window': 0.1, 'Stair': 0.1}))
+    monkeypatch.chdir(tmp_path)
+    socket_path = str(tmp_path / 'server.sock')
+    server = pycab.EvaluationServer(pycab.load_material_db(DB_PATH))
+
+    async def send(method, path, body=b''):
+        reader, writer = await asyncio.open_unix_connection(socket_path)
+        writer.write(b'%s %s HTTP/1.1\r\nContent-Length: %d\r\nConnection: close\r\n\r\n'
+                     % (method.encode(), path.encode(), len(body)) + body)
+        await writer.drain()
+        response = await reader.read()
+        writer.close()
+        head, _, payload = response.partition(b'\r\n\r\n')
+        return int(head.split()[1]), json.loads(payload)
+
+    async def run():
+        serving = asyncio.ensure_future(server.serve(socket_path=socket_path))
+        while not os.path.exists(socket_path):
+            assert not serving.done()
+            await asyncio.sleep(0.05)
+        try:
+            assert await send('GET', '/stats') == (200, {'Requests': 0, 'CacheHits': 0, 'Workers': 1})
+            assert (await send('GET', '/unknown'))[0] == 404
+            assert (await send('POST', '/evaluate', b'not json'))[0] == 400
+            assert (await send('POST', '/evaluate', b'{"ifcfile": 1}'))[0] == 400
+            assert (await send('POST', '/evaluate', b'{"ifcfile": "missing.ifc"}'))[0] == 404
+
+            body = json.dumps({'ifcfile': ifc_path}).encode()
+            status, result = await send('POST', '/evaluate', body)
+            assert status == 200
+            assert result['BuildingEC'] > 0. and result['BuildingECPerAreaInternal'] is None
+            assert not result['CacheHit']
+            status, result = await send('POST', '/evaluate', body)
+            assert status == 200 and result['CacheHit']
+            status, stats = await send('GET', '/stats')
+            assert stats['Requests'] == 2 and stats['CacheHits'] == 1
+        finally:
+            serving.cancel()
+
+    try:
+        asyncio.run(run())
+    finally:
+        server.shutdown()
+
+
+def test_scenarios_without_internal_area():
+    # The scenario table of a building without internal area has nan per m², as the rest of the report
+    quantity_matrix = (['Wall'], ['Clay, Brick'], np.array([[2.]]), np.array([[500.]]))
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        comparison_table, _ = pycab.evaluate_scenarios(quantity_matrix, {'Current': np.array([np.nan]),
+                                                                         'LowBrick': np.array([100.])}, 0.)
+    assert comparison_table['BuildingEC'].tolist() == [500., 200.]
+    assert comparison_table['BuildingECPerAreaInternal'].isna().all()
+
+
+def test_streaming_extraction_matches_ifcopenshell(tmp_path):
+    # --stream reads the same elements as ifcopenshell, comments with ';' or quotes in them are skipped
+    ifc_path = str(tmp_path / 'model.ifc')
+    benchmark.generate_ifc(ifc_path, benchmark.get_element_counts(80))
+    with open(ifc_path, encoding='latin-1') as f:
+        text = f.read()
+    commented_path = str(tmp_path / 'commented.ifc')
+    with open(commented_path, 'w', encoding='latin-1') as f:
+        f.write(text.replace(';\n#', ";\n/* it's a comment; with ' quotes */\n#").replace('(#', "(/* ; */#"))
+
+    layer_table = pycab.build_layer_table(pycab.extract_ifc_file(ifc_path)[0])
+    for path in (ifc_path, commented_path):
+        streamed_table = pycab.build_layer_table(pycab.extract_ifc_file(path, stream=True)[0])
+        pd.testing.assert_frame_equal(streamed_table, layer_table)
+
+
+def test_compiled_material_db_round_trip(tmp_path, monkeypatch):
+    # A compiled database answers lookups, matches and replacements as the CSV it was compiled from
+    material_db = pycab.load_material_db(DB_PATH)
+    compiled_path = str(tmp_path / 'materials.pycabdb')
+    pycab.compile_material_db(DB_PATH, compiled_path)
+    compiled_db = pycab.load_material_db(compiled_path)
+    assert isinstance(compiled_db, pycab.CompiledMaterialDatabase)
+
+    names = [material_db.get_name(position) for position in range(len(material_db))]
+    assert len(compiled_db) == len(material_db)
+    # The CSV keeps the raw text of the numeric columns, the values used by the evaluation are compared
+    columns = ('ID', 'Name', 'EC_Class', 'EC_ID', 'EC_Per_Volume')
+    for name, record in material_db.lookup_many(names).items():
+        assert [compiled_db.lookup(name)[column] for column in columns] == [record[column] for column in columns]
+    assert compiled_db.lookup(' %s ' % names[0]) == compiled_db.lookup(names[0])
+    assert compiled_db.lookup('Not a material') is None
+    for query in ('Plasterbord', 'brick clay', 'Concrete C30'):
+        assert compiled_db.match(query) == material_db.match(query)
+
+    material_list = names[::7] + ['Not a material']
+    records, min_ec_dict, replacements = pycab.find_replacements(material_list, material_db)
+    compiled_records, compiled_min_ec_dict, compiled_replacements = pycab.find_replacements(material_list, compiled_db)
+    assert compiled_records.keys() == records.keys()
+    for material, record in records.items():
+        assert (compiled_records[material] is None) == (record is None)
+        if record is not None:
+            assert [compiled_records[material][column] for column in columns] == [record[column] for column in columns]
+    assert compiled_min_ec_dict == min_ec_dict
+    assert compiled_replacements.keys() == replacements.keys()
+    for material, table in replacements.items():
+        pd.testing.assert_frame_equal(compiled_replacements[material], table)
+
+    # A file compiled without the match index rebuilds it on first use
+    stale_path = str(tmp_path / 'stale.pycabdb')
+    with monkeypatch.context() as patch:
+        patch.setattr(pycab, 'build_match_index', lambda names, descriptions: {})
+        pycab.compile_material_db(DB_PATH, stale_path)
+    stale_db = pycab.load_material_db(stale_path)
+    assert 'NameGrams.keys' not in stale_db.arrays
+    assert stale_db.match('Plasterbord') == material_db.match('Plasterbord')
+
+    # Files that are not compiled, cut short or missing arrays are rejected on load
+    with pytest.raises(ValueError, match='not a compiled material database'):
+        pycab.CompiledMaterialDatabase(DB_PATH)
+    with open(compiled_path, 'rb') as f:
+        data = f.read()
+    truncated_path = str(tmp_path / 'truncated.pycabdb')
+    with open(truncated_path, 'wb') as f:
+        f.write(data[:len(data) // 2])
+    with pytest.raises(ValueError, match='truncated'):
+        pycab.load_material_db(truncated_path)
+    # The header of a file of an older layout, padded to the same size so the arrays keep their offsets
+    header_size = int(np.frombuffer(data[8:16], dtype=np.uint64)[0])
+    header = json.loads(data[16:16 + header_size])
+    del header['Arrays']['EC_Per_Volume']
+    with open(stale_path, 'wb') as f:
+        f.write(data[:16] + json.dumps(header).encode().ljust(header_size) + data[16 + header_size:])
+    with pytest.raises(ValueError, match='older version, missing EC_Per_Volume'):
+        pycab.load_material_db(stale_path)
+
+
+def get_elements(element_store):
+    # Values and layers of each element by GlobalId, missing numbers as None so they compare equal
+    def get_value(value):
+        return None if isinstance(value, float) and np.isnan(value) else value
+
+    strings = {column: table.strings for column, table in element_store.strings.items()}
+    elements = {}
+    for number, global_id in enumerate(element_store.global_ids):
+        elements[global_id] = [get_value(strings[column][values[number]] if column in strings else values[number])
+                               for column, values in element_store.elements.items()]
+    for position, name in enumerate(element_store.layer_names()):
+        element = elements[element_store.global_ids[element_store.layers['Element'][position]]]
+        element.append([name] + [get_value(element_store.layers[column][position])
+                                 for column in ('LayerThickness', 'EmbodiedCarbon', 'MassDensity', 'UnitCarbon')])
+    return elements
+
+
+def test_parallel_extraction_matches_serial(tmp_path):
+    # Extraction in a process pool gives the same elements and layers as a serial one
+    ifc_path = str(tmp_path / 'model.ifc')
+    benchmark.generate_ifc(ifc_path, benchmark.get_element_counts(120))
+    element_store, building_properties = pycab.extract_ifc_file(ifc_path)
+    parallel_store, parallel_building_properties = pycab.extract_ifc_file(ifc_path, jobs=2)
+
+    assert element_store.element_count == 120
+    assert get_elements(parallel_store) == get_elements(element_store)
+    assert parallel_building_properties == building_properties
+
+
+def test_cached_extraction(tmp_path, monkeypatch):
+    # A cached extraction reloads the same elements, and a new extraction version does not read older entries
+    ifc_path = str(tmp_path / 'model.ifc')
+    benchmark.generate_ifc(ifc_path, benchmark.get_element_counts(120))
+    cache_dir = str(tmp_path / 'cache')
+    extractions = []
+    extract_model = pycab.extract_model
+    monkeypatch.setattr(pycab, 'extract_model', lambda *args: extractions.append(args) or extract_model(*args))
+
+    element_store, building_properties = pycab.extract_ifc_file(ifc_path, cache_dir=cache_dir)
+    cache_path = pycab.get_cache_path(cache_dir, ifc_path)
+    assert os.listdir(cache_dir) == [os.path.basename(cache_path)]
+    cached_store, cached_building_properties = pycab.extract_ifc_file(ifc_path, cache_dir=cache_dir)
+    assert len(extractions) == 1
+    assert get_elements(cached_store) == get_elements(element_store)
+    assert cached_building_properties == building_properties
+    pd.testing.assert_frame_equal(pycab.build_layer_table(cached_store), pycab.build_layer_table(element_store))
+
+    monkeypatch.setattr(pycab, 'EXTRACTION_VERSION', pycab.EXTRACTION_VERSION + 1)
+    assert pycab.get_cache_path(cache_dir, ifc_path) != cache_path
+    pycab.extract_ifc_file(ifc_path, cache_dir=cache_dir)
+    assert len(extractions) == 2
+    assert len(os.listdir(cache_dir)) == 2
+
+    # Damaged entries are misses rather than errors
+    with open(cache_path, 'wb') as f:
+        f.write(b'not an npz file')
+    assert pycab.load_extraction(cache_path) is None
+
+
+def test_element_store_interning(tmp_path):
+    # Repeated names are stored once, merged stores recode their names, and a saved store loads unchanged
+    def new_store(elements):
+        element_store = pycab.ElementStore()
+        for global_id, name, category, layers in elements:
+            number = element_store.add_element(types.SimpleNamespace(GlobalId=global_id, Name=name), category, False, 2.)
+            for layer in layers:
+                element_store.add_layer(number, layer, 100., 0.2, 1800.)
+            if not layers:
+                element_store.add_layer(number)
+        return element_store
+
+    element_store = new_store([('a', 'Wall A', 'Wall', ['Brick', 'Plaster']), ('b', 'Wall A', 'Wall', ['Brick'])])
+    other_store = new_store([('c', None, 'Door', []), ('d', 'Wall B', 'Wall', ['Plaster', 'Insulation'])])
+    assert element_store.strings['Name'].strings == ['Wall A']
+    assert element_store.material_names() == ['Brick', 'Plaster']
+    assert list(element_store.elements['Name']) == [0, 0]
+    assert list(element_store.layers['Layer']) == [0, 1, 0]
+
+    element_store.extend(other_store)
+    assert element_store.element_count == 4
+    assert len(element_store) == 6
+    assert element_store.find('d') == 3
+    assert element_store.strings['Name'].strings == ['Wall A', '', 'Wall B']
+    assert element_store.material_names() == ['Brick', 'Plaster', 'Insulation']
+    assert element_store.layer_names() == ['Brick', 'Plaster', 'Brick', None, 'Plaster', 'Insulation']
+    assert list(element_store.layers['Element']) == [0, 0, 1, 2, 3, 3]
+    assert get_elements(element_store)['d'] == get_elements(other_store)['d']
+    assert get_elements(element_store)['c'] == get_elements(other_store)['c']
+
+    cache_path = str(tmp_path / 'store.npz')
+    building_properties = {'BuildingName': 'Test', 'Buildings': []}
+    pycab.save_extraction(cache_path, element_store, building_properties)
+    loaded_store, loaded_building_properties = pycab.load_extraction(cache_path)
+    assert loaded_building_properties == building_properties
+    assert loaded_store.strings['Layer'].strings == element_store.strings['Layer'].strings
+    assert get_elements(loaded_store) == get_elements(element_store)
+    for columns, loaded_columns in ((element_store.elements, loaded_store.elements),
+                                    (element_store.layers, loaded_store.layers)):
+        for column, values in columns.items():
+            assert loaded_columns[column].typecode == values.typecode
+            np.testing.assert_array_equal(loaded_columns[column], values)
+
+
+def test_uncertainty_is_deterministic(tmp_path, monkeypatch):
+    # Samples depend only on the seed, not on the number of processes
+    ifc_path = str(tmp_path / 'model.ifc')
+    benchmark.generate_ifc(ifc_path, benchmark.get_element_counts(60))
+    material_db = pycab.load_material_db(DB_PATH)
+    evaluation = pycab.evaluate_layer_table(pycab.build_layer_table(pycab.extract_ifc_file(ifc_path)[0]), material_db)
+    monkeypatch.setattr(pycab, 'UNCERTAINTY_CHUNK', 1000)
+    options = pycab.new_uncertainty_options(3500, seed=7)
+
+    uncertainty = pycab.evaluate_uncertainty(evaluation, material_db, options)
+    assert len(uncertainty['Samples']) == 3500
+    for repeated in (pycab.evaluate_uncertainty(evaluation, material_db, options),
+                     pycab.evaluate_uncertainty(evaluation, material_db, options, jobs=2)):
+        np.testing.assert_array_equal(repeated['Samples'], uncertainty['Samples'])
+        assert repeated['Percentiles'] == uncertainty['Percentiles']
+    other_seed = pycab.evaluate_uncertainty(evaluation, material_db, pycab.new_uncertainty_options(3500, seed=8))
+    assert not np.array_equal(other_seed['Samples'], uncertainty['Samples'])
+    percentiles = uncertainty['Percentiles']
+    assert percentiles[5] < evaluation['BuildingECPerAreaInternal'] < percentiles[95]
+
+
+def test_matcher_ranks_close_names_first():
+    # Exact names, names with other case and punctuation and names with a missing letter match their material first
+    material_db = pycab.load_material_db(DB_PATH)
+    for position in range(len(material_db)):
+        name = material_db.get_name(position)
+        assert material_db.match(name)[0] == (name, 1.)
+        for query in (name.lower().replace(',', ''), name[:len(name) // 2] + name[len(name) // 2 + 1:]):
+            candidates = material_db.match(query)
+            assert candidates[0][0] == name
+            assert candidates[0][1] > max([confidence for _, confidence in candidates[1:]], default=0.)
+
+    assert pycab.match_material('Plasterbord', material_db) is None
+    material_db.match_threshold = 0.7
+    assert pycab.match_material('Plasterbord', material_db)['Name'] == 'Plasterboard'
+
+
+def test_pipeline_matches_sequential_evaluation(tmp_path, monkeypatch):
+    # The concurrent pipeline gives the evaluation of evaluate_ifc_file, and the error of a failed stage
+    ifc_path = str(tmp_path / 'model.ifc')
+    benchmark.generate_ifc(ifc_path, benchmark.get_element_counts(80))
+    monkeypatch.chdir(tmp_path)
+    material_db = pycab.load_material_db(DB_PATH)
+    options = {'chart_format': 'png', 'uncertainty': pycab.new_uncertainty_options(500),
+               'whole_life': pycab.new_whole_life_options(60)}
+
+    evaluation = pycab.evaluate_ifc_file(ifc_path, material_db, **options)
+    graph = pycab.build_pipeline(ifc_path, lambda: pycab.load_material_db(DB_PATH), **options)
+    pipeline_evaluation = graph.run(jobs=2)['Evaluation']
+    assert json.dumps(pycab.get_json_result(pipeline_evaluation)) == json.dumps(pycab.get_json_result(evaluation))
+    np.testing.assert_array_equal(pipeline_evaluation['Uncertainty']['Samples'], evaluation['Uncertainty']['Samples'])
+    assert set(graph.timings) == set(graph.stages)
+    assert graph.critical_path()[0][-1] == 'Evaluation'
+
+    def fail(*arguments):
+        raise RuntimeError('replacements failed')
+    monkeypatch.setattr(pycab, 'find_replacements', fail)
+    graph = pycab.build_pipeline(ifc_path, material_db, report=False)
+    with pytest.raises(RuntimeError, match='replacements failed'):
+        graph.run(jobs=2)
+    assert 'Evaluate' not in graph.timings
+
+    with pytest.raises(ValueError, match='duplicate stage'):
+        graph.add('Evaluate', lambda: None)
+    with pytest.raises(ValueError, match='unknown stages Missing'):
+        graph.add('Other', lambda: None, ['Missing'])